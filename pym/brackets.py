@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An index of the brackets in a buffer, for finding matching pairs
+"""
+
+import re
+
+from pym.buf import RegionIndex
+from pym.weight_tree import WeightNode, WeightTree
+
+# Opening brackets and the closing brackets that match them
+BRACKET_PAIRS = {'(': ')', '[': ']', '{': '}'}
+
+# Each bracket and the opening bracket of its kind
+BRACKET_KINDS = {'(': '(', ')': '(', '[': '[', ']': '[', '{': '{', '}': '{'}
+
+# Any bracket
+BRACKET_PATTERN = re.compile(r'[][(){}]')
+
+class DepthNode(WeightNode):
+    """
+    A node in a DepthTree. Besides its count and total, the node knows the
+    lowest running total reached along its weights, counting the empty total
+    of 0 at the start.
+    """
+    __slots__ = ('low',)
+
+    def recount(self):
+        """
+        Recompute the count, total and lowest running total for this node
+        """
+        super(DepthNode, self).recount()
+        total = 0
+        low = 0
+
+        if self.children == None:
+            for weight in self.weights:
+                total += weight
+                low = min(low, total)
+        else:
+            for child in self.children:
+                low = min(low, total + child.low)
+                total += child.total
+
+        self.low = low
+
+    def first_at_most(self, start, target, base):
+        """
+        Get the first running total index from start on where the running
+        total is at most target, or None. Index k is the total of the first k
+        weights, and base is the total before this node.
+        """
+        if start > self.count:
+            return None
+        if start == 0 and base + self.low > target:
+            return None
+
+        if self.children == None:
+            total = base
+            for k, weight in enumerate(self.weights):
+                if k >= start and total <= target:
+                    return k
+                total += weight
+            return self.count if total <= target else None
+
+        pos = 0
+        for child in self.children:
+            if start <= pos + child.count:
+                found = child.first_at_most(max(start - pos, 0), target,
+                                            base)
+                if found != None:
+                    return pos + found
+            pos += child.count
+            base += child.total
+
+        return None
+
+    def last_at_most(self, end, target, base):
+        """
+        Get the last running total index up to end where the running total is
+        at most target, or None. See first_at_most.
+        """
+        if end < 0:
+            return None
+        if end >= self.count and base + self.low > target:
+            return None
+
+        if self.children == None:
+            totals = [base]
+            for weight in self.weights:
+                totals.append(totals[-1] + weight)
+            for k in range(min(end, self.count), -1, -1):
+                if totals[k] <= target:
+                    return k
+            return None
+
+        starts = []
+        pos = 0
+        for child in self.children:
+            starts.append((pos, base))
+            pos += child.count
+            base += child.total
+
+        for child, (pos, base) in reversed(list(zip(self.children, starts))):
+            if end >= pos:
+                found = child.last_at_most(end - pos, target, base)
+                if found != None:
+                    return pos + found
+
+        return None
+
+class DepthTree(WeightTree):
+    """
+    A B-tree over a list of +1 and -1 weights, one per bracket, keeping the
+    running totals along the list searchable. The total before a bracket is
+    its nesting depth, so the bracket matching an opening bracket is found
+    by looking for where the total next drops back to that depth. Looking
+    up a total, splicing the list and both searches are O(log n).
+    """
+    node_class = DepthNode
+
+    def first_at_most(self, start, target):
+        """
+        Get the first k from start on where the total of the first k weights
+        is at most target, or None
+        """
+        return self.root.first_at_most(start, target, 0)
+
+    def last_at_most(self, end, target):
+        """
+        Get the last k up to end where the total of the first k weights is at
+        most target, or None
+        """
+        return self.root.last_at_most(end, target, 0)
+
+class BracketIndex(object):
+    """
+    The brackets in a buffer, as regions one character long tagged with the
+    bracket. Each kind of bracket is kept in its own RegionIndex, so edits
+    move them like any other region, and in a DepthTree running parallel to
+    it, so matching brackets and the brackets around a position are found in
+    O(log n). Kinds are matched separately, the way vi's % does.
+
+    The regions are supplied by the highlighter from the lexer's tokens, so
+    brackets in strings and comments are left out.
+    """
+    def __init__(self):
+        self.regions = {x: RegionIndex() for x in BRACKET_PAIRS}
+        self.depths = {x: DepthTree() for x in BRACKET_PAIRS}
+
+    def __iter__(self):
+        for index in self.regions.values():
+            yield from index
+
+    def replace(self, start, end, source, regs):
+        """
+        Replace the brackets from the given source that start between start
+        and end (exclusive) with a sorted list of new bracket regions in that
+        range.
+        """
+        by_kind = {x: [] for x in BRACKET_PAIRS}
+
+        for reg in regs:
+            by_kind[BRACKET_KINDS[reg.tag]].append(reg)
+
+        for kind, index in self.regions.items():
+            low = index.bisect(index.items, start)
+            high = index.bisect(index.items, end)
+            old_len = len(index)
+            index.replace(start, end, source, by_kind[kind])
+            new_high = high + len(index) - old_len
+            self.depths[kind].splice(low, high,
+                                     [1 if x.tag == kind else -1
+                                      for x in index.items[low:new_high]])
+
+    def expand(self, start, end):
+        """
+        Move brackets to make room for text inserted from start to end
+        """
+        for index in self.regions.values():
+            index.expand(start, end)
+
+    def collapse(self, start, end):
+        """
+        Move brackets to close up the text deleted from start to end
+        """
+        for index in self.regions.values():
+            index.collapse(start, end)
+
+    def find(self, pos):
+        """
+        Get the kind and index of the bracket at a position, or None
+        """
+        for kind, index in self.regions.items():
+            i = index.bisect(index.items, pos)
+            if i < len(index) and index.items[i].start == pos:
+                return kind, i
+
+        return None
+
+    def next_on_line(self, pos):
+        """
+        Get the position of the first bracket at or after a position on the
+        same line, or None
+        """
+        found = None
+
+        for index in self.regions.values():
+            i = index.bisect(index.items, pos)
+            if i < len(index) and index.items[i].start[0] == pos[0]:
+                start = index.items[i].start
+                if found == None or start < found:
+                    found = start
+
+        return found
+
+    def match(self, pos):
+        """
+        Get the position of the bracket matching the one at a position, or
+        None
+        """
+        found = self.find(pos)
+
+        if found == None:
+            return None
+
+        kind, i = found
+        items = self.regions[kind].items
+        depths = self.depths[kind]
+
+        if items[i].tag == kind:
+            k = depths.first_at_most(i + 1, depths.total(i))
+            if k == None:
+                return None
+            return items[k - 1].start
+
+        k = depths.last_at_most(i, depths.total(i + 1))
+        if k == None:
+            return None
+        return items[k].start
+
+    def enclosing(self, pos, kind=None):
+        """
+        Get the positions of the opening and closing brackets of the
+        innermost pair around a position, as a tuple, or None. A bracket at
+        the position counts as inside its own pair. If no kind is given the
+        innermost pair of any kind is found.
+        """
+        if kind == None:
+            found = [self.enclosing(pos, x) for x in BRACKET_PAIRS]
+            found = [x for x in found if x != None]
+            return max(found, default=None)
+
+        index = self.regions[kind]
+        depths = self.depths[kind]
+        i = index.bisect(index.items, pos)
+
+        if i < len(index) and index.items[i].start == pos and \
+                index.items[i].tag == kind:
+            i += 1
+
+        depth = depths.total(i)
+        opening = depths.last_at_most(i, depth - 1)
+
+        if opening == None:
+            return None
+
+        closing = depths.first_at_most(i, depth - 1)
+
+        if closing == None:
+            return None
+
+        return (index.items[opening].start, index.items[closing - 1].start)
@@ -23,10 +23,16 @@ Handling for text buffers. This is the core of the editor.
 
 import os
 import re
-import magic
+import stat
+import tempfile
+from heapq import merge
 from operator import attrgetter
 
 from pym import pym
+from .piece_table import PieceTable, MappedLines
+from .line_index import LineIndex
+from .search import SearchIndex
+from .undo import UndoJournal
 
 class NoFileNameError(Exception):
     """
@@ -80,45 +86,75 @@ class Motion(object):
             col = 0
         if row < 0:
             row = 0
+        removed_from = (row, col)
         prepend = ""
 
+        text, text_start = self.removed_text(row, col, end)
+        cursor = (self.buf.row, self.buf.col)
+
         if row < end[0]:
             prepend = self.buf.lines[row][:col]
-            del self.buf.lines[row:end[0]]
+            self.buf.replace_lines(row, end[0], [])
             col = 0
         if len(self.buf.lines) == 0:
-            self.buf.lines = ['']
+            self.buf.replace_lines(0, 0, [''])
 
         if row >= len(self.buf.lines):
             row = len(self.buf.lines) - 1
         line = self.buf.lines[row]
-        self.buf.lines[row] = prepend + line[0:col] + line[end[1]:]
+        self.buf.replace_lines(row, row + 1,
+                               [prepend + line[0:col] + line[end[1]:]])
         col = self.buf.col
         if start != self.start:
             self.execute()
         else:
             self.buf.move_to(*start)
         self.buf.col_want = col
-        self.buf.collapse_regions((row, col), end)
+        self.buf.collapse_regions(removed_from, end)
+        self.buf.journal.record(False, text_start, text, cursor)
         self.buf.dirty = True
 
+    def removed_text(self, row, col, end):
+        """
+        Get the text delete() will remove when deleting from (row, col) to
+        end, and the position it starts at.
+        """
+        lines = self.buf.lines
+
+        if end[0] < len(lines):
+            start = (row, min(col, len(lines[row])))
+            end = (end[0], max(min(end[1], len(lines[end[0]])), 0))
+        else:
+            # Deleting through the last line takes the newline before the
+            # first deleted line with it.
+            last = len(lines) - 1
+            end = (last, len(lines[last]))
+
+            if row > 0:
+                start = (row - 1, len(lines[row - 1]))
+            else:
+                start = (0, 0)
+
+        return Motion(self.buf, start, end).get_text(), start
+
     def get_text(self):
         """
         Retrieve the text passed over by this motion
         """
         start, end = self.ordered_coords()
 
-        row = start[0]
-        col = start[1]
+        if start[0] == end[0]:
+            return self.buf.lines[start[0]][start[1]:end[1]]
 
-        ret = ""
+        lines = self.buf.lines[start[0]:end[0] + 1]
 
-        while row < end[0]:
-            ret += self.buf.lines[row][col:] + "\n"
-            row += 1
-            col = 0
+        # Line motions may end on the row past the last line
+        if len(lines) <= end[0] - start[0]:
+            lines.append("")
 
-        return ret + self.buf.lines[row][col:end[1]]
+        lines[0] = lines[0][start[1]:]
+        lines[-1] = lines[-1][:end[1]]
+        return "\n".join(lines)
 
 class LineMotion(Motion):
     """
@@ -137,6 +173,19 @@ class LineMotion(Motion):
         self.buf.move_to(self.target, self.buf.col_want)
         pym.redraw()
 
+class InclusiveMotion(Motion):
+    """
+    A motion whose text includes the character at its far end, like the
+    motion of vi's `%`
+    """
+    def delete(self):
+        start, end = self.ordered_coords()
+        Motion(self.buf, start, (end[0], end[1] + 1)).delete()
+
+    def get_text(self):
+        start, end = self.ordered_coords()
+        return Motion(self.buf, start, (end[0], end[1] + 1)).get_text()
+
 class NullMotion(Motion):
     "A motion that goes nowhere"
 
@@ -158,29 +207,590 @@ class Region(object):
     """
     A static region in a buffer. Usually used for things like hilighting or
     folding.
+
+    Once a region is added to a buffer its row is kept by the buffer's
+    RegionIndex, which may store it relative to the end of the buffer so that
+    edits above the region move it without touching it. The end is stored as
+    a number of rows after the start, and a column.
+
+    The source is whatever created the region (i.e. a Highlighter), so that it
+    can find its own regions again.
     """
 
-    def __init__(self, update, tag, start, end):
+    def __init__(self, update, tag, start, end, source=None):
         self.update = update
         self.tag = tag
-        self.start = start
-        self.end = end
+        self.source = source
+        self.owner = None
+        self.tail = False
+        self.anchor = start[0]
+        self.col = start[1]
+        self.span = end[0] - start[0]
+        self.end_col = end[1]
+
+    @property
+    def row(self):
+        """
+        The row this region starts on
+        """
+        if self.tail:
+            return self.owner.base - self.anchor
+        return self.anchor
+
+    def get_start(self):
+        """
+        Get the start position of this region
+        """
+        return (self.row, self.col)
+
+    def set_start(self, start):
+        """
+        Set the start position of this region
+        """
+        self.place(start, self.end)
+
+    def get_end(self):
+        """
+        Get the end position of this region
+        """
+        return (self.row + self.span, self.end_col)
+
+    def set_end(self, end):
+        """
+        Set the end position of this region
+        """
+        self.place(self.start, end)
+
+    def place(self, start, end):
+        """
+        Move this region to cover the given positions
+        """
+        owner = self.owner
+
+        if owner != None:
+            owner.remove(self)
+
+        self.anchor = start[0]
+        self.col = start[1]
+        self.span = end[0] - start[0]
+        self.end_col = end[1]
+
+        if owner != None:
+            owner.add(self)
+
+    start = property(get_start, set_start, "Start position of the region")
+    end = property(get_end, set_end, "End position of the region")
+
+class RegionIndex(object):
+    """
+    The regions of a buffer, sorted by start position. Regions spanning more
+    than one line are also kept in a second sorted list along with the
+    longest such span. Finding the regions over a line then only looks at
+    the regions starting on it and the spanning regions that start within
+    that longest span before it, rather than at every region.
+
+    The widest region within a single line is kept too, so finding the
+    regions over some columns of a line only looks at the regions starting
+    within that width before them.
+
+    Like a gap buffer, the list is split at a gap. Regions before the gap
+    store their row directly, and regions after it store their distance from
+    base, so adding lines above them is a single change to base. Edits move
+    the gap to themselves first, so an edit only touches the regions on the
+    lines it changed, plus those between it and the last edit.
+    """
+    def __init__(self):
+        self.items = []
+        self.spanning = []
+        self.watched = []
+        self.max_span = 0
+        self.max_width = 0
+        self.gap = 0
+        self.base = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, key):
+        return self.items[key]
+
+    @staticmethod
+    def bisect(items, pos):
+        """
+        Get the index of the first region in a sorted list that starts at or
+        after the given position.
+        """
+        low = 0
+        high = len(items)
+
+        while low < high:
+            mid = (low + high) // 2
+            if items[mid].start < pos:
+                low = mid + 1
+            else:
+                high = mid
+
+        return low
+
+    def find(self, items, reg):
+        """
+        Get the index of a region in a sorted list, or None
+        """
+        start = reg.start
+        i = self.bisect(items, start)
+
+        while i < len(items) and items[i].start == start:
+            if items[i] is reg:
+                return i
+            i += 1
+
+        return None
+
+    def move_gap(self, idx):
+        """
+        Move the gap to just before the given index
+        """
+        for reg in self.items[idx:self.gap]:
+            reg.anchor = self.base - reg.anchor
+            reg.tail = True
+
+        for reg in self.items[self.gap:idx]:
+            reg.anchor = self.base - reg.anchor
+            reg.tail = False
+
+        self.gap = idx
+
+    def add(self, reg):
+        """
+        Add a region, before any that start at the same place
+        """
+        reg.owner = self
+        reg.tail = False
+        idx = self.bisect(self.items, reg.start)
+
+        if idx > self.gap:
+            reg.anchor = self.base - reg.anchor
+            reg.tail = True
+        else:
+            self.gap += 1
+
+        self.items.insert(idx, reg)
+
+        if reg.span > 0:
+            self.spanning.insert(self.bisect(self.spanning, reg.start), reg)
+            self.max_span = max(self.max_span, reg.span)
+        else:
+            self.max_width = max(self.max_width, reg.end_col - reg.col)
+
+        if reg.update != None:
+            self.watched.append(reg)
+
+    def extend(self, regs):
+        """
+        Add many regions at once
+        """
+        self.move_gap(len(self.items))
+
+        for reg in regs:
+            reg.owner = self
+            reg.tail = False
+
+        self.items.extend(regs)
+        self.items.sort(key=attrgetter('start'))
+        self.gap = len(self.items)
+        self.watched.extend(x for x in regs if x.update != None)
+        self.reindex()
+
+    def remove(self, reg):
+        """
+        Remove a region
+        """
+        idx = self.find(self.items, reg)
+        if idx == None:
+            return
+
+        del self.items[idx]
+        if idx < self.gap:
+            self.gap -= 1
+
+        idx = self.find(self.spanning, reg)
+        if idx != None:
+            del self.spanning[idx]
+
+        if reg.update != None:
+            self.watched.remove(reg)
+
+        reg.anchor = reg.row
+        reg.tail = False
+        reg.owner = None
+
+    def replace(self, start, end, source, regs):
+        """
+        Replace the regions from the given source that start between start
+        and end (exclusive) with a sorted list of new regions in that range.
+        Return the last row reached by a region that was removed or added.
+        """
+        low = self.bisect(self.items, start)
+        high = self.bisect(self.items, end)
+        self.move_gap(high)
+
+        old = self.items[low:high]
+        kept = [x for x in old if x.source is not source]
+        reach = max([x.end[0] for x in old if x.source is source] +
+                    [x.end[0] for x in regs] + [start[0]])
+
+        for reg in old:
+            if reg.source is not source:
+                continue
 
-from .filetypes import plain_text, file_type_for_mime
+            if reg.span > 0:
+                del self.spanning[self.find(self.spanning, reg)]
+            if reg.update != None:
+                self.watched.remove(reg)
+            reg.owner = None
+
+        for reg in regs:
+            reg.owner = self
+            reg.tail = False
+
+        self.items[low:high] = merge(kept, regs, key=attrgetter('start'))
+        self.gap += len(kept) + len(regs) - len(old)
+
+        for reg in regs:
+            if reg.span > 0:
+                self.spanning.insert(self.bisect(self.spanning, reg.start),
+                                     reg)
+                self.max_span = max(self.max_span, reg.span)
+            else:
+                self.max_width = max(self.max_width, reg.end_col - reg.col)
+
+        self.watched.extend(x for x in regs if x.update != None)
+        return reach
+
+    def reindex(self):
+        """
+        Rebuild the list of spanning regions, and the longest span and width
+        """
+        self.spanning = [x for x in self.items if x.span > 0]
+        self.max_span = max([x.span for x in self.spanning], default=0)
+        self.max_width = max([x.end_col - x.col for x in self.items
+                              if x.span == 0], default=0)
+
+    def set_span(self, reg, span, end_col):
+        """
+        Change how far a region extends, keeping the spanning list current
+        """
+        if (reg.span > 0) != (span > 0):
+            if span > 0:
+                reg.span = span
+                self.spanning.insert(self.bisect(self.spanning, reg.start),
+                                     reg)
+            else:
+                del self.spanning[self.find(self.spanning, reg)]
+
+        reg.span = span
+        reg.end_col = end_col
+        self.max_span = max(self.max_span, span)
+
+        if span == 0:
+            self.max_width = max(self.max_width, end_col - reg.col)
+
+    def shift(self, start, end, lines_added, moved, reaching):
+        """
+        Apply an edit. The regions in moved have already been moved to new
+        positions, and the regions in reaching have their ends adjusted by
+        the given function. Everything from the end of the edit on moves
+        down by lines_added. Return the watched regions whose position
+        changed.
+        """
+        before = [(x, x.start, x.end) for x in self.watched]
+        spans = [(x,) + end(x) for x in reaching if x.end >= start]
+
+        for reg, row, col, span, end_col in moved:
+            reg.anchor = row
+            reg.col = col
+            spans.append((reg, span, end_col))
+
+        self.base += lines_added
+
+        # Spans change last, once every start is in place and the spanning
+        # list is in order again.
+        for reg, span, end_col in spans:
+            self.set_span(reg, span, end_col)
+
+        return [x for x, old_start, old_end in before
+                if x.start != old_start or x.end != old_end]
+
+    def expand(self, start, end):
+        """
+        Move regions to make room for text inserted from start to end.
+        Return the watched regions that moved.
+        """
+        row, col = start
+        lines_added = end[0] - row
+        cols_added = end[1] - col
+
+        first = self.bisect(self.items, (row, col + 1))
+        after = self.bisect(self.items, (row + 1,))
+        self.move_gap(after)
+
+        reaching = self.spanning_into(row)
+        reaching += self.items[self.bisect(self.items, (row,)):first]
+        reaching = [x for x in reaching if x.end > start]
+
+        def new_end(reg):
+            """
+            Where a region containing the insert point now ends
+            """
+            end_col = reg.end_col
+            if reg.row + reg.span == row:
+                end_col += cols_added
+            return (reg.span + lines_added, end_col)
+
+        moved = []
+        for reg in self.items[first:after]:
+            end_col = reg.end_col
+            if reg.span == 0:
+                end_col += cols_added
+            moved.append((reg, row + lines_added, reg.col + cols_added,
+                          reg.span, end_col))
+
+        # Regions that end exactly at the insert point don't grow
+        start = (row, col + 1)
+        return self.shift(start, new_end, lines_added, moved, reaching)
+
+    def collapse(self, start, end):
+        """
+        Move regions to close up the text deleted from start to end. Return
+        the watched regions that moved.
+        """
+        row, col = start
+        lines_removed = end[0] - row
+        cols_removed = end[1] - col
+
+        first = self.bisect(self.items, start)
+        inside_end = self.bisect(self.items, end)
+        after = self.bisect(self.items, (end[0] + 1,))
+        self.move_gap(after)
+
+        reaching = self.spanning_into(row)
+        reaching += self.items[self.bisect(self.items, (row,)):first]
+
+        def new_end(reg):
+            """
+            Where a region ends once the deleted text is gone
+            """
+            old_end = reg.end
+
+            if old_end >= end:
+                end_col = old_end[1]
+                if old_end[0] == end[0]:
+                    end_col -= cols_removed
+                end_row = old_end[0] - lines_removed
+            else:
+                end_row, end_col = start
+
+            return (end_row - reg.row, end_col)
+
+        moved = []
+        for reg in self.items[first:inside_end]:
+            span, end_col = new_end(reg)
+            moved.append((reg, row, col, span + reg.row - row, end_col))
+
+        for reg in self.items[inside_end:after]:
+            end_col = reg.end_col
+            if reg.span == 0:
+                end_col -= cols_removed
+            moved.append((reg, row, reg.col - cols_removed, reg.span,
+                          end_col))
+
+        return self.shift(start, new_end, -lines_removed, moved, reaching)
+
+    def spanning_into(self, line):
+        """
+        Get the spanning regions that start before the given line and reach
+        it.
+        """
+        ret = []
+        i = self.bisect(self.spanning, (line,)) - 1
+
+        while i >= 0 and self.spanning[i].start[0] >= line - self.max_span:
+            if self.spanning[i].end[0] >= line:
+                ret.append(self.spanning[i])
+            i -= 1
+
+        ret.reverse()
+        return ret
+
+    def for_line(self, line):
+        """
+        Get the regions covering any part of the given line
+        """
+        return self.in_range(line, line)
+
+    def in_columns(self, line, first, last):
+        """
+        Get the regions covering any part of the columns [first, last) of the
+        given line, in order of their start position. Regions that start on
+        the line are only looked at if they start within the widest region
+        before first, or are spanning regions.
+        """
+        low = self.bisect(self.items, (line, first - self.max_width))
+        high = self.bisect(self.items, (line, last))
+        span_low = self.bisect(self.spanning, (line,))
+        span_high = self.bisect(self.spanning, (line, first - self.max_width))
+
+        return self.spanning_into(line) + \
+            self.spanning[span_low:span_high] + \
+            [x for x in self.items[low:high]
+             if x.end > (line, first) or x.start[1] >= first]
+
+    def in_range(self, first, last):
+        """
+        Get the regions covering any part of the lines from first to last
+        inclusive, in order of their start position.
+        """
+        low = self.bisect(self.items, (first,))
+        high = self.bisect(self.items, (last + 1,))
+        return self.spanning_into(first) + self.items[low:high]
+
+class LineChanges(object):
+    """
+    Collects the lines of a buffer that have changed, as a sorted list of
+    merged [start, end) ranges. The ranges are kept in the buffer's current
+    line numbering, moving as lines are inserted and removed before them. An
+    empty range marks a place where lines were only removed. Lines whose
+    regions changed (i.e. were hilighted again) are collected too.
+
+    The first row from which lines have moved up or down since the last poll
+    is kept in moved, or None if no lines were inserted or removed.
+
+    Get one from Buffer.track_changes() and poll it with take().
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.ranges = []
+        self.moved = None
+        self.version = buf.version
+        buf.subscribe(self.changed)
+        buf.trackers.append(self)
+
+    def changed(self, buf, start, old_end, new_end):
+        """
+        Record that the lines in [start, old_end) were replaced by the lines
+        in [start, new_end).
+        """
+        shift = new_end - old_end
+        merged = [start, new_end]
+        ranges = []
+
+        if shift != 0 and (self.moved == None or start < self.moved):
+            self.moved = start
+
+        for rstart, rend in self.ranges:
+            if rend < start:
+                ranges.append((rstart, rend))
+            elif rstart > old_end:
+                if merged != None:
+                    ranges.append(tuple(merged))
+                    merged = None
+                ranges.append((rstart + shift, rend + shift))
+            else:
+                merged[0] = min(merged[0], rstart)
+                if rend > old_end:
+                    merged[1] = rend + shift
+
+        if merged != None:
+            ranges.append(tuple(merged))
+
+        self.ranges = ranges
+        self.version = buf.version
+
+    def mark(self, start, end):
+        """
+        Record that the lines in [start, end) changed without moving
+        """
+        self.changed(self.buf, start, end, end)
+
+    def take(self):
+        """
+        Get the ranges changed since the last call, and forget them along
+        with moved
+        """
+        ranges = self.ranges
+        self.ranges = []
+        self.moved = None
+        return ranges
+
+    def close(self):
+        """
+        Stop tracking changes
+        """
+        self.buf.unsubscribe(self.changed)
+        self.buf.trackers.remove(self)
+
+# Files with at least this many lines are stored in a piece table rather than
+# a plain list, unless the buffer asks for one or the other.
+PIECE_TABLE_LINES = 100000
+
+# Files of at least this many bytes are mapped and loaded lazily rather than
+# read into memory.
+LAZY_LOAD_BYTES = 64 << 20
+
+# Most bytes of the start of a file's first line looked at for a shebang or
+# modeline
+SNIFF_BYTES = 1024
+
+# Number of lines joined and encoded at a time when writing a file
+WRITE_CHUNK_LINES = 4096
+
+# Most lines whose search highlight regions are cached
+SEARCH_HIT_LINES = 1024
+
+# Lines longer than this many columns are only searched for hilighting
+# around the columns on screen
+LONG_LINE_COLS = 4096
+
+# Columns searched on either side of the ones on screen in a long line, so
+# matches crossing the edge of the screen are still found
+SEARCH_MARGIN = 256
+
+from .filetypes import plain_text, file_type_for_path
+from .fold import FoldIndex
+from .brackets import BracketIndex, BRACKET_KINDS
 class Buffer(object):
     """
     A buffer stores a filesworth of text as a list of lines. It can generate
     motion objects over that text and maintains a cursor position.
+
+    The lines are kept in a plain list, or in a PieceTable if piece_table is
+    True. If piece_table is None, the piece table is used for files with more
+    than PIECE_TABLE_LINES lines.
     """
-    def __init__(self, path=None):
-        self.lines = [""]
+    def __init__(self, path=None, piece_table=None):
+        self.piece_table = piece_table
+        self.lines = self.line_store([""])
+        self._line_index = None
         self.path = None
         self.row = 0
         self.col = 0
         self.col_want = 0
         self.dirty = False
-        self.regions = []
+        self.version = 0
+        self.listeners = []
+        self.trackers = []
+        self.regions = RegionIndex()
+        self.folds = FoldIndex(self)
+        self.brackets = BracketIndex()
         self.search_expr = None
+        self.search_index = None
+        self.search_hits = {}
+        self.journal = UndoJournal()
+        self.highlighter = None
+        self.outline = None
         self.search_backward = False
         self.file_type = plain_text
 
@@ -189,17 +799,92 @@ class Buffer(object):
 
         self.markers = {}
 
+    def subscribe(self, func):
+        """
+        Ask to be told about changes to the text of this buffer. After each
+        change, func is called with the buffer and the start, old end, and new
+        end of the replaced line range. The version is bumped before the call.
+        """
+        self.listeners.append(func)
+
+    def unsubscribe(self, func):
+        """
+        Stop calling a function passed to subscribe
+        """
+        self.listeners.remove(func)
+
+    def track_changes(self):
+        """
+        Get a LineChanges object to poll for the lines changed from here on
+        """
+        return LineChanges(self)
+
+    def lines_changed(self, start, old_end, new_end):
+        """
+        Bump the version and notify subscribers that the lines in [start,
+        old_end) have been replaced by the lines in [start, new_end).
+        """
+        self.version += 1
+
+        if old_end == new_end:
+            for line in range(start, old_end):
+                self.search_hits.pop(line, None)
+        elif len(self.search_hits):
+            self.search_hits = {k: v for k, v in self.search_hits.items()
+                                if k < start}
+
+        for func in list(self.listeners):
+            func(self, start, old_end, new_end)
+
     def add_region(self, reg):
         """
         Add a region to the buffer
         """
+        self.regions.add(reg)
+        self.regions_changed(reg.start[0], reg.end[0] + 1)
+
+    def add_regions(self, regs):
+        """
+        Add a list of regions to the buffer
+        """
+        self.regions.extend(regs)
+
+        for reg in regs:
+            self.regions_changed(reg.start[0], reg.end[0] + 1)
+
+    def regions_changed(self, start, end):
+        """
+        Tell the change trackers that the regions over the lines in [start,
+        end) changed
+        """
+        for tracker in self.trackers:
+            tracker.mark(start, end)
+
+    def hilight_lines(self, first, last):
+        """
+        Get hilighting ready for the lines in [first, last), i.e. before they
+        are drawn
+        """
+        if self.highlighter != None:
+            self.highlighter.refresh(first, last)
+
+    def set_highlighter(self, highlighter):
+        """
+        Replace the object keeping this buffer's syntax hilighting current
+        """
+        if self.highlighter != None:
+            self.highlighter.close()
+
+        self.highlighter = highlighter
 
-        for i, other in enumerate(self.regions):
-            if other.start >= reg.start:
-                self.regions.insert(i, reg)
-                return
+    def set_outline(self, outline):
+        """
+        Replace the index of definitions in this buffer
+        """
+        if self.outline != None:
+            self.outline.close()
 
-        self.regions.append(reg)
+        self.outline = outline
 
     def headline(self):
         """
@@ -215,22 +900,71 @@ class Buffer(object):
 
         return dirty_marker + os.path.relpath(self.path)
 
-    def regions_for_line(self, line):
+    def regions_for_line(self, line, first=0, last=None):
         """
-        Get the regions affecting a line
+        Get the regions affecting a line, or only the columns [first, last)
+        of it if last is given
         """
-        regions = [x for x in self.regions if x.start[0] <= line and x.end[0] >= line]
+        if self.highlighter != None:
+            self.highlighter.refresh()
+
+        if last == None:
+            regions = self.regions.for_line(line)
+        else:
+            regions = self.regions.in_columns(line, first, last)
 
         if self.search_expr == None:
             return regions
 
-        for k in self.search_expr.finditer(self.lines[line]):
-            regions.append(Region(None, 'hilight', (line, k.start()),
-                (line, k.end())))
+        return list(merge(regions, self.search_hits_for_line(line, first,
+                                                             last),
+                          key=attrgetter('start')))
+
+    def search_hits_for_line(self, line, first=0, last=None):
+        """
+        Get highlight regions for the search matches on a line. They are
+        cached until the line changes or a new search is started. If last is
+        given and the line is longer than LONG_LINE_COLS, only the columns
+        [first, last) and SEARCH_MARGIN columns either side of them are
+        searched, and nothing is cached.
+        """
+        if last != None and self.line_length(line) > LONG_LINE_COLS:
+            low = max(first - SEARCH_MARGIN, 0)
+            text = self.line_slice(line, low, last + SEARCH_MARGIN)
+            return [Region(None, 'hilight', (line, low + k.start()),
+                           (line, low + k.end()))
+                    for k in self.search_expr.finditer(text)
+                    if low + k.end() > first and low + k.start() < last]
+
+        if line in self.search_hits:
+            return self.search_hits[line]
+
+        if len(self.search_hits) >= SEARCH_HIT_LINES:
+            self.search_hits = {}
+
+        hits = [Region(None, 'hilight', (line, k.start()), (line, k.end()))
+                for k in self.search_expr.finditer(self.lines[line])]
+        self.search_hits[line] = hits
+        return hits
+
+    def line_slice(self, row, first, last):
+        """
+        Get the columns [first, last) of a line, without decoding the rest of
+        it if it is a long line in a mapped file
+        """
+        if isinstance(self.lines, PieceTable):
+            return self.lines.line_slice(row, first, last)
+
+        return self.lines[row][first:last]
 
-        regions.sort(key=attrgetter('start'))
+    def line_length(self, row):
+        """
+        Get the length of a line in columns
+        """
+        if isinstance(self.lines, PieceTable):
+            return self.lines.line_length(row)
 
-        return regions
+        return len(self.lines[row])
 
     def mark(self, char="'"):
         """
@@ -263,25 +997,31 @@ class Buffer(object):
 
         new_lines = []
 
-        mimetype = 'text/plain'
         try:
-            with open(self.path, 'r') as f:
-                for line in f.readlines():
-                    if line.endswith('\n'):
-                        line = line[:-1]
-                    new_lines += [line]
-
-                mimetype = magic.from_file(self.path, mime=True).decode("utf-8")
+            if os.path.getsize(self.path) >= LAZY_LOAD_BYTES:
+                new_lines = MappedLines(self.path)
+            else:
+                with open(self.path, 'r') as f:
+                    for line in f.readlines():
+                        if line.endswith('\n'):
+                            line = line[:-1]
+                        new_lines += [line]
         except FileNotFoundError:
             #TODO: Notify if the directory isn't there either
             pass
 
-        self.file_type = file_type_for_mime(mimetype)
-
         if len(new_lines) == 0:
-            self.lines = ['']
-        else:
-            self.lines = new_lines
+            new_lines = ['']
+
+        self.set_highlighter(None)
+        self.set_outline(None)
+
+        old_len = len(self.lines)
+        self.lines = self.line_store(new_lines)
+        self.file_type = file_type_for_path(self.path, self.first_line())
+        self._line_index = None
+        self.lines_changed(0, old_len, len(self.lines))
+        self.journal = UndoJournal()
 
         redraw = False
         if len(self.lines) <= self.row:
@@ -295,23 +1035,128 @@ class Buffer(object):
         if redraw:
             pym.redraw()
 
-        self.regions = []
+        self.regions = RegionIndex()
+        self.brackets = BracketIndex()
+        self.folds.clear()
         self.dirty = False
         self.file_type.load(self)
 
+    def first_line(self):
+        """
+        Get the start of the first line, to look for a shebang or modeline
+        in. Only SNIFF_BYTES of a mapped file are read.
+        """
+        if isinstance(self.lines, PieceTable):
+            return self.lines.line_prefix(0, SNIFF_BYTES)
+
+        return self.lines[0][:SNIFF_BYTES]
+
+    def line_store(self, lines):
+        """
+        Wrap a list of lines in the storage engine this buffer uses. Mapped
+        files always get a piece table.
+        """
+        use_table = self.piece_table
+
+        if use_table == None:
+            use_table = len(lines) >= PIECE_TABLE_LINES
+
+        if isinstance(lines, MappedLines):
+            use_table = True
+
+        if not use_table:
+            return lines
+
+        store = PieceTable(lines)
+        store.on_grow = self.lines_loaded
+        return store
+
+    def lines_loaded(self, row, count):
+        """
+        Called when a lazily loaded file has indexed more of its lines
+        """
+        self._line_index = None
+        self.lines_changed(row, row, row + count)
+
+    def replace_lines(self, start, end, new_lines):
+        """
+        Replace the lines in the range [start, end) with the given list of
+        lines. All changes to the text of the buffer go through here.
+        """
+        self.lines[start:end] = new_lines
+
+        if self._line_index != None:
+            self._line_index.splice(start, end, [len(x) for x in new_lines])
+
+        self.lines_changed(start, end, start + len(new_lines))
+
+    @property
+    def line_index(self):
+        """
+        A LineIndex over the lengths of this buffer's lines. It is built the
+        first time it is needed and kept up to date by replace_lines after
+        that.
+        """
+        if self._line_index == None:
+            self._line_index = LineIndex(len(x) for x in self.lines)
+        return self._line_index
+
+    def pos_to_offset(self, pos):
+        """
+        Convert a (row, column) position to a character offset into the text
+        of the buffer, as given by dump_text.
+        """
+        return self.line_index.offset(*pos)
+
+    def offset_to_pos(self, offset):
+        """
+        Convert a character offset into the text of the buffer to a (row,
+        column) position.
+        """
+        return self.line_index.position(offset)
+
     def dump_text(self, line_start=0, line_end=None):
         """
         Dump the text of this buffer
         """
+        return "".join(self.dump_chunks(line_start, line_end))
+
+    @property
+    def loaded(self):
+        """
+        Whether a lazily loaded file has all of its lines in the buffer yet
+        """
+        return not isinstance(self.lines, PieceTable) or self.lines.loaded
+
+    def wait_loaded(self):
+        """
+        Wait until a lazily loaded file has all of its lines in the buffer
+        """
+        if isinstance(self.lines, PieceTable):
+            self.lines.wait()
+
+    def dump_chunks(self, line_start=0, line_end=None):
+        """
+        Generate the text of this buffer a few thousand lines at a time. A
+        lazily loaded file is finished loading first, so all of it is there.
+        """
+        self.wait_loaded()
+
         if line_end == None:
-            return "\n".join(self.lines[line_start:])+"\n"
-        else:
-            return "\n".join(self.lines[line_start:line_end])+"\n"
+            line_end = len(self.lines)
 
-    def write_file(self, path=None):
+        for start in range(line_start, line_end, WRITE_CHUNK_LINES):
+            end = min(start + WRITE_CHUNK_LINES, line_end)
+            yield "\n".join(self.lines[start:end]) + "\n"
+
+    def write_file(self, path=None, fsync=False):
         """
         Write the contents of this buffer to a file. If no path is given, use
         the last known location.
+
+        The text is streamed into a temporary file beside the target, which
+        then replaces it, so a failed write leaves the old file intact. If
+        fsync is True the data is flushed to disk before the replace.
         """
         do_mime = False
 
@@ -325,15 +1170,38 @@ class Buffer(object):
             do_mime = True
             self.path = path
 
-        with open(path, "wb") as f:
-            f.write(self.dump_text().encode())
+        target = os.path.realpath(path)
+        directory, name = os.path.split(target)
+
+        try:
+            mode = stat.S_IMODE(os.stat(target).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+
+        fd, tmp_path = tempfile.mkstemp(prefix="." + name + ".",
+                                        suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self.dump_chunks():
+                    f.write(chunk.encode())
+
+                if fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
         if os.path.samefile(path, self.path):
             self.dirty = False
 
         if do_mime:
-            mimetype = magic.from_file(self.path, mime=True).decode("utf-8")
-            self.file_type = file_type_for_mime(mimetype)
+            self.file_type = file_type_for_path(self.path, self.first_line())
             self.file_type.load(self)
 
     def mode_changed(self, old_mode):
@@ -343,8 +1211,11 @@ class Buffer(object):
         so this is the buffer's opportunity to correct.
         """
         if pym.mode.insert:
+            self.journal.begin_group()
             return
 
+        self.journal.seal()
+
         if self.col < len(self.lines[self.row]) and \
                 (old_mode == None or not old_mode.insert):
             return
@@ -380,13 +1251,22 @@ class Buffer(object):
     def down_motion(self, count=1):
         """
         Get a motion that moves the cursor down by the given number of lines.
+        Closed folds count as one line.
         """
+        if len(self.folds):
+            return LineMotion(self, self.row, self.folds.move(self.row, count))
+
         return LineMotion(self, self.row, self.row + count)
 
     def up_motion(self, count=1):
         """
         Get a motion that moves the cursor up by the given number of lines.
+        Closed folds count as one line.
         """
+        if len(self.folds):
+            return LineMotion(self, self.row,
+                              self.folds.move(self.row, -count))
+
         return LineMotion(self, self.row, self.row - count)
 
     def left_motion(self, count=1):
@@ -408,24 +1288,13 @@ class Buffer(object):
         line as one column.
         """
 
-        line = self.row
-        col = self.col
+        offset = self.pos_to_offset((self.row, max(self.col, 0))) + count
+        line, col = self.offset_to_pos(offset)
 
-        while (len(self.lines[line]) - col) < count and \
-                line < (len(self.lines) - 1):
-            count -= len(self.lines)
-            count -= 1
+        if 0 < len(self.lines[line]) <= col and line < len(self.lines) - 1:
             col = 0
             line += 1
 
-        if line == len(self.lines):
-            col = len(self.lines[line]) - 1
-        elif (len(self.lines[line]) - col) == count:
-            col = 0
-            line += 1
-        else:
-            col += count
-
         return Motion(self, (self.row, self.col), (line, col))
 
     def backward_motion(self, count=1):
@@ -435,142 +1304,200 @@ class Buffer(object):
         previous line as one column.
         """
 
-        col = self.col
-        line = self.row
+        offset = self.pos_to_offset((self.row, max(self.col, 0))) - count
+        line, col = self.offset_to_pos(max(offset, 0))
 
-        while line > 0 and col < count:
-            count -= col
-            count -= 1
-            line -= 1
+        if 0 < len(self.lines[line]) <= col:
             col = len(self.lines[line]) - 1
 
-        if col < count:
-            col = 0
-        else:
-            col -= count
-
         return Motion(self, (self.row, self.col), (line, col))
 
     def expand_regions(self, start, end):
         """
         Expand regions to cover newly-inserted text
         """
-        lines_added = end[0] - start[0]
-        cols_added = end[1] - start[1]
-        update = []
+        self.update_regions(self.regions.expand(start, end))
+        self.folds.regions.expand(start, end)
+        self.brackets.expand(start, end)
 
-        for reg in self.regions:
-            old_start = reg.start
-            old_end = reg.end
+    def forward_search(self, start_pos=None):
+        """
+        Get the linearly next matching search position
+        """
+        if start_pos == None:
+            start_pos = (self.row, self.col)
 
-            newcol = reg.end[1]
-            if reg.end > start:
-                if reg.end[0] == start[0]:
-                    newcol += cols_added
-                reg.end = (reg.end[0] + lines_added, newcol)
+        if self.search_index == None:
+            return NULL_MOTION
 
-            if reg.start > start:
-                newcol = reg.start[1]
-                if reg.start[0] == start[0]:
-                    newcol += cols_added
-                reg.start = (reg.start[0] + lines_added, newcol)
+        match = self.search_index.next_match(start_pos)
 
-            if old_start != reg.start or old_end != reg.end:
-                update.append(reg)
+        if match == None:
+            return NULL_MOTION
 
-        self.update_regions(update)
+        return Motion(self, (self.row, self.col), match[0])
 
-    def forward_search(self, start_pos=None):
+    def backward_search(self, start_pos=None):
         """
         Get the linearly next matching search position
         """
         if start_pos == None:
             start_pos = (self.row, self.col)
 
-        row, col = start_pos
+        if self.search_index == None:
+            return NULL_MOTION
 
-        if self.search_expr == None:
+        match = self.search_index.prev_match(start_pos)
+
+        if match == None:
             return NULL_MOTION
 
-        match = self.search_expr.search(self.lines[row], col + 1)
+        return Motion(self, (self.row, self.col), match[0])
 
-        if match != None:
-            return Motion(self, (self.row, self.col), (row, match.start()))
+    def definition_start(self, definition):
+        """
+        Get a motion to the start of a definition from the outline, which may
+        be None
+        """
+        if definition == None:
+            return NULL_MOTION
 
-        stop_row = row
-        row = row + 1
-        if row >= len(self.lines):
-            row = 0
+        row = definition[0]
+        line = self.lines[row]
+        col = len(line) - len(line.lstrip())
+
+        return Motion(self, (self.row, self.col), (row, col))
 
-        while row != stop_row:
-            if row >= len(self.lines):
-                row = 0
+    def next_definition_motion(self, count=1):
+        """
+        Get a motion to the start of the count'th class or function definition
+        after the cursor
+        """
+        if self.outline == None:
+            return NULL_MOTION
 
-            match = self.search_expr.search(self.lines[row])
+        row = self.row
+        definition = None
 
-            if match == None:
-                row += 1
-                continue
+        for _ in range(count):
+            found = self.outline.next_definition(row)
+            if found == None:
+                break
+            definition = found
+            row = found[0]
 
-            start, end = match.span()
+        return self.definition_start(definition)
 
-            if start == end:
-                row += 1
-                continue
-            return Motion(self, (self.row, self.col), (row, start))
+    def prev_definition_motion(self, count=1):
+        """
+        Get a motion to the start of the count'th class or function definition
+        before the cursor
+        """
+        if self.outline == None:
+            return NULL_MOTION
 
-        return NULL_MOTION
+        row = self.row
+        definition = None
 
-    def backward_search(self, start_pos=None):
+        for _ in range(count):
+            found = self.outline.prev_definition(row)
+            if found == None:
+                break
+            definition = found
+            row = found[0]
+
+        return self.definition_start(definition)
+
+    def word_at(self, row, col):
         """
-        Get the linearly next matching search position
+        Get the word (run of letters, digits and underscores) at a position,
+        or None
         """
-        if start_pos == None:
-            start_pos = (self.row, self.col)
+        line = self.lines[row]
+        col = max(col, 0)
 
-        row, col = start_pos
+        for match in re.finditer(r'\w+', line):
+            if match.start() <= col < match.end():
+                return match.group()
+            if match.start() > col:
+                break
 
-        if self.search_expr == None:
+        return None
+
+    def goto_definition_motion(self):
+        """
+        Get a motion to the definition of the name under the cursor
+        """
+        if self.outline == None:
             return NULL_MOTION
 
-        match = None
+        name = self.word_at(self.row, self.col)
 
-        for m in self.search_expr.finditer(self.lines[row]):
-            if m.start() < col and m.start() != m.end():
-                match = m
-            elif m.start() >= col:
-                break
+        if name == None:
+            return NULL_MOTION
 
-        if match != None:
-            return Motion(self, (self.row, self.col), (row, match.start()))
+        return self.definition_start(self.outline.find(name, self.row))
 
-        stop_row = row
-        row = row - 1
+    def current_brackets(self):
+        """
+        Get the bracket index, once the highlighter has caught up with any
+        edits
+        """
+        if self.highlighter != None:
+            self.highlighter.refresh()
 
-        if row < 0:
-            row = len(self.lines) - 1
+        return self.brackets
 
-        while row != stop_row:
-            if row < 0:
-                row = len(self.lines) - 1
+    def bracket_motion(self):
+        """
+        Get a motion to the bracket matching the one under the cursor, or the
+        first one after the cursor on its line
+        """
+        brackets = self.current_brackets()
+        pos = brackets.next_on_line((self.row, max(self.col, 0)))
 
-            match = None
+        if pos == None:
+            return NULL_MOTION
 
-            for match in self.search_expr.finditer(self.lines[row]):
-                pass
+        match = brackets.match(pos)
 
-            if match == None:
-                row -= 1
-                continue
+        if match == None:
+            return NULL_MOTION
+
+        return InclusiveMotion(self, (self.row, self.col), match)
+
+    def enclosing_bracket_motion(self, bracket):
+        """
+        Get a motion to the given bracket of the innermost pair of its kind
+        around the cursor
+        """
+        kind = BRACKET_KINDS[bracket]
+        pair = self.current_brackets().enclosing((self.row, max(self.col, 0)),
+                                                 kind)
 
-            start, end = match.span()
+        if pair == None:
+            return NULL_MOTION
 
-            if start != end:
-                return Motion(self, (self.row, self.col), (row, start))
+        if bracket == kind:
+            return Motion(self, (self.row, self.col), pair[0])
+        return InclusiveMotion(self, (self.row, self.col), pair[1])
+
+    def block_motion(self, bracket, inner):
+        """
+        Get a motion over the innermost block around the cursor delimited by
+        the given kind of bracket. An inner block leaves out the brackets.
+        """
+        pair = self.current_brackets().enclosing((self.row, max(self.col, 0)),
+                                                 BRACKET_KINDS[bracket])
+
+        if pair == None:
+            return NULL_MOTION
 
-            row -= 1
+        start, end = pair
 
-        return NULL_MOTION
+        if inner:
+            return Motion(self, (start[0], start[1] + 1), end)
+        return Motion(self, start, (end[0], end[1] + 1))
 
     def next_search(self, pos=None):
         """
@@ -596,40 +1523,92 @@ class Buffer(object):
         """
         self.search_expr = re.compile(expr)
         self.search_backward = backward
+        self.search_hits = {}
+
+        if self.search_index != None:
+            self.search_index.close()
+        self.search_index = SearchIndex(self, self.search_expr)
 
     def collapse_regions(self, start, end):
         """
         Collapse regions that were surrounding deleted text
         """
-        update = []
-        for reg in self.regions:
-            old_start = reg.start
-            old_end = reg.end
+        self.update_regions(self.regions.collapse(start, end))
+        self.folds.regions.collapse(start, end)
+        self.brackets.collapse(start, end)
+
+    def fold_lines(self, first, last):
+        """
+        Make a closed fold of the lines from first to last inclusive
+        """
+        if last > first:
+            self.folds.add(first, last)
+
+    def fold_outline(self):
+        """
+        Make a closed fold of each top-level class and function definition in
+        the outline
+        """
+        if self.outline == None:
+            return False
+
+        row = -1
+        while True:
+            definition = self.outline.next_definition(row)
+            if definition == None:
+                break
+
+            row = definition[0]
+            if definition[2] == 0:
+                self.fold_lines(row, definition[1] - 1)
+
+        return True
+
+    def set_fold_closed(self, closed, row=None):
+        """
+        Open or close the innermost fold containing a row, which defaults to
+        the cursor's. If closed is None, toggle it. Return False if there is
+        no fold there.
+        """
+        if row == None:
+            row = self.row
+
+        folds = self.folds.folds_at(row)
+
+        if len(folds) == 0:
+            return False
+
+        # Closing closes the innermost open fold, opening opens the outermost
+        # closed one, so the cursor's line shows either way.
+        if closed == None:
+            closed = not any(x in self.folds.closed for x in folds)
+
+        if closed:
+            candidates = [x for x in folds if x not in self.folds.closed]
+            fold = candidates[-1] if len(candidates) else folds[-1]
+        else:
+            candidates = [x for x in folds if x in self.folds.closed]
+            fold = candidates[0] if len(candidates) else folds[0]
+
+        self.folds.set_closed(fold, closed)
+        self.row = self.folds.visible_row(self.row)
+        return True
 
-            if reg.start >= end:
-                newcol = reg.start[1]
-                if reg.start[0] == end[0]:
-                    newcol -= end[1]
-                    if start[0] == end[0]:
-                        newcol += start[1]
-                reg.start = (reg.start[0] - end[0] + start[0], newcol)
-            elif reg.start >= start:
-                reg.start = start
-
-            if reg.end >= end:
-                newcol = reg.end[1]
-                if reg.end[0] == end[0]:
-                    newcol -= end[1]
-                    if start[0] == end[0]:
-                        newcol += start[1]
-                reg.end = (reg.end[0] - end[0] + start[0], newcol)
-            elif reg.end >= start:
-                reg.end = start
-
-            if old_start != reg.start or old_end != reg.end:
-                update.append(reg)
-
-        self.update_regions(update)
+    def delete_fold(self, row=None):
+        """
+        Remove the innermost fold containing a row, which defaults to the
+        cursor's. Return False if there is no fold there.
+        """
+        if row == None:
+            row = self.row
+
+        folds = self.folds.folds_at(row)
+
+        if len(folds) == 0:
+            return False
+
+        self.folds.remove(folds[-1])
+        return True
 
     def update_regions(self, regions):
         """
@@ -657,19 +1636,67 @@ class Buffer(object):
             row = self.row
         if col == None:
             col = self.col
+        if col < 0:
+            col = 0
 
-        data = data.split('\n')
-        postfix = self.lines[row][col:]
-        self.lines[row] = self.lines[row][:col] + data.pop(0)
-        end_row = row
-
-        if len(data) > 0:
-            self.lines = self.lines[:row + 1] + data + self.lines[row + 1:]
-            end_row += len(data)
+        self.journal.record(True, (row, col), data, (self.row, self.col))
 
-        end_col = len(self.lines[end_row])
-        self.lines[end_row] += postfix
+        data = data.split('\n')
+        line = self.lines[row]
+        data[0] = line[:col] + data[0]
+        end_row = row + len(data) - 1
+        end_col = len(data[-1])
+        data[-1] += line[col:]
+        self.replace_lines(row, row + 1, data)
         self.dirty = True
         self.expand_regions((row, col), (end_row, end_col))
 
         return Motion(self, (row, col), (end_row, end_col))
+
+    def undo(self):
+        """
+        Undo the most recent change. Return False if there was nothing to
+        undo.
+        """
+        change = self.journal.pop_undo()
+
+        if change == None:
+            return False
+
+        self.journal.replaying = True
+        try:
+            for entry in reversed(change.entries):
+                if entry.inserted:
+                    Motion(self, entry.pos, entry.end).delete()
+                else:
+                    self.insert(entry.text, *entry.pos)
+        finally:
+            self.journal.replaying = False
+
+        self.move_to(*change.cursor)
+        self.col_want = self.col
+        return True
+
+    def redo(self):
+        """
+        Redo the most recently undone change. Return False if there was
+        nothing to redo.
+        """
+        change = self.journal.pop_redo()
+
+        if change == None:
+            return False
+
+        self.journal.replaying = True
+        try:
+            for entry in change.entries:
+                if entry.inserted:
+                    self.insert(entry.text, *entry.pos)
+                else:
+                    Motion(self, entry.pos, entry.end).delete()
+        finally:
+            self.journal.replaying = False
+
+        self.move_to(*change.entries[0].pos)
+        self.col_want = self.col
+        return True
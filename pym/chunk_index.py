@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Indexes over a buffer that are worked out a chunk of lines at a time
+"""
+
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+class ChunkIndex(object):
+    """
+    Something found in a buffer (i.e. search matches or definitions), kept
+    per chunk of lines. The buffer is split into chunks, and each chunk is
+    scanned the first time it is wanted, so edits only throw away what was
+    found in the chunks they touch. Subclasses give scan(), which is passed
+    a chunk's lines and returns what was found in them with rows relative to
+    the chunk, and split(), which divides a run of lines into chunks.
+
+    A lazily loaded buffer may grow while a chunk's lines are fetched, which
+    re-splits the chunks at the end. The generation counts the changes
+    followed, so chunk() can tell and fetch again. It may also grow while
+    split() reads lines, so changes that come in while one is being followed
+    are queued and followed after it.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.counts = []
+        self.found = []
+        self.starts = None
+        self.generation = 0
+        self.pending = []
+        self.changed(buf, 0, 0, len(buf.lines))
+        buf.subscribe(self.changed)
+
+    def close(self):
+        """
+        Stop following changes to the buffer
+        """
+        self.buf.unsubscribe(self.changed)
+
+    def chunk_starts(self):
+        """
+        Get the first row of each chunk
+        """
+        if self.starts == None:
+            self.starts = [0] + list(accumulate(self.counts))[:-1]
+        return self.starts
+
+    def chunk_for(self, row):
+        """
+        Get the index of the chunk containing a row, and the row's offset in
+        it.
+        """
+        starts = self.chunk_starts()
+        idx = max(bisect_right(starts, row) - 1, 0)
+        return idx, row - starts[idx]
+
+    def changed_chunks(self, start, old_end):
+        """
+        Get the indices of the first and last chunks a change to the lines in
+        [start, old_end) touches
+        """
+        first, _ = self.chunk_for(start)
+        last, _ = self.chunk_for(max(old_end - 1, start))
+        return first, last
+
+    def changed(self, buf, start, old_end, new_end):
+        """
+        Follow a change to the buffer, or queue it if we are already following
+        one
+        """
+        self.pending.append((start, old_end, new_end))
+
+        if len(self.pending) > 1:
+            return
+
+        while len(self.pending):
+            self.follow(buf, *self.pending[0])
+            self.pending.pop(0)
+
+    def follow(self, buf, start, old_end, new_end):
+        """
+        Follow one change to the buffer. The chunks covering the changed lines
+        are merged, split again and forgotten.
+        """
+        if len(self.counts) == 0:
+            first = last = 0
+            row = 0
+            lines = 0
+        else:
+            first, last = self.changed_chunks(start, old_end)
+            row = self.chunk_starts()[first]
+            lines = sum(self.counts[first:last + 1])
+
+        lines += new_end - old_end
+        chunks = self.split(buf.lines, row, row + lines)
+
+        self.counts[first:last + 1] = chunks
+        self.found[first:last + 1] = [None] * len(chunks)
+        self.starts = None
+        self.generation += 1
+
+    def split(self, lines, row, end):
+        """
+        Get the line counts of the chunks to divide the rows in [row, end)
+        into
+        """
+        raise NotImplementedError("ChunkIndex does not implement split()")
+
+    def scan(self, lines):
+        """
+        Find what this index holds in a chunk's lines
+        """
+        raise NotImplementedError("ChunkIndex does not implement scan()")
+
+    def absolute(self, idx, item):
+        """
+        Convert something found in a chunk to buffer coordinates
+        """
+        raise NotImplementedError("ChunkIndex does not implement absolute()")
+
+    def items(self, idx):
+        """
+        Get the sorted list of things found in a chunk. Subclasses whose
+        chunks hold more than that list pick it out here.
+        """
+        return self.chunk(idx)
+
+    def next_item(self, pos, wrap=False):
+        """
+        Get the first thing found at or after a position, converted by
+        absolute(), or None. The position is a tuple of a row and whatever
+        the found things are sorted by after their rows. If wrap is set the
+        search carries on from the start of the buffer.
+        """
+        if len(self.counts) == 0:
+            return None
+
+        idx, row = self.chunk_for(pos[0])
+        found = self.items(idx)
+        i = bisect_left(found, (row,) + tuple(pos[1:]))
+
+        if i < len(found):
+            return self.absolute(idx, found[i])
+
+        if wrap:
+            others = [(idx + x) % len(self.counts)
+                      for x in range(1, len(self.counts) + 1)]
+        else:
+            others = range(idx + 1, len(self.counts))
+
+        for other in others:
+            found = self.items(other)
+            if len(found):
+                return self.absolute(other, found[0])
+
+        return None
+
+    def prev_item(self, pos, wrap=False):
+        """
+        Get the last thing found before a position, converted by absolute(),
+        or None. See next_item.
+        """
+        if len(self.counts) == 0:
+            return None
+
+        idx, row = self.chunk_for(pos[0])
+        found = self.items(idx)
+        i = bisect_left(found, (row,) + tuple(pos[1:]))
+
+        if i > 0:
+            return self.absolute(idx, found[i - 1])
+
+        if wrap:
+            others = [(idx - x) % len(self.counts)
+                      for x in range(1, len(self.counts) + 1)]
+        else:
+            others = range(idx - 1, -1, -1)
+
+        for other in others:
+            found = self.items(other)
+            if len(found):
+                return self.absolute(other, found[-1])
+
+        return None
+
+    def chunk(self, idx):
+        """
+        Get what was found in a chunk, scanning it if need be
+        """
+        if self.found[idx] != None:
+            return self.found[idx]
+
+        generation = None
+
+        while generation != self.generation:
+            generation = self.generation
+            first = self.chunk_starts()[idx]
+            lines = self.buf.lines[first:first + self.counts[idx]]
+
+        self.found[idx] = self.scan(lines)
+        return self.found[idx]
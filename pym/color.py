@@ -51,6 +51,41 @@ def resolve_text_color(text_color):
 
     return '#x|x'
 
+def nearest_level(value, levels):
+    """
+    Get the level in a list nearest to a color component value. Ties go to
+    the level listed first.
+    """
+    nearest = levels[0]
+
+    for level in levels[1:]:
+        if abs(value - level) < abs(value - nearest):
+            nearest = level
+
+    return nearest
+
+# Component levels of the 256 color cube, in hex digits
+CUBE_256_LEVELS = [0x0, 0x6, 0x8, 0xa, 0xd, 0xf]
+
+# The nearest cube level for each hex digit a text color component can have
+QUANTIZE_256 = [nearest_level(x, CUBE_256_LEVELS) for x in range(16)]
+
+def split_text_color(text_color):
+    """
+    Split a resolved text color string into foreground and background (r, g,
+    b) tuples of component values, either of which may be None for the
+    default color. A missing background is the default.
+    """
+    colors = []
+
+    for cluster in (text_color[1:] + '|x').split('|')[:2]:
+        if cluster == 'x':
+            colors.append(None)
+        else:
+            colors.append(tuple(int(x, 16) for x in cluster))
+
+    return tuple(colors)
+
 def color_alias(name, color):
     """
     Create a color alias.
@@ -73,3 +73,15 @@ def writecmd(args):
         pym.notify("Permission denied", error=True)
     except FileNotFoundError:
         pym.notify("No Such File or Directory", error=True)
+
+@excommand("foldoutline")
+def foldoutlinecmd(args):
+    """
+    :foldoutline
+    """
+    if args != None:
+        pym.notify("Trailing characters", error=True)
+    elif not pym.buf.fold_outline():
+        pym.notify("No outline for this file type", error=True)
+    else:
+        pym.redraw()
@@ -21,9 +21,22 @@
 File type support
 """
 
-import ast
+import os
+import re
+import sys
+import json
+import zlib
+import struct
+import hashlib
+import tempfile
+import magic
+from array import array
+from functools import partial
 from pym.buf import Region
-from pygments.lexers import PythonLexer
+from pym.highlight import Highlighter
+from pym.outline import OutlineIndex
+import pygments
+from pygments.lexers import get_all_lexers, find_lexer_class
 from pygments import token
 
 class FileType(object):
@@ -40,61 +53,328 @@ MIME_DICT = {}
 
 plain_text = FileType()
 
-class PythonFileType(FileType):
+# Region tags for token types, checked in order. A token gets the tag of the
+# first type it is a subtype of.
+TOKEN_TAGS = [
+    (token.Comment, 'comment'),
+    (token.String.Escape, 'string_literal_esc'),
+    (token.String, 'string_literal'),
+    (token.Literal, 'literal'),
+    (token.Keyword, 'keyword'),
+    (token.Name.Decorator, 'function_name'),
+    (token.Name.Class, 'class_name'),
+    (token.Name.Function, 'function_name'),
+]
+
+# Where hilighting is cached between runs
+HILIGHT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'pym', 'hilight')
+
+# Most bytes the hilighting cache may take up on disk
+HILIGHT_CACHE_BYTES = 64 << 20
+
+# Buffers with fewer lines than this are quick enough to lex that they aren't
+# cached
+HILIGHT_CACHE_LINES = 2000
+
+# Start of each cache file. Bump the number when the format changes.
+HILIGHT_CACHE_MAGIC = b'PYMH2'
+
+class HilightCache(object):
     """
-    File type for python sources
+    Lexer states and hilighting regions for whole buffers, kept on disk in a
+    directory with one file per version of a file and lexer. The least recently
+    used files are removed when the directory grows past limit bytes.
+
+    A file is the magic string followed by zlib compressed data: three
+    lengths, a JSON list of the tags and state stacks used, the regions as
+    five integers each (tag index, start row and column, end row and column),
+    and one integer per line indexing its state stack, or -1 for none. The
+    integers are in native byte order, which is part of the key.
     """
+    def __init__(self, directory=HILIGHT_CACHE_DIR, limit=HILIGHT_CACHE_BYTES):
+        self.directory = directory
+        self.limit = limit
+
+    def key(self, buf, lexer_class):
+        """
+        Get the cache key for a buffer lexed with a given lexer. The key is
+        made from the path and (device, inode, mtime, size) of the buffer's
+        file, as reading the contents could take a while. It is None if the
+        buffer has no file or has changed since it was loaded or written.
+        """
+        if buf.path == None or buf.dirty:
+            return None
+
+        try:
+            info = os.stat(buf.path)
+        except OSError:
+            return None
+
+        digest = hashlib.sha1()
+        digest.update(repr((HILIGHT_CACHE_MAGIC, sys.byteorder,
+                            pygments.__version__, lexer_class.__module__,
+                            lexer_class.__name__, TOKEN_TAGS, buf.path,
+                            info.st_dev, info.st_ino, info.st_mtime_ns,
+                            info.st_size)).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Get the states and (tag, start, end) region tuples stored under a key,
+        or None
+        """
+        path = os.path.join(self.directory, key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            if not data.startswith(HILIGHT_CACHE_MAGIC):
+                return None
+
+            data = zlib.decompress(data[len(HILIGHT_CACHE_MAGIC):])
+            table_len, region_count, state_count = struct.unpack_from('<III',
+                                                                      data)
+            pos = struct.calcsize('<III')
+            tags, stacks = json.loads(data[pos:pos + table_len].decode())
+            pos += table_len
+
+            numbers = array('i')
+            numbers.frombytes(data[pos:])
+            os.utime(path)
+        except (OSError, ValueError, zlib.error, struct.error):
+            return None
+
+        if len(numbers) != region_count * 5 + state_count:
+            return None
+
+        stacks = [tuple(x) for x in stacks]
+        regions = []
+
+        for i in range(0, region_count * 5, 5):
+            regions.append((tags[numbers[i]],
+                            (numbers[i + 1], numbers[i + 2]),
+                            (numbers[i + 3], numbers[i + 4])))
+
+        states = [stacks[x] if x >= 0 else None
+                  for x in numbers[region_count * 5:]]
+        return states, regions
+
+    def save(self, key, states, regions):
+        """
+        Store states and regions under a key, then trim the cache
+        """
+        tags = {}
+        stacks = {}
+        numbers = array('i')
+
+        for reg in regions:
+            numbers.append(tags.setdefault(reg.tag, len(tags)))
+            numbers.extend(reg.start + reg.end)
+
+        for state in states:
+            if state == None:
+                numbers.append(-1)
+            else:
+                numbers.append(stacks.setdefault(state, len(stacks)))
+
+        table = json.dumps([list(tags), list(stacks)]).encode()
+        data = struct.pack('<III', len(table), len(regions), len(states))
+        data = HILIGHT_CACHE_MAGIC + zlib.compress(data + table +
+                                                   numbers.tobytes())
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.directory, key))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in its
+        limit
+        """
+        entries = []
+        total = 0
+
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+                total += info.st_size
+
+        entries.sort()
+
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+hilight_cache = HilightCache()
+
+class PygmentsFileType(FileType):
+    """
+    File type for anything a Pygments lexer can hilight. The lexer is given
+    by name, and only looked up when a file of this type is loaded.
+    """
+    def __init__(self, lexer_name):
+        self.lexer_name = lexer_name
+        self.lexer_class = None
+        self.tags = {}
+
+    def load(self, buf):
+        """
+        Set up syntax hilighting. A lazily loaded file's cached hilighting is
+        only looked for once all of its lines are in.
+        """
+        if self.lexer_class == None:
+            self.lexer_class = find_lexer_class(self.lexer_name)
+
+        highlighter = Highlighter(buf, self.lexer_class(), self.tag)
+        buf.set_highlighter(highlighter)
+
+        if buf.loaded and len(buf.lines) < HILIGHT_CACHE_LINES:
+            return
+
+        key = hilight_cache.key(buf, self.lexer_class)
+
+        if key == None:
+            return
+
+        highlighter.on_done = partial(self.save_hilighting, key)
+
+        if buf.loaded:
+            self.restore_hilighting(key, highlighter)
+            return
+
+        def lines_loaded(buf, *_):
+            """
+            Look in the cache once the buffer has finished loading
+            """
+            if buf.dirty or buf.highlighter is not highlighter:
+                buf.unsubscribe(lines_loaded)
+            elif buf.loaded:
+                buf.unsubscribe(lines_loaded)
+                self.restore_hilighting(key, highlighter)
 
+        buf.subscribe(lines_loaded)
+
+    @staticmethod
+    def restore_hilighting(key, highlighter):
+        """
+        Give a highlighter the states and regions cached under a key, if
+        there are any for its buffer
+        """
+        cached = hilight_cache.load(key)
+
+        if cached != None and len(cached[0]) == len(highlighter.buf.lines):
+            states, spans = cached
+            highlighter.restore(states, [Region(None, tag, start, end,
+                                                highlighter)
+                                         for tag, start, end in spans])
+
+    def save_hilighting(self, key, highlighter):
+        """
+        Cache a highlighter's results once it has lexed the whole buffer,
+        unless the buffer or its file changed in the meantime.
+        """
+        buf = highlighter.buf
+
+        if buf.highlighter is highlighter and buf.loaded and \
+                hilight_cache.key(buf, self.lexer_class) == key:
+            hilight_cache.save(key, highlighter.states,
+                               highlighter.regions())
+
+    def tag(self, ttype):
+        """
+        Get the region tag for a token type, or None
+        """
+        if ttype in self.tags:
+            return self.tags[ttype]
+
+        tag = None
+        for parent, parent_tag in TOKEN_TAGS:
+            if ttype in parent:
+                tag = parent_tag
+                break
+
+        self.tags[ttype] = tag
+        return tag
+
+class PythonFileType(PygmentsFileType):
+    """
+    File type for Python, which also keeps an outline of the classes and
+    functions in the buffer.
+    """
     def load(self, buf):
         """
-        Build an AST and set up syntax hilighting
-        """
-        tokens = PythonLexer().get_tokens_unprocessed(buf.dump_text())
-
-        index = 0
-        line = 0
-        col = 0
-
-        for t in tokens:
-            col += t[0] - index
-            index = t[0]
-            while col > len(buf.lines[line]):
-                col -= 1
-                col -= len(buf.lines[line])
-                line += 1
-            pos = (line, col)
-            end_line = pos[0]
-            end_col = pos[1]
-            i = 0
-
-            while i < len(t[2]):
-                if t[2][i] == '\n':
-                    end_line += 1
-                    end_col = 0
-                else:
-                    end_col += 1
-                i += 1
-
-            end = (end_line, end_col)
-
-            if t[1] in token.Comment:
-                buf.add_region(Region(None, 'comment', pos, end))
-            elif t[1] in token.String.Escape:
-                buf.add_region(Region(None, 'string_literal_esc', pos, end))
-            elif t[1] in token.String:
-                buf.add_region(Region(None, 'string_literal', pos, end))
-            elif t[1] in token.Literal:
-                buf.add_region(Region(None, 'literal', pos, end))
-            elif t[1] in token.Keyword:
-                buf.add_region(Region(None, 'keyword', pos, end))
-            elif t[1] in token.Name.Decorator:
-                buf.add_region(Region(None, 'function_name', pos, end))
-            elif t[1] in token.Name.Class:
-                buf.add_region(Region(None, 'class_name', pos, end))
-            elif t[1] in token.Name.Function:
-                buf.add_region(Region(None, 'function_name', pos, end))
-
-MIME_DICT['text/x-python'] = PythonFileType()
+        Set up syntax hilighting and the outline
+        """
+        super(PythonFileType, self).load(buf)
+        buf.set_outline(OutlineIndex(buf))
+
+# File type classes for lexers that get more than hilighting
+FILE_TYPE_CLASSES = {
+    'Python': PythonFileType,
+}
+
+# Exact file names (i.e. Makefile) and extensions mapped to file types, from
+# the lexers' file name patterns. Extensions claimed by more than one lexer are
+# left out so libmagic can settle them.
+FILENAME_DICT = {}
+EXTENSION_DICT = {}
+
+# Lexer aliases mapped to file types, for interpreters named in shebang lines
+# and languages named in modelines
+ALIAS_DICT = {}
+
+_ambiguous = set()
+
+for _name, _aliases, _filenames, _mimetypes in get_all_lexers():
+    if _name == 'Text only':
+        _file_type = plain_text
+    else:
+        _file_type = FILE_TYPE_CLASSES.get(_name, PygmentsFileType)(_name)
+
+    for _mime in _mimetypes:
+        if _mime != 'text/plain' and _mime not in MIME_DICT:
+            MIME_DICT[_mime] = _file_type
+
+    for _alias in _aliases:
+        ALIAS_DICT.setdefault(_alias, _file_type)
+
+    for _pattern in _filenames:
+        if _pattern.startswith('*.') and \
+                not any(x in _pattern[2:] for x in '*?['):
+            _ext = _pattern[1:]
+            if EXTENSION_DICT.get(_ext, _file_type) is not _file_type:
+                _ambiguous.add(_ext)
+            EXTENSION_DICT[_ext] = _file_type
+        elif not any(x in _pattern for x in '*?['):
+            FILENAME_DICT.setdefault(_pattern, _file_type)
+
+for _ext in _ambiguous:
+    del EXTENSION_DICT[_ext]
+
+# Newer versions of libmagic report Python scripts under this name
+MIME_DICT['text/x-script.python'] = MIME_DICT['text/x-python']
 
 def file_type_for_mime(mime):
     """
@@ -104,3 +384,92 @@ def file_type_for_mime(mime):
         return MIME_DICT[mime]
 
     return plain_text
+
+# Most files file_type_for_path remembers the type of
+FILE_TYPE_MEMO_SIZE = 4096
+
+# File types found by file_type_for_path, keyed by the path and (device, inode,
+# mtime, size) of the file, since renaming a file changes its type but not its
+# mtime
+file_type_memo = {}
+
+# Interpreter named by a shebang line, possibly through env
+SHEBANG_PATTERN = re.compile(r'#!\s*(?:\S*/)?(?:env\s+)?([^\s/]+)')
+
+# Language named by an Emacs or Vim modeline
+MODELINE_PATTERNS = [
+    re.compile(r'-\*-.*\bmode:\s*([\w+#-]+)', re.I),
+    re.compile(r'-\*-\s*([\w+#-]+)\s*-\*-'),
+    re.compile(r'\b(?:vim?|ex):.*\b(?:ft|filetype|syntax)=([\w+#-]+)'),
+]
+
+def file_type_for_first_line(line):
+    """
+    Get the file type named by a shebang or modeline in the first line of a
+    file, or None.
+    """
+    match = SHEBANG_PATTERN.match(line)
+    if match:
+        prog = match.group(1)
+        for name in (prog, prog.rstrip('0123456789.-')):
+            if name in ALIAS_DICT:
+                return ALIAS_DICT[name]
+
+    for pattern in MODELINE_PATTERNS:
+        match = pattern.search(line)
+        if match and match.group(1).lower() in ALIAS_DICT:
+            return ALIAS_DICT[match.group(1).lower()]
+
+    return None
+
+def file_type_for_magic(path):
+    """
+    Ask libmagic for the file type of a file. This opens and reads the file,
+    so it is the last resort.
+    """
+    mime = magic.from_file(path, mime=True)
+
+    if isinstance(mime, bytes):
+        mime = mime.decode("utf-8")
+
+    return file_type_for_mime(mime)
+
+def file_type_for_path(path, first_line=""):
+    """
+    Get the file type object for a file, given the first line of its contents.
+    The file's name is tried first, then a shebang or modeline in the first
+    line, and libmagic only if those say nothing. Results are remembered until
+    the file changes or is renamed.
+    """
+    try:
+        info = os.stat(path)
+        key = (path, info.st_dev, info.st_ino, info.st_mtime_ns,
+               info.st_size)
+    except OSError:
+        key = None
+
+    if key in file_type_memo:
+        return file_type_memo[key]
+
+    name = os.path.basename(path)
+    ext = os.path.splitext(name)[1]
+
+    file_type = FILENAME_DICT.get(name)
+
+    if file_type == None:
+        file_type = EXTENSION_DICT.get(ext, EXTENSION_DICT.get(ext.lower()))
+
+    if file_type == None:
+        file_type = file_type_for_first_line(first_line)
+
+    if key == None:
+        return file_type or plain_text
+
+    if file_type == None:
+        file_type = file_type_for_magic(path)
+
+    if len(file_type_memo) >= FILE_TYPE_MEMO_SIZE:
+        file_type_memo.clear()
+
+    file_type_memo[key] = file_type
+    return file_type
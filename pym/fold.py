@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Folding ranges of lines out of view
+"""
+
+from bisect import bisect_right
+
+from pym.buf import Region, RegionIndex
+
+class FoldIndex(object):
+    """
+    The folds in a buffer, and an index of which of its lines are visible.
+
+    A fold is a region covering whole lines. The regions are kept in a
+    RegionIndex of their own, so edits move them like any other region
+    without their tags getting into the hilighting. When a fold is closed its
+    first line stands for the whole fold and the rest of its lines are
+    hidden.
+
+    The hidden lines are indexed as sorted runs of rows, along with how many
+    lines are hidden before each run, so converting between buffer rows and
+    screen rows is a binary search. The runs are rebuilt only after the folds
+    or the buffer change, and only cost as much as there are folds.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.regions = RegionIndex()
+        self.closed = set()
+        self.starts = None
+        self.ends = None
+        self.before = None
+        self.screen_starts = None
+        self.heads = None
+        buf.subscribe(self.changed)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def changed(self, *_):
+        """
+        Forget the index of hidden lines. The folds themselves are moved when
+        the buffer moves its regions, after this is called.
+        """
+        self.starts = None
+
+    def clear(self):
+        """
+        Remove all folds
+        """
+        self.regions = RegionIndex()
+        self.closed = set()
+        self.starts = None
+
+    def add(self, first, last, closed=True):
+        """
+        Fold the lines from first to last inclusive. Return the new fold.
+        """
+        reg = Region(None, 'fold', (first, 0),
+                     (last, len(self.buf.lines[last])), self)
+        self.regions.add(reg)
+
+        if closed:
+            self.closed.add(reg)
+
+        self.starts = None
+        return reg
+
+    def remove(self, reg):
+        """
+        Remove a fold
+        """
+        self.regions.remove(reg)
+        self.closed.discard(reg)
+        self.starts = None
+
+    def folds_at(self, row):
+        """
+        Get the folds containing a row, outermost first
+        """
+        return [x for x in self.regions.for_line(row)
+                if x.start[0] <= row <= x.end[0]]
+
+    def set_closed(self, reg, closed):
+        """
+        Open or close a fold
+        """
+        if closed:
+            self.closed.add(reg)
+        else:
+            self.closed.discard(reg)
+
+        self.starts = None
+
+    def set_all(self, closed):
+        """
+        Open or close every fold
+        """
+        if closed:
+            self.closed = set(self.regions)
+        else:
+            self.closed = set()
+
+        self.starts = None
+
+    def build(self):
+        """
+        Rebuild the runs of hidden lines if they are out of date. Folds that
+        edits have shrunk to a single line no longer hide anything, and are
+        dropped.
+        """
+        if self.starts != None:
+            return
+
+        for reg in [x for x in self.regions if x.span == 0]:
+            self.remove(reg)
+
+        starts = []
+        ends = []
+        heads = {}
+
+        for reg in self.regions:
+            if reg not in self.closed:
+                continue
+
+            first = reg.start[0]
+            end = reg.end[0] + 1
+
+            if len(ends) and first < ends[-1]:
+                ends[-1] = max(ends[-1], end)
+                continue
+
+            heads[first] = reg
+            starts.append(first + 1)
+            ends.append(end)
+
+        before = [0]
+        for start, end in zip(starts, ends):
+            before.append(before[-1] + end - start)
+
+        self.ends = ends
+        self.before = before
+        self.heads = heads
+        self.screen_starts = [x - y for x, y in zip(starts, before)]
+        self.starts = starts
+
+    def hidden_lines(self):
+        """
+        Get how many lines are hidden in closed folds
+        """
+        self.build()
+        return self.before[-1]
+
+    def visible_lines(self):
+        """
+        Get how many lines are left on screen once closed folds are hidden
+        """
+        return len(self.buf.lines) - self.hidden_lines()
+
+    def head(self, row):
+        """
+        Get the closed fold shown on the given row, or None if the row is
+        shown as itself.
+        """
+        self.build()
+        return self.heads.get(row)
+
+    def visible_row(self, row):
+        """
+        Get the row that stands for the given row on screen: the row itself,
+        or the first line of the closed fold hiding it.
+        """
+        self.build()
+        i = bisect_right(self.starts, row) - 1
+
+        if i >= 0 and row < self.ends[i]:
+            return self.starts[i] - 1
+
+        return row
+
+    def screen_row(self, row):
+        """
+        Get the screen row a buffer row is shown on, counting from the top of
+        the buffer
+        """
+        self.build()
+        row = self.visible_row(row)
+        i = bisect_right(self.starts, row) - 1
+
+        if i < 0:
+            return row
+
+        return row - self.before[i + 1]
+
+    def buffer_row(self, screen_row):
+        """
+        Get the buffer row shown on a screen row, counting from the top of
+        the buffer
+        """
+        self.build()
+        i = bisect_right(self.screen_starts, screen_row) - 1
+
+        if i < 0:
+            return screen_row
+
+        return screen_row + self.before[i + 1]
+
+    def move(self, row, count):
+        """
+        Get the row count visible lines below (or above, if negative) the
+        given row
+        """
+        screen = max(self.screen_row(row) + count, 0)
+        return min(self.buffer_row(screen), len(self.buf.lines) - 1)
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Incremental syntax hilighting with Pygments lexers
+"""
+
+import threading
+from functools import partial
+from pygments import token
+from pygments.lexer import RegexLexer
+from pygments.token import _TokenType
+from pym import pym
+from pym.buf import Region
+from pym.brackets import BRACKET_KINDS, BRACKET_PATTERN
+
+# The state stack a RegexLexer starts in
+ROOT_STATE = ('root',)
+
+# How far back from an edit we look for a line that starts outside of any
+# nested lexer state to start lexing again from
+RESUME_LINES = 2000
+
+# Lines the background worker lexes between handing regions back
+HIGHLIGHT_BATCH_LINES = 500
+
+# Lines of the buffer a run of the background worker is handed at once, so
+# the main loop never has to join the whole buffer into one text
+HIGHLIGHT_CHUNK_LINES = 10000
+
+def resumable(lexer):
+    """
+    Whether we can start a lexer part way through a text with a saved state
+    stack. Only lexers using the stock RegexLexer loop can be.
+    """
+    return isinstance(lexer, RegexLexer) and \
+        type(lexer).get_tokens_unprocessed is \
+        RegexLexer.get_tokens_unprocessed
+
+def lex(lexer, text, stack=ROOT_STATE):
+    """
+    Split text into (offset, token type, value) tuples the way
+    RegexLexer.get_tokens_unprocessed does, starting from the given state
+    stack. Whenever a match ends at the start of a line, an (offset, None,
+    stack) tuple follows with the state stack at that point.
+    """
+    # pylint: disable=protected-access
+    pos = 0
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+
+    while True:
+        for rexmatch, action, new_state in statetokens:
+            match = rexmatch(text, pos)
+            if not match:
+                continue
+
+            if action != None:
+                if type(action) is _TokenType:
+                    yield pos, action, match.group()
+                else:
+                    yield from action(lexer, match)
+            pos = match.end()
+
+            if new_state == None:
+                break
+
+            if isinstance(new_state, tuple):
+                for state in new_state:
+                    if state == '#pop':
+                        if len(statestack) > 1:
+                            statestack.pop()
+                    elif state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        statestack.append(state)
+            elif isinstance(new_state, int):
+                if abs(new_state) >= len(statestack):
+                    del statestack[1:]
+                else:
+                    del statestack[new_state:]
+            else:
+                statestack.append(statestack[-1])
+
+            statetokens = tokendefs[statestack[-1]]
+            break
+        else:
+            if pos >= len(text):
+                return
+
+            if text[pos] == '\n':
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                yield pos, token.Whitespace, '\n'
+            else:
+                yield pos, token.Error, text[pos]
+            pos += 1
+
+        if pos > 0 and text[pos - 1] == '\n':
+            yield pos, None, tuple(statestack)
+
+def positions(text, row, tokens):
+    """
+    Turn the offsets in the output of lex() for a text starting at the given
+    row into buffer positions. Yields (start, end, token type, value) tuples;
+    for the state stack tuples start and end are both the start of the line.
+    """
+    line_start = 0
+    done = 0
+
+    for offset, ttype, value in tokens:
+        newlines = text.count('\n', done, offset)
+        if newlines > 0:
+            row += newlines
+            line_start = text.rfind('\n', done, offset) + 1
+        done = offset
+
+        if ttype == None:
+            yield (row, 0), (row, 0), None, value
+            continue
+
+        start = (row, offset - line_start)
+        done = offset + len(value)
+        newlines = text.count('\n', offset, done)
+
+        if newlines > 0:
+            row += newlines
+            line_start = text.rfind('\n', offset, done) + 1
+
+        yield start, (row, done - line_start), ttype, value
+
+def passed_rows(start, end):
+    """
+    Get the rows whose starts fall inside a token. These have no usable lexer
+    state. A token ending at the start of a row isn't counted, as the state
+    there is known.
+    """
+    if end[1] > 0:
+        return range(start[0] + 1, end[0] + 1)
+    return range(start[0] + 1, end[0])
+
+def bracket_regions(source, start, value):
+    """
+    Get a region for each bracket in the text of a token starting at the
+    given position
+    """
+    regions = []
+
+    for match in BRACKET_PATTERN.finditer(value):
+        idx = match.start()
+        newlines = value.count('\n', 0, idx)
+
+        if newlines > 0:
+            pos = (start[0] + newlines, idx - value.rfind('\n', 0, idx) - 1)
+        else:
+            pos = (start[0], start[1] + idx)
+
+        regions.append(Region(None, match.group(), pos, (pos[0], pos[1] + 1),
+                              source))
+
+    return regions
+
+class HighlightJob(object):
+    """
+    A run of the background hilighting worker. It lexes the buffer as it was
+    when the job started, from the given row on. The shift is how far edits
+    above the rows it has yet to hand back have since moved them.
+
+    If limit is set the job was only given a chunk of the buffer, and stops
+    at the first line from limit on where the lexer's state is known.
+    """
+    def __init__(self, row):
+        self.row = row
+        self.limit = None
+        self.shift = 0
+        self.cancelled = False
+        self.thread = None
+
+class Highlighter(object):
+    """
+    Keeps a buffer's hilighting regions up to date as it is edited. The
+    lexer's state stack is saved at the start of each line where a token
+    ends. An edit marks its first line dirty, and before regions are next
+    needed the text is lexed again from the saved state before the edit
+    until a line is reached where the state matches what was saved there.
+    The rest of the buffer would lex the same as before, so lexing stops.
+
+    Lexing starts again from a line in the lexer's base state where there is
+    one nearby, since a construct that opened before the edit (say, a string
+    left unterminated) may lex differently once the edit closes it.
+
+    The buffer is first lexed by a background thread, which hands back
+    batches of regions through the UI's main loop. It is given the buffer
+    HIGHLIGHT_CHUNK_LINES at a time, plus RESUME_LINES more so a token
+    crossing the end of a chunk is still seen whole. Lines before the row it
+    has reached (lexed) are hilighted as above. Lines after it that are on
+    screen are lexed from the base state as a guess, until the worker gets
+    to them.
+
+    Brackets in tokens other than strings and comments are kept in the
+    buffer's BracketIndex, and follow the hilighting regions as they are
+    replaced.
+
+    tag_for maps a token type to a region tag, or None for no region. If
+    on_done is set, it is called with the highlighter when the worker
+    finishes lexing the buffer. Lexers that can't be resumed (see
+    resumable()) are lexed from the top of the buffer by the worker after
+    every edit.
+    """
+    def __init__(self, buf, lexer, tag_for):
+        self.buf = buf
+        self.lexer = lexer
+        self.tag_for = tag_for
+        self.resumable = resumable(lexer)
+        self.states = [None] * len(buf.lines)
+        self.states[0] = ROOT_STATE
+        self.stacks = {}
+        self.dirty = []
+        self.lexed = 0
+        self.job = None
+        self.guessed = None
+        self.on_done = None
+        self.code_types = {}
+        buf.subscribe(self.changed)
+
+    def close(self):
+        """
+        Stop hilighting the buffer and remove our regions
+        """
+        self.cancel()
+        self.buf.unsubscribe(self.changed)
+        self.replace((0, 0), (len(self.buf.lines) + 1, 0), [], [])
+
+    def restore(self, states, regions):
+        """
+        Take the lexer states and regions for the whole buffer from
+        elsewhere (i.e. a cache) rather than lexing it
+        """
+        self.cancel()
+        self.states = states
+        self.states[0] = ROOT_STATE
+        self.lexed = len(states)
+        self.dirty = []
+        self.replace((0, 0), (len(states) + 1, 0),
+                     [x for x in regions if x.tag not in BRACKET_KINDS],
+                     [x for x in regions if x.tag in BRACKET_KINDS])
+
+    def regions(self):
+        """
+        Get our hilighting and bracket regions in the buffer
+        """
+        return [x for x in self.buf.regions if x.source is self] + \
+            [x for x in self.buf.brackets if x.source is self]
+
+    def replace(self, start, end, regions, brackets):
+        """
+        Replace our hilighting and bracket regions between two positions
+        """
+        reach = self.buf.regions.replace(start, end, self, regions)
+        self.buf.brackets.replace(start, end, self, brackets)
+        self.buf.regions_changed(start[0], max(reach + 1, end[0]))
+
+    def collect(self, start, end, ttype, value, regions, brackets):
+        """
+        Add the hilighting region and bracket regions for a token to lists
+        """
+        tag = self.tag_for(ttype)
+        if tag != None:
+            regions.append(Region(None, tag, start, end, self))
+
+        code = self.code_types.get(ttype)
+        if code == None:
+            code = not (ttype in token.String or ttype in token.Comment)
+            self.code_types[ttype] = code
+
+        if code and BRACKET_PATTERN.search(value):
+            brackets.extend(bracket_regions(self, start, value))
+
+    def cancel(self):
+        """
+        Stop the background worker, if it is running
+        """
+        if self.job != None:
+            self.job.cancelled = True
+            self.job = None
+
+    def changed(self, buf, start, old_end, new_end):
+        """
+        Follow a change to the buffer. The saved states for the changed lines
+        are forgotten and the first of them is marked dirty.
+        """
+        # pylint: disable=unused-argument
+        self.states[start:old_end] = [None] * (new_end - start)
+        self.states[0] = ROOT_STATE
+        shift = new_end - old_end
+
+        if not self.resumable:
+            self.cancel()
+            self.lexed = 0
+            return
+
+        # The worker's batches are all for rows from lexed on, so edits
+        # above that only move them.
+        if self.lexed >= old_end:
+            self.lexed += shift
+            if self.job != None:
+                self.job.shift += shift
+        else:
+            self.cancel()
+            self.lexed = min(self.lexed, start)
+            while self.lexed > 0 and self.states[self.lexed] == None:
+                self.lexed -= 1
+
+        dirty = set([start])
+
+        for row in self.dirty:
+            if row < start:
+                dirty.add(row)
+            elif row >= old_end:
+                dirty.add(row + shift)
+
+        self.dirty = sorted(dirty)
+
+    def refresh(self, first=None, last=None):
+        """
+        Lex any dirty parts of the buffer again, and make sure the worker is
+        running if there is more to lex. If a range of rows is given, guess
+        at the hilighting of any the worker hasn't reached yet.
+        """
+        self.dirty = [x for x in self.dirty if x < self.lexed]
+
+        while len(self.dirty):
+            self.relex(self.dirty[0])
+
+        if self.job == None and self.lexed < len(self.buf.lines):
+            self.start_job()
+
+        if first != None:
+            self.guess(first, last)
+
+    def lex_text(self, text, stack, lexer=None):
+        """
+        Start lexing a text with the given state stack
+        """
+        if lexer == None:
+            lexer = self.lexer
+
+        if self.resumable:
+            return lex(lexer, text, stack)
+        return lexer.get_tokens_unprocessed(text)
+
+    def relex(self, row):
+        """
+        Lex from the last saved state before the given row until the state
+        matches what was saved before, or the worker's row is reached.
+        Replace our regions on the lines that were lexed.
+        """
+        states = self.states
+        lines = self.buf.lines
+        first = row - 1
+
+        while first > 0 and states[first] == None:
+            first -= 1
+
+        for base in range(first, max(first - RESUME_LINES, 0), -1):
+            if states[base] != None and len(states[base]) == 1:
+                first = base
+                break
+
+        first = max(first, 0)
+        stack = states[first]
+        last = len(lines)
+        handoff = self.lexed
+
+        # Well past the edit the worker takes over, so the rest of the buffer
+        # is never joined here
+        if self.resumable and last > row + 2 * RESUME_LINES:
+            last = row + 2 * RESUME_LINES
+            handoff = min(handoff, row + RESUME_LINES)
+
+        text = "\n".join(lines[first:last]) + "\n"
+        tokens = positions(text, first, self.lex_text(text, stack))
+        regions = []
+        brackets = []
+        stop = last
+
+        for start, end, ttype, value in tokens:
+            if ttype == None:
+                cur_row = start[0]
+                if cur_row >= stop:
+                    break
+                if cur_row > row and cur_row <= self.lexed and \
+                        states[cur_row] == value:
+                    stop = cur_row
+                    break
+
+                states[cur_row] = self.stacks.setdefault(value, value)
+
+                if cur_row > row and cur_row >= handoff:
+                    # We've reached the worker and changed what it started
+                    # from, or lexed far enough that it should take over
+                    self.cancel()
+                    self.lexed = cur_row
+                    stop = cur_row
+                    break
+                continue
+
+            for passed in passed_rows(start, end):
+                states[passed] = None
+
+            self.collect(start, end, ttype, value, regions, brackets)
+
+        if stop > self.lexed:
+            self.cancel()
+            self.lexed = stop
+
+        self.dirty = [x for x in self.dirty if x < first or x >= stop]
+        self.replace((first, 0), (stop, 0), regions, brackets)
+
+    def start_job(self):
+        """
+        Start the background worker lexing from the row we've lexed up to
+        """
+        while self.lexed > 0 and self.states[self.lexed] == None:
+            self.lexed -= 1
+
+        job = HighlightJob(self.lexed)
+        last = len(self.buf.lines)
+
+        if self.resumable and \
+                last - job.row > HIGHLIGHT_CHUNK_LINES + RESUME_LINES:
+            job.limit = job.row + HIGHLIGHT_CHUNK_LINES
+            last = job.limit + RESUME_LINES
+
+        lines = self.buf.lines[job.row:last]
+        lexer = type(self.lexer)(**self.lexer.options)
+
+        job.thread = threading.Thread(target=self.work,
+                                      args=(job, lines, self.states[job.row],
+                                            lexer))
+        job.thread.daemon = True
+        self.job = job
+        job.thread.start()
+
+    def work(self, job, lines, stack, lexer):
+        """
+        Lex the lines for a job and post the regions back a batch at a time.
+        Run by the worker thread.
+        """
+        text = "\n".join(lines) + "\n"
+        stop = job.row + len(lines)
+        batch_start = job.row
+        regions = []
+        brackets = []
+        marks = []
+        tokens = positions(text, job.row, self.lex_text(text, stack, lexer))
+
+        for start, end, ttype, value in tokens:
+            if ttype != None:
+                self.collect(start, end, ttype, value, regions, brackets)
+                continue
+
+            marks.append((start[0], value))
+
+            if job.limit != None and start[0] >= job.limit:
+                stop = start[0]
+                break
+
+            if start[0] - batch_start < HIGHLIGHT_BATCH_LINES:
+                continue
+
+            if job.cancelled:
+                return
+
+            pym.post(partial(self.apply, job, batch_start, start[0], regions,
+                             brackets, marks))
+            batch_start = start[0]
+            regions = []
+            brackets = []
+            marks = []
+
+        if job.limit != None and (len(marks) == 0 or marks[-1][0] != stop):
+            # A token ran past the end of the chunk, so start the next one
+            # from the base state
+            marks.append((stop, ROOT_STATE))
+
+        pym.post(partial(self.apply, job, batch_start, stop, regions, brackets,
+                         marks, True))
+
+    def apply(self, job, first, end, regions, brackets, marks, last=False):
+        """
+        Take a batch of regions and brackets for the rows in [first, end) from
+        the worker. Run on the main loop. The last batch of a job starts the
+        next one if the buffer isn't all lexed yet.
+        """
+        if job.cancelled:
+            return
+
+        states = self.states
+        first += job.shift
+        end += job.shift
+        states[first + 1:end] = [None] * (end - first - 1)
+
+        for row, stack in marks:
+            if row + job.shift < len(states):
+                states[row + job.shift] = self.stacks.setdefault(stack, stack)
+
+        if job.shift != 0:
+            for reg in regions + brackets:
+                reg.anchor += job.shift
+
+        self.replace((first, 0), (end, 0), regions, brackets)
+        self.lexed = end
+
+        if last:
+            self.job = None
+
+            if end < len(self.buf.lines):
+                self.start_job()
+            elif self.on_done != None:
+                self.on_done(self)
+
+        pym.redraw()
+
+    def guess(self, first, last):
+        """
+        Lex the rows in [first, last) the worker hasn't reached yet, starting
+        from the base state. The regions found are replaced when the worker
+        gets there.
+        """
+        lines = self.buf.lines
+        first = max(first, self.lexed)
+        last = min(last, len(lines))
+
+        if first >= last or self.guessed == (self.buf.version, first, last):
+            return
+
+        self.guessed = (self.buf.version, first, last)
+        text = "\n".join(lines[first:last]) + "\n"
+        tokens = positions(text, first, self.lex_text(text, ROOT_STATE))
+        regions = []
+        brackets = []
+
+        for start, end, ttype, value in tokens:
+            if ttype != None:
+                self.collect(start, end, ttype, value, regions, brackets)
+
+        self.replace((first, 0), (last, 0), regions, brackets)
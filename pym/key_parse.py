@@ -270,7 +270,9 @@ class SequenceKeyParser(KeyParser):
 
 class ChoiceKeyParser(KeyParser):
     """
-    Select between several parses
+    Select between several parses. Every key is offered to each choice that
+    is still ready, so choices sharing a prefix (i.e. [m and [( ) are
+    followed side by side.
     """
     def __init__(self, *others):
         self.others = others
@@ -295,7 +297,7 @@ class ChoiceKeyParser(KeyParser):
         self.complete = False
 
         for o in self.others:
-            ret = ret or o.offer(key)
+            ret = o.offer(key) or ret
             self.ready = self.ready or o.ready
             self.complete = self.complete or o.complete
 
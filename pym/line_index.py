@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A balanced index of line lengths, for converting between (row, column)
+positions and absolute character offsets.
+"""
+
+from pym.weight_tree import WeightTree
+
+class LineIndex(WeightTree):
+    """
+    A B-tree over the lengths of a buffer's lines. Converting a row to a
+    character offset or back, and replacing a range of lines, are all
+    O(log n) in the number of lines.
+
+    Offsets are counted as if the lines were joined with newlines, so the
+    newline at the end of each line occupies the column after its last
+    character. Each line is weighted by its length plus its newline.
+    """
+    def __init__(self, lengths=()):
+        super(LineIndex, self).__init__(x + 1 for x in lengths)
+
+    @property
+    def chars(self):
+        """
+        Total number of characters in the index, including newlines
+        """
+        return self.root.total
+
+    def offset(self, row, col=0):
+        """
+        Get the character offset of the given position
+        """
+        return self.total(row) + col
+
+    def position(self, offset):
+        """
+        Get the (row, column) position of the given character offset. Offsets
+        past the end are clamped to the end of the last line.
+        """
+        if offset >= self.root.total:
+            if self.root.count == 0:
+                return (0, 0)
+            row = self.root.count - 1
+            return (row, self.root.total - 1 - self.offset(row))
+
+        node = self.root
+        row = 0
+
+        while node.children != None:
+            found = node.children[-1]
+            for child in node.children:
+                if offset < child.total:
+                    found = child
+                    break
+                offset -= child.total
+                row += child.count
+            node = found
+
+        for weight in node.weights:
+            if offset < weight:
+                break
+            offset -= weight
+            row += 1
+
+        return (row, offset)
+
+    def splice(self, start, end, lengths):
+        """
+        Replace the line lengths for the rows in [start, end) with the given
+        lengths.
+        """
+        super(LineIndex, self).splice(start, end, [x + 1 for x in lengths])
@@ -93,6 +93,22 @@ class Mode(object):
             for expr, func in self.key_exprs:
                 expr.reset()
 
+    def paste(self, text):
+        """
+        Handle pasted text. It is inserted all at once rather than handled a
+        key at a time, into the status line if it has focus (up to the first
+        newline) and at the cursor in the buffer otherwise.
+        """
+        self.reset()
+
+        if self.focus == 'sline':
+            sline = pym.sline
+            text = text.split('\n')[0]
+            sline.buf = sline.buf[:sline.pos] + text + sline.buf[sline.pos:]
+            sline.pos += len(text)
+        elif len(text):
+            pym.buf.insert(text).execute()
+
     def handle(self, expr):
         """
         Set up a handler for a key sequence
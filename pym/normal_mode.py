@@ -24,6 +24,7 @@ from .mode import normal, insert, excmd, search, backsearch
 from .key_parse import KeyGroup
 
 motionGroup = KeyGroup('motion')
+textObjectGroup = KeyGroup('textobject')
 
 @motionGroup.add("#?(h|j|k|l|<enter>| |<backspace>)")
 def motion(key):
@@ -70,7 +71,53 @@ def search_motion(keys):
         else:
             return pym.buf.next_search()
 
-@normal.handle('#?d(d|`motion`)')
+@motionGroup.add('#?(]|[)m')
+def definition_motion(keys):
+    """
+    Move to the next or previous class or function definition
+    """
+    count, key, _ = keys
+
+    if count == None:
+        count = 1
+
+    if key == ']':
+        return pym.buf.next_definition_motion(count)
+    else:
+        return pym.buf.prev_definition_motion(count)
+
+@motionGroup.add('%')
+def bracket_motion(_):
+    """
+    Move to the matching bracket
+    """
+    return pym.buf.bracket_motion()
+
+@motionGroup.add('[(<(>|{)|](<)>|})')
+def enclosing_bracket_motion(keys):
+    """
+    Move to the bracket of the innermost pair around the cursor
+    """
+    return pym.buf.enclosing_bracket_motion(keys[1])
+
+@textObjectGroup.add('(i|a)(<(>|<)>|b|[|]|{|}|B)')
+def block_text_object(keys):
+    """
+    Select the innermost block of the given bracket around the cursor
+    """
+    inner, bracket = keys
+    bracket = {'b': '(', 'B': '{'}.get(bracket, bracket)
+
+    return pym.buf.block_motion(bracket, inner == 'i')
+
+@motionGroup.add('gd')
+def goto_definition_motion(_):
+    """
+    Move to the definition of the name under the cursor
+    """
+    return pym.buf.goto_definition_motion()
+
+@normal.handle('#?d(d|`motion`|`textobject`)')
 def normal_delete(keys):
     """
     Key press handler for `d` in normal mode
@@ -85,6 +132,53 @@ def normal_delete(keys):
 
     mot.delete()
 
+@normal.handle('zf`motion`')
+def normal_mode_fold(keys):
+    """
+    Key press handler for `zf` in normal mode
+    """
+    start, end = keys[2].ordered_coords()
+    last = end[0]
+
+    if end[1] == 0 and last > start[0]:
+        last -= 1
+
+    pym.buf.fold_lines(max(start[0], 0), min(last, len(pym.buf.lines) - 1))
+    pym.redraw()
+
+@normal.handle('z(o|c|a)')
+def normal_mode_fold_open(keys):
+    """
+    Key press handler for `zo`, `zc` and `za` in normal mode
+    """
+    closed = {'o': False, 'c': True, 'a': None}[keys[1]]
+
+    if not pym.buf.set_fold_closed(closed):
+        pym.notify("No fold found", error=True)
+
+    pym.redraw()
+
+@normal.handle('z(R|M)')
+def normal_mode_fold_all(keys):
+    """
+    Key press handler for `zR` and `zM` in normal mode
+    """
+    pym.buf.folds.set_all(keys[1] == 'M')
+    pym.buf.row = pym.buf.folds.visible_row(pym.buf.row)
+    pym.redraw()
+
+@normal.handle('z(d|E)')
+def normal_mode_fold_delete(keys):
+    """
+    Key press handler for `zd` and `zE` in normal mode
+    """
+    if keys[1] == 'E':
+        pym.buf.folds.clear()
+    elif not pym.buf.delete_fold():
+        pym.notify("No fold found", error=True)
+
+    pym.redraw()
+
 @normal.handle('m@')
 def normal_mode_mark(keys):
     """
@@ -168,3 +262,37 @@ def normal_mode_to_insert_mode(key):
         buf.move_to(buf.row, len(buf.lines[buf.row]))
     elif key == 'a':
         buf.right_motion().execute()
+
+@normal.handle('#?u')
+def normal_mode_undo(keys):
+    """
+    Key press handler for `u` in normal mode
+    """
+    count, _ = keys
+
+    if count == None:
+        count = 1
+
+    for _ in range(count):
+        if not pym.buf.undo():
+            pym.notify("Already at oldest change")
+            break
+
+    pym.redraw()
+
+@normal.handle('#?<ctrl r>')
+def normal_mode_redo(keys):
+    """
+    Key press handler for `ctrl r` in normal mode
+    """
+    count, _ = keys
+
+    if count == None:
+        count = 1
+
+    for _ in range(count):
+        if not pym.buf.redo():
+            pym.notify("Already at newest change")
+            break
+
+    pym.redraw()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An outline of the classes and functions in Python buffers
+"""
+
+import ast
+from bisect import bisect_left, bisect_right
+from pygments import token
+from pygments.lexers import PythonLexer
+from pym.chunk_index import ChunkIndex
+from pym.highlight import positions
+
+# Number of lines parsed together as one piece of text. Pieces are stretched
+# to end at a top-level statement, so they may be longer.
+OUTLINE_CHUNK_LINES = 4096
+
+# Keywords that may start a definition, and the token types of the names
+# they define
+DEF_KEYWORDS = ('async', 'def', 'class')
+DEF_NAME_TYPES = (token.Name.Function, token.Name.Class)
+
+# Definition node types and the kind of definition they make
+DEF_KINDS = {
+    ast.ClassDef: 'class',
+    ast.FunctionDef: 'def',
+    ast.AsyncFunctionDef: 'def',
+}
+
+def top_level(lines, row):
+    """
+    Check whether a top-level statement starts at the given row, so the
+    lines before it can be parsed apart from the lines after. A line in a
+    multi-line string may fool this, in which case parsing falls back to
+    scan_definitions.
+    """
+    line = lines[row]
+
+    if len(line) == 0 or line[0] in ' \t#)]}':
+        return False
+
+    if row == 0:
+        return True
+
+    prev = lines[row - 1]
+    return not (prev.startswith('@') or prev.endswith('\\'))
+
+def parse_definitions(text):
+    """
+    Get the definitions in a piece of Python source as a sorted list of (row,
+    end_row, depth, kind, name) tuples, where rows count from 0 and end_row is
+    the row after the definition's last line. Return None if the text doesn't
+    parse.
+    """
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+
+    found = []
+    todo = [(x, 0) for x in reversed(tree.body)]
+
+    while len(todo):
+        node, depth = todo.pop()
+        kind = DEF_KINDS.get(type(node))
+
+        if kind != None:
+            found.append((node.lineno - 1, node.end_lineno, depth, kind,
+                          node.name))
+            depth += 1
+
+        todo.extend((x, depth) for x in reversed(list(ast.iter_child_nodes(
+            node))) if isinstance(x, ast.stmt))
+
+    found.sort()
+    return found
+
+def scan_definitions(lines):
+    """
+    Find the definitions in a list of lines by their def and class keywords
+    and indentation, for source that doesn't parse (i.e. while it is being
+    typed). The lines are lexed with Pygments, so keywords and lines inside
+    strings and comments are passed over. Returns the same tuples as
+    parse_definitions.
+    """
+    text = "\n".join(lines) + "\n"
+    tokens = PythonLexer().get_tokens_unprocessed(text)
+    found = []
+    open_defs = []
+    covered = -1
+    last = 0
+    row = indent = 0
+    keyword = None
+
+    for start, end, ttype, value in positions(text, 0, tokens):
+        if len(value.strip()) == 0 or ttype in token.Comment:
+            continue
+
+        if start[0] > covered:
+            # The first token on a line, so it gives the indentation
+            row, indent = start
+            keyword = None
+
+            while len(open_defs) and open_defs[-1][0] >= indent:
+                found[open_defs.pop()[1]][1] = last + 1
+
+        if ttype in token.Keyword and value in DEF_KEYWORDS and \
+                (start[0] > covered or keyword == 'async'):
+            keyword = value
+        elif keyword in ('def', 'class') and ttype in DEF_NAME_TYPES:
+            open_defs.append((indent, len(found)))
+            found.append([row, row + 1, len(open_defs) - 1, keyword, value])
+            keyword = None
+        else:
+            keyword = None
+
+        covered = end[0] if end[1] > 0 else end[0] - 1
+        last = covered
+
+    for _, idx in open_defs:
+        found[idx][1] = last + 1
+
+    return [tuple(x) for x in found]
+
+class OutlineIndex(ChunkIndex):
+    """
+    The class and function definitions in a Python buffer. The buffer is
+    split into chunks of lines that each end at a top-level statement, so
+    each can be parsed on its own. A chunk is parsed with ast the first time a
+    definition in it is wanted, or scanned line by line if it won't parse.
+    Each chunk's definitions are kept as a sorted list of (row, end_row,
+    depth, kind, name) tuples with rows relative to the chunk, along with a
+    map from names to rows.
+    """
+    def changed_chunks(self, start, old_end):
+        """
+        Get the chunks a change touches. An edit to the first line of a chunk
+        may change where the chunk before it ends, so that one is included
+        too.
+        """
+        first, offset = self.chunk_for(start)
+        last, _ = self.chunk_for(max(old_end - 1, start))
+
+        if offset == 0 and first > 0:
+            first -= 1
+
+        return first, last
+
+    def split(self, lines, row, end):
+        """
+        Divide rows into chunks of about OUTLINE_CHUNK_LINES, each ending at a
+        top-level statement
+        """
+        chunks = []
+
+        while row < end:
+            split = row + OUTLINE_CHUNK_LINES
+
+            while split < end and not top_level(lines, split):
+                split += 1
+
+            if end - split < OUTLINE_CHUNK_LINES // 2:
+                split = end
+
+            chunks.append(split - row)
+            row = split
+
+        return chunks
+
+    def scan(self, lines):
+        """
+        Get the definitions in a chunk's lines and a map from their names to
+        their rows
+        """
+        found = parse_definitions("\n".join(lines))
+
+        if found == None:
+            found = scan_definitions(lines)
+
+        names = {}
+        for item in found:
+            names.setdefault(item[4], []).append(item[0])
+
+        return found, names
+
+    def items(self, idx):
+        """
+        Get the definitions in a chunk
+        """
+        return self.chunk(idx)[0]
+
+    def absolute(self, idx, item):
+        """
+        Convert a definition in a chunk to buffer coordinates
+        """
+        first = self.chunk_starts()[idx]
+        return (first + item[0], first + item[1]) + item[2:]
+
+    def next_definition(self, row):
+        """
+        Get the first definition starting after the given row as a (row,
+        end_row, depth, kind, name) tuple, or None.
+        """
+        return self.next_item((row + 1,))
+
+    def prev_definition(self, row):
+        """
+        Get the last definition starting before the given row, or None.
+        """
+        return self.prev_item((row,))
+
+    def find(self, name, row=0):
+        """
+        Get the definition of a name nearest before the given row, or the
+        first one after it if there is none before. Chunks are parsed as they
+        are searched, so the first search may parse the whole buffer.
+        """
+        if len(self.counts) == 0:
+            return None
+
+        idx, offset = self.chunk_for(row)
+
+        for other in range(idx, -1, -1):
+            rows = self.chunk_names(other, name)
+            if other == idx:
+                rows = rows[:bisect_right(rows, offset)]
+            if len(rows):
+                return self.definition_at(other, rows[-1])
+
+        for other in range(idx, len(self.counts)):
+            rows = self.chunk_names(other, name)
+            if other == idx:
+                rows = rows[bisect_right(rows, offset):]
+            if len(rows):
+                return self.definition_at(other, rows[0])
+
+        return None
+
+    def chunk_names(self, idx, name):
+        """
+        Get the rows in a chunk where a name is defined, relative to the chunk
+        """
+        return self.chunk(idx)[1].get(name, [])
+
+    def definition_at(self, idx, row):
+        """
+        Get the definition starting at a row in a chunk, in buffer coordinates
+        """
+        found = self.chunk(idx)[0]
+        return self.absolute(idx, found[bisect_left(found, (row,))])
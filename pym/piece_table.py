@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A piece table storage engine for buffer lines, and a lazily indexed,
+memory-mapped source of original lines for it.
+"""
+
+import mmap
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+from collections import OrderedDict
+
+# Size of the chunks in which MappedLines counts newlines
+MAP_CHUNK = 1 << 20
+
+# How many chunks MappedLines keeps full newline positions for
+MAP_CACHE_CHUNKS = 64
+
+# Lines at least this many bytes long are sliced by column without decoding
+# all of them
+LONG_LINE_BYTES = 1 << 16
+
+# Columns between the byte offsets kept for a long line
+COLUMN_STEP = 4096
+
+# How many long lines MappedLines keeps column offsets for
+COLUMN_CACHE_LINES = 16
+
+class MappedLines(object):
+    """
+    A read-only, list-like view of the lines of a file through mmap. Newlines
+    are counted a chunk at a time by a background thread, which is all the
+    index holds, and lines are only located and decoded when they are asked
+    for. The positions of the newlines in recently used chunks are cached.
+
+    Until the background thread finishes, len() reports only the lines
+    indexed so far, and complete is False.
+
+    A very long line (i.e. a minified file) can be sliced by column without
+    decoding all of it. The first time one is sliced, the byte offset of
+    every COLUMN_STEP'th column is found and cached, so later slices only
+    decode the columns they want.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self.before = [0]
+        self.known = 0
+        self.complete = False
+        self.cache = OrderedDict()
+        self.columns = OrderedDict()
+
+        self.thread = None
+
+        # Index the first chunk right away so the first screen is ready
+        self.index_chunk()
+
+        if not self.complete:
+            self.thread = threading.Thread(target=self.build_index)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __len__(self):
+        return self.known
+
+    def index_chunk(self):
+        """
+        Count the newlines in the next unindexed chunk
+        """
+        start = (len(self.before) - 1) * MAP_CHUNK
+        newlines = self.map[start:start + MAP_CHUNK].count(b'\n')
+        self.before.append(self.before[-1] + newlines)
+
+        if start + MAP_CHUNK < self.size:
+            self.known = self.before[-1]
+            return
+
+        if self.size > 0 and self.map[self.size - 1:] != b'\n':
+            self.known = self.before[-1] + 1
+        else:
+            self.known = self.before[-1]
+        self.complete = True
+
+    def build_index(self):
+        """
+        Index the rest of the file. Run by the background thread.
+        """
+        while not self.complete:
+            self.index_chunk()
+
+    def wait(self):
+        """
+        Block until the whole file is indexed
+        """
+        if self.thread != None:
+            self.thread.join()
+
+    def newline(self, num):
+        """
+        Get the byte offset of the given newline in the file
+        """
+        chunk = bisect_right(self.before, num) - 1
+
+        if chunk in self.cache:
+            self.cache.move_to_end(chunk)
+            positions = self.cache[chunk]
+        else:
+            start = chunk * MAP_CHUNK
+            parts = self.map[start:start + MAP_CHUNK].split(b'\n')[:-1]
+            positions = list(accumulate(len(x) + 1 for x in parts))
+            positions = [start + x - 1 for x in positions]
+            self.cache[chunk] = positions
+
+            if len(self.cache) > MAP_CACHE_CHUNKS:
+                self.cache.popitem(last=False)
+
+        return positions[num - self.before[chunk]]
+
+    def line_bounds(self, row):
+        """
+        Get the byte offsets of the start and end of a line in the file
+        """
+        if row < 0 or row >= self.known:
+            raise IndexError("MappedLines index out of range")
+
+        if row == 0:
+            start = 0
+        else:
+            start = self.newline(row - 1) + 1
+
+        if row < self.before[-1]:
+            end = self.newline(row)
+        else:
+            end = self.size
+
+        if end > start and self.map[end - 1] == 0xd:
+            end -= 1
+
+        return start, end
+
+    def __getitem__(self, row):
+        start, end = self.line_bounds(row)
+        return self.map[start:end].decode()
+
+    def line_prefix(self, row, size):
+        """
+        Get the text of at most the first size bytes of a line. A character
+        cut off at the end is dropped.
+        """
+        start, end = self.line_bounds(row)
+        return self.map[start:min(end, start + size)].decode(errors='ignore')
+
+    def column_offsets(self, row, start, end):
+        """
+        Get the length of a long line and the byte offsets, from the start of
+        the line, of every COLUMN_STEP'th column and of the line's end. The
+        offsets are None if the line is ASCII, since then columns and bytes
+        are the same.
+        """
+        key = (row, start, end)
+
+        if key in self.columns:
+            self.columns.move_to_end(key)
+            return self.columns[key]
+
+        data = self.map[start:end]
+
+        if data.isascii():
+            found = (len(data), None)
+        else:
+            text = data.decode()
+            offsets = [0]
+            for i in range(0, len(text), COLUMN_STEP):
+                offsets.append(offsets[-1] +
+                               len(text[i:i + COLUMN_STEP].encode()))
+            found = (len(text), offsets)
+
+        self.columns[key] = found
+
+        if len(self.columns) > COLUMN_CACHE_LINES:
+            self.columns.popitem(last=False)
+
+        return found
+
+    def line_slice(self, row, first, last):
+        """
+        Get the columns [first, last) of a line
+        """
+        start, end = self.line_bounds(row)
+
+        if end - start < LONG_LINE_BYTES:
+            return self.map[start:end].decode()[first:last]
+
+        length, offsets = self.column_offsets(row, start, end)
+        first = min(max(first, 0), length)
+        last = min(max(last, first), length)
+
+        if offsets == None:
+            return self.map[start + first:start + last].decode()
+
+        low = first // COLUMN_STEP
+        high = -(-last // COLUMN_STEP)
+        text = self.map[start + offsets[low]:start + offsets[high]].decode()
+        skip = low * COLUMN_STEP
+        return text[first - skip:last - skip]
+
+    def line_length(self, row):
+        """
+        Get the length of a line in columns
+        """
+        start, end = self.line_bounds(row)
+
+        if end - start < LONG_LINE_BYTES:
+            return len(self.map[start:end].decode())
+
+        return self.column_offsets(row, start, end)[0]
+
+class PieceTable(object):
+    """
+    A list-like store of lines. The lines are described by a table of pieces,
+    each naming a run of lines in one of two sources: the original lines,
+    which are never modified, and a list of lines added by edits. Inserting
+    or deleting lines only rewrites the table, so edits cost O(pieces) rather
+    than O(lines). Each entry in the added list belongs to exactly one row,
+    so replacing a row that was already edited overwrites its entry, and
+    typing on a line doesn't grow the list.
+
+    Only the parts of the list interface the buffer needs are supported:
+    indexing, slicing, slice assignment and deletion with a step of 1, len()
+    and iteration.
+
+    The original lines may still be loading (see MappedLines). Lines that
+    appear later are added after the last original line that was known, or
+    at the end if that line has since been deleted, and on_grow is called
+    with the row they were added at and how many there were.
+    """
+    def __init__(self, original=None):
+        if original == None:
+            original = []
+
+        self.original = original
+        self.added = []
+        self.known = len(original)
+        self.length = self.known
+        self.pieces = []
+        self.starts = None
+        self.on_grow = None
+
+        if self.length > 0:
+            self.pieces.append((original, 0, self.length))
+
+    def sync(self):
+        """
+        Pick up any lines the original source has loaded since we last
+        looked.
+        """
+        known = len(self.original)
+
+        if known == self.known:
+            return
+
+        count = known - self.known
+        row = 0
+        for idx, (source, start, pcount) in enumerate(self.pieces):
+            row += pcount
+            if source is self.original and start + pcount == self.known:
+                self.pieces[idx] = (source, start, pcount + count)
+                break
+        else:
+            self.pieces.append((self.original, self.known, count))
+
+        self.known = known
+        self.length += count
+        self.starts = None
+
+        if self.on_grow != None:
+            self.on_grow(row, count)
+
+    def wait(self):
+        """
+        Wait for the original lines to finish loading, and pick them all up
+        """
+        if isinstance(self.original, MappedLines):
+            self.original.wait()
+
+        self.sync()
+
+    @property
+    def loaded(self):
+        """
+        Whether the original lines have all loaded and been picked up. This
+        doesn't sync, so it can be asked from inside on_grow.
+        """
+        if isinstance(self.original, MappedLines) and \
+                not self.original.complete:
+            return False
+
+        return self.known == len(self.original)
+
+    def __len__(self):
+        self.sync()
+        return self.length
+
+    def __iter__(self):
+        self.sync()
+        for source, start, count in self.pieces:
+            for i in range(start, start + count):
+                yield source[i]
+
+    def find(self, row):
+        """
+        Get the index of the piece containing the given row, and the offset of
+        the row within that piece.
+        """
+        self.sync()
+
+        if self.starts == None:
+            self.starts = []
+            pos = 0
+            for piece in self.pieces:
+                self.starts.append(pos)
+                pos += piece[2]
+
+        idx = bisect_right(self.starts, row) - 1
+        return idx, row - self.starts[idx]
+
+    def line_range(self, start, end):
+        """
+        Generate the lines in the range [start, end)
+        """
+        if start >= end:
+            return
+
+        idx, offset = self.find(start)
+        remaining = end - start
+
+        while remaining > 0:
+            source, pstart, count = self.pieces[idx]
+            take = min(count - offset, remaining)
+            for i in range(pstart + offset, pstart + offset + take):
+                yield source[i]
+            remaining -= take
+            offset = 0
+            idx += 1
+
+    def check_slice(self, key):
+        """
+        Turn a slice into a clamped start/stop pair
+        """
+        start, stop, step = key.indices(len(self))
+
+        if step != 1:
+            raise ValueError("PieceTable does not support extended slices")
+
+        return start, max(start, stop)
+
+    def check_index(self, key):
+        """
+        Turn a possibly negative index into an absolute row, checking bounds
+        """
+        length = len(self)
+
+        if key < 0:
+            key += length
+
+        if key < 0 or key >= length:
+            raise IndexError("PieceTable index out of range")
+
+        return key
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(self.line_range(*self.check_slice(key)))
+
+        idx, offset = self.find(self.check_index(key))
+        source, start, _ = self.pieces[idx]
+        return source[start + offset]
+
+    def line_slice(self, row, first, last):
+        """
+        Get the columns [first, last) of a line. Original lines that are
+        memory mapped are sliced without decoding the whole line.
+        """
+        idx, offset = self.find(self.check_index(row))
+        source, start, _ = self.pieces[idx]
+
+        if isinstance(source, MappedLines):
+            return source.line_slice(start + offset, first, last)
+
+        return source[start + offset][first:last]
+
+    def line_prefix(self, row, size):
+        """
+        Get the start of a line, at least size bytes of it if it is that
+        long. Only size bytes of original lines that are memory mapped are
+        read.
+        """
+        idx, offset = self.find(self.check_index(row))
+        source, start, _ = self.pieces[idx]
+
+        if isinstance(source, MappedLines):
+            return source.line_prefix(start + offset, size)
+
+        return source[start + offset][:size]
+
+    def line_length(self, row):
+        """
+        Get the length of a line in columns
+        """
+        idx, offset = self.find(self.check_index(row))
+        source, start, _ = self.pieces[idx]
+
+        if isinstance(source, MappedLines):
+            return source.line_length(start + offset)
+
+        return len(source[start + offset])
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop = self.check_slice(key)
+            value = list(value)
+
+            if stop == start + 1 and len(value) == 1:
+                self[start] = value[0]
+            else:
+                self.splice(start, stop, lines=value)
+            return
+
+        row = self.check_index(key)
+        idx, offset = self.find(row)
+        source, start, _ = self.pieces[idx]
+
+        # Repeated edits to one line (i.e. typing) overwrite the line's own
+        # entry in the added list rather than growing it.
+        if source is self.added:
+            self.added[start + offset] = value
+            return
+
+        self.splice(row, row + 1, [value])
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self.splice(*self.check_slice(key), lines=[])
+        else:
+            row = self.check_index(key)
+            self.splice(row, row + 1, [])
+
+    def split(self, row):
+        """
+        Make sure a piece starts at the given row. Return the index of that
+        piece.
+        """
+        if row >= len(self):
+            return len(self.pieces)
+
+        idx, offset = self.find(row)
+
+        if offset == 0:
+            return idx
+
+        source, start, count = self.pieces[idx]
+        self.pieces[idx:idx + 1] = [(source, start, offset),
+                                    (source, start + offset, count - offset)]
+        self.starts = None
+        return idx + 1
+
+    def splice(self, start, end, lines):
+        """
+        Replace the rows in the range [start, end) with the given lines.
+        """
+        first = self.split(start)
+        last = self.split(end)
+        new_pieces = []
+
+        if len(lines) > 0:
+            added_start = len(self.added)
+            self.added.extend(lines)
+            new_pieces.append((self.added, added_start, len(lines)))
+
+            # Lines appended right after the previous piece's lines extend
+            # that piece rather than starting a new one.
+            if first > 0:
+                source, pstart, count = self.pieces[first - 1]
+                if source is self.added and pstart + count == added_start:
+                    first -= 1
+                    new_pieces[0] = (source, pstart, count + len(lines))
+
+        self.pieces[first:last] = new_pieces
+        self.length += len(lines) - (end - start)
+        self.starts = None
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Searching buffers for regular expressions
+"""
+
+from bisect import bisect_right
+from itertools import accumulate
+from pym.chunk_index import ChunkIndex
+
+# Number of lines searched together as one piece of text
+SEARCH_CHUNK_LINES = 4096
+
+class SearchIndex(ChunkIndex):
+    """
+    The matches of a compiled expression in a buffer. The buffer is split
+    into chunks of lines, each of which is searched as one string the first
+    time a match inside it is wanted, so patterns may span lines within a
+    chunk. Each chunk's matches are kept as a sorted list of (row, col,
+    end_row, end_col) tuples with rows relative to the chunk.
+
+    Empty matches are never recorded.
+    """
+    def __init__(self, buf, expr):
+        self.expr = expr
+        super(SearchIndex, self).__init__(buf)
+
+    def split(self, lines, row, end):
+        """
+        Divide rows into chunks of SEARCH_CHUNK_LINES, with any short
+        remainder joined to the last
+        """
+        # pylint: disable=unused-argument
+        remaining = end - row
+        chunks = []
+
+        while remaining > 0:
+            count = min(remaining, SEARCH_CHUNK_LINES)
+            if remaining - count < SEARCH_CHUNK_LINES // 2:
+                count = remaining
+            chunks.append(count)
+            remaining -= count
+
+        return chunks
+
+    def scan(self, lines):
+        """
+        Search a chunk's lines as one string
+        """
+        line_starts = [0] + list(accumulate(len(x) + 1 for x in lines))
+        text = "\n".join(lines)
+        found = []
+
+        for match in self.expr.finditer(text):
+            start, end = match.span()
+            if start == end:
+                continue
+
+            row = bisect_right(line_starts, start) - 1
+            end_row = bisect_right(line_starts, end) - 1
+            found.append((row, start - line_starts[row],
+                          end_row, end - line_starts[end_row]))
+
+        return found
+
+    def absolute(self, idx, match):
+        """
+        Convert a match in a chunk to buffer coordinates
+        """
+        first = self.chunk_starts()[idx]
+        return ((first + match[0], match[1]), (first + match[2], match[3]))
+
+    def next_match(self, pos):
+        """
+        Get the (start, end) of the first match starting after the given
+        position, wrapping around the end of the buffer, or None.
+        """
+        return self.next_item((pos[0], pos[1] + 1), True)
+
+    def prev_match(self, pos):
+        """
+        Get the (start, end) of the last match starting before the given
+        position, wrapping around the start of the buffer, or None.
+        """
+        return self.prev_item(pos, True)
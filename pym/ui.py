@@ -25,6 +25,9 @@ class UI(object):
     """
     A representation of the UI to UI-agnostic portions of the code
     """
+    def __init__(self):
+        self.dirty = False
+
     def quit(self):
         """
         Exit the program
@@ -71,8 +74,32 @@ class UI(object):
 
     def redraw(self):
         """
-        Redraw the screen
+        Ask for the screen to be redrawn. Nothing is drawn until the UI's
+        event loop calls flush(), so a command that asks several times only
+        draws once.
+        """
+        self.dirty = True
+
+    def flush(self):
+        """
+        Draw the screen if a redraw was asked for since it was last drawn
+        """
+        if not self.dirty:
+            return
+
+        self.dirty = False
+        self.draw()
+
+    def draw(self):
+        """
+        Draw the screen
         """
         pass
 
+    def post(self, func):
+        """
+        Call a function from the main loop. Safe to call from any thread.
+        """
+        raise NotImplementedError("UI does not implement post()")
+
     mode = property(get_mode, set_mode, "The current editor mode")
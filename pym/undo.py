@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An operation log of buffer edits, for undo and redo
+"""
+
+from collections import deque
+
+# Most characters of edited text the journal keeps before it forgets the
+# oldest changes
+UNDO_MEMORY_CHARS = 4 << 20
+
+def text_end(pos, text):
+    """
+    Get the position just after some text inserted at the given position
+    """
+    newlines = text.count('\n')
+
+    if newlines == 0:
+        return (pos[0], pos[1] + len(text))
+
+    return (pos[0] + newlines, len(text) - text.rfind('\n') - 1)
+
+class UndoEntry(object):
+    """
+    A single edit: some text that was inserted or deleted at a position. The
+    end is the position just after the text, while it is in the buffer.
+    """
+    __slots__ = ('inserted', 'pos', 'text', 'end')
+
+    def __init__(self, inserted, pos, text):
+        self.inserted = inserted
+        self.pos = pos
+        self.text = text
+        self.end = text_end(pos, text)
+
+class UndoChange(object):
+    """
+    A list of edits that are undone and redone together, and where the cursor
+    was before the first of them.
+    """
+    __slots__ = ('entries', 'cursor', 'size')
+
+    def __init__(self, cursor):
+        self.entries = []
+        self.cursor = cursor
+        self.size = 0
+
+class UndoJournal(object):
+    """
+    The undo and redo history of a buffer. Each edit is recorded as the text
+    that was inserted or deleted and its position, so undoing or redoing costs
+    as much as the edit did.
+
+    Edits made while a group is open (i.e. during a visit to insert mode) are
+    undone as one change, and characters typed one after another are merged
+    into a single entry. Otherwise each edit is a change of its own.
+
+    When the history holds more than limit characters of text the oldest
+    changes are forgotten. Nothing is recorded while replaying is set, which
+    the buffer does while it undoes or redoes a change.
+    """
+    def __init__(self, limit=UNDO_MEMORY_CHARS):
+        self.limit = limit
+        self.undo_list = deque()
+        self.redo_list = []
+        self.size = 0
+        self.grouping = False
+        self.current = None
+        self.replaying = False
+
+    def begin_group(self):
+        """
+        Start collecting edits into a single change
+        """
+        self.current = None
+        self.grouping = True
+
+    def seal(self):
+        """
+        End the current change, so the next edit starts a new one
+        """
+        self.current = None
+        self.grouping = False
+
+    def record(self, inserted, pos, text, cursor):
+        """
+        Record that text was inserted or deleted at a position. The cursor is
+        where the cursor was before the edit.
+        """
+        if self.replaying or len(text) == 0:
+            return
+
+        for change in self.redo_list:
+            self.size -= change.size
+        self.redo_list = []
+
+        if self.current == None:
+            self.current = UndoChange(cursor)
+            self.undo_list.append(self.current)
+
+        change = self.current
+        entries = change.entries
+
+        if len(entries) and inserted and entries[-1].inserted and \
+                entries[-1].end == pos:
+            entries[-1].text += text
+            entries[-1].end = text_end(pos, text)
+        else:
+            entries.append(UndoEntry(inserted, pos, text))
+
+        change.size += len(text)
+        self.size += len(text)
+
+        if not self.grouping:
+            self.current = None
+
+        while self.size > self.limit and len(self.undo_list) > 1:
+            self.size -= self.undo_list.popleft().size
+
+    def pop_undo(self):
+        """
+        Take the most recent change off the undo list and put it on the redo
+        list. Return None if there is nothing to undo.
+        """
+        self.seal()
+
+        if len(self.undo_list) == 0:
+            return None
+
+        change = self.undo_list.pop()
+        self.redo_list.append(change)
+        return change
+
+    def pop_redo(self):
+        """
+        Take the most recently undone change off the redo list and put it back
+        on the undo list. Return None if there is nothing to redo.
+        """
+        self.seal()
+
+        if len(self.redo_list) == 0:
+            return None
+
+        change = self.redo_list.pop()
+        self.undo_list.append(change)
+        return change
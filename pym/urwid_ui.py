@@ -21,14 +21,19 @@
 A UI for PyM using Urwid
 """
 
+import os
 import urwid
 import importlib
 import signal
 import argparse
+import time
+from collections import deque, OrderedDict
+from bisect import bisect_right
+from itertools import accumulate
 
 from pym import pym_init
 from pym.ui import UI
-from pym.color import resolve_text_color
+from pym.color import resolve_text_color, split_text_color, QUANTIZE_256
 
 class UrwidUI(UI):
     """
@@ -38,6 +43,10 @@ class UrwidUI(UI):
         UI.__init__(self)
         self.loop = None
         self.bdisp = None
+        self.posted = deque()
+        self.wake_fd = None
+        self.last_frame = 0
+        self.frame_alarm = None
 
     def quit(self):
         raise urwid.ExitMainLoop()
@@ -48,10 +57,54 @@ class UrwidUI(UI):
         status_msg = message
         status_err = error
 
-    def redraw(self):
+    def flush(self):
+        """
+        Draw the screen if a redraw was asked for, but no more often than
+        once every FRAME_INTERVAL seconds. A redraw asked for sooner is put
+        off with an alarm. Run by FrameLoop in place of its own draw when it
+        goes idle, i.e. after each batch of input or posted functions.
+        """
+        if not self.dirty:
+            return
+
+        wait = self.last_frame + FRAME_INTERVAL - time.monotonic()
+
+        if wait > 0:
+            if self.frame_alarm == None:
+                self.frame_alarm = self.loop.set_alarm_in(wait,
+                                                          self.frame_due)
+            return
+
+        self.last_frame = time.monotonic()
+        UI.flush(self)
+
+    def frame_due(self, *_):
+        """
+        Flush a redraw that was put off to keep to the frame rate
+        """
+        self.frame_alarm = None
+        self.flush()
+
+    def draw(self):
         self.bdisp._invalidate()
         self.loop.draw_screen()
 
+    def post(self, func):
+        self.posted.append(func)
+
+        if self.wake_fd != None:
+            os.write(self.wake_fd, b'.')
+
+    def run_posted(self, _):
+        """
+        Call the functions posted from other threads. Run by the main loop
+        when the wake pipe is written to.
+        """
+        while len(self.posted):
+            self.posted.popleft()()
+
+        return True
+
     @property
     def buf(self):
         return buf
@@ -89,22 +142,212 @@ urwid.set_encoding("UTF-8")
 
 scrolloff = 5
 
-class BufferDisplay(urwid.Widget):
+# Least time between redraws asked for with pym.redraw(), in seconds
+FRAME_INTERVAL = 1 / 60
+
+# Most lines whose encoded text and attrs BufferDisplay keeps
+RENDER_CACHE_LINES = 2048
+
+# Terminal sequences to turn bracketed paste on and off
+BRACKETED_PASTE_ON = "\x1b[?2004h"
+BRACKETED_PASTE_OFF = "\x1b[?2004l"
+
+# Internals of urwid's raw display Screen that scrolling rows into place
+# relies on, as checked against urwid 2.1.2. Without any of them, canvases
+# are just drawn the usual way.
+SCREEN_INTERNALS = ('screen_buf', '_screen_buf_canvas', '_resized',
+                    '_rows_used', '_attrspec_to_escape')
+
+# Text for the named keys that can appear in pasted text
+PASTE_KEYS = {'enter': '\n', 'tab': '\t'}
+
+class TrackedWidget(urwid.Widget):
+    """
+    A widget that knows when what it shows has changed. Subclasses return a
+    key from damage_key() that changes whenever they would draw something
+    different, and check_damage() invalidates the widget only then, so
+    widgets whose contents a key press didn't touch keep their canvases.
+    """
+    def __init__(self):
+        urwid.Widget.__init__(self)
+        self.shown_key = None
+
+    def damage_key(self):
+        """
+        Get a value that changes whenever this widget's contents do
+        """
+        raise NotImplementedError()
+
+    def check_damage(self):
+        """
+        Invalidate this widget if its contents have changed since the last
+        check
+        """
+        key = self.damage_key()
+
+        if key != self.shown_key:
+            self.shown_key = key
+            self._invalidate()
+            pym.redraw()
+
+class FrameLoop(urwid.MainLoop):
+    """
+    A main loop that, when it goes idle, only draws the screen if a redraw
+    was asked for, by way of UrwidUI.flush. Redraws are so merged into the
+    loop's one draw and kept to the frame rate. A screen that was resized
+    is always drawn.
+    """
+    def entering_idle(self):
+        if not self.screen.started:
+            return
+
+        if self.screen_size == None:
+            pym.redraw()
+
+        pym.flush()
+
+class ScrollingScreen(urwid.raw_display.Screen):
+    """
+    A raw display screen that can move rows already on the terminal instead
+    of repainting them. When told the next canvas is the last one scrolled,
+    it finds the band of rows that moved, shifts them with a scroll region
+    and insert or delete line, and lets the usual row by row comparison
+    repaint only the rows left over.
+
+    This leans on urwid internals (see SCREEN_INTERNALS). If they are
+    missing or don't look as expected, the screen is repainted in full
+    instead.
+
+    It also turns on bracketed paste, so pasted text arrives between 'begin
+    paste' and 'end paste' keys.
+    """
+    def __init__(self):
+        urwid.raw_display.Screen.__init__(self)
+        self.scroll_hint = 0
+
+    def _start(self, *args, **kwargs):
+        ret = urwid.raw_display.Screen._start(self, *args, **kwargs)
+        self.write(BRACKETED_PASTE_ON)
+        self.flush()
+        return ret
+
+    def _stop(self):
+        self.write(BRACKETED_PASTE_OFF)
+        self.flush()
+        return urwid.raw_display.Screen._stop(self)
+
+    def scroll_rows(self, amount):
+        """
+        Say that the next canvas drawn has some of its rows scrolled up by
+        amount rows (down, if negative) from the last one
+        """
+        self.scroll_hint += amount
+
+    def can_scroll(self, maxres, r, amount):
+        """
+        Check whether rows can be scrolled into place before drawing a canvas:
+        the screen buffer must hold the last canvas drawn, at this size.
+        """
+        # pylint: disable=protected-access
+        if amount == 0 or abs(amount) >= maxres[1] or \
+                not all(hasattr(self, x) for x in SCREEN_INTERNALS):
+            return False
+
+        return isinstance(self.screen_buf, list) and \
+            len(self.screen_buf) > 0 and not self._resized and \
+            self._rows_used == None and r is not self._screen_buf_canvas
+
+    def draw_screen(self, maxres, r):
+        amount = self.scroll_hint
+        self.scroll_hint = 0
+
+        if self.can_scroll(maxres, r, amount):
+            try:
+                self.scroll_band(list(r.content()), amount)
+            except (TypeError, ValueError, IndexError):
+                self.clear()
+
+        urwid.raw_display.Screen.draw_screen(self, maxres, r)
+
+    def scroll_band(self, rows, amount):
+        """
+        Move the longest band of rows that scrolled by amount on the terminal
+        and in the screen buffer. The rows scrolled into view are forgotten, so
+        they are the only ones draw_screen paints.
+        """
+        # pylint: disable=protected-access
+        old = list(self.screen_buf)
+        best = (0, 0)
+        start = None
+
+        for y in range(len(rows) + 1):
+            src = y + amount
+            if y < len(rows) and 0 <= src < len(old) and rows[y] == old[src]:
+                if start == None:
+                    start = y
+                continue
+            if start != None and y - start > best[1] - best[0]:
+                best = (start, y)
+            start = None
+
+        first, end = best
+
+        # Not worth it unless more rows move than are painted afresh
+        if end - first <= abs(amount):
+            return
+
+        if amount > 0:
+            top, bottom = first, end + amount
+            command = "\x1b[%dM" % amount
+        else:
+            top, bottom = first + amount, end
+            command = "\x1b[%dL" % -amount
+
+        self.write(urwid.escape.HIDE_CURSOR)
+        self.write(self._attrspec_to_escape(urwid.AttrSpec('', '')))
+        self.write("\x1b[%d;%dr" % (top + 1, bottom))
+        self.write(urwid.escape.set_cursor_position(0, top))
+        self.write(command)
+        self.write("\x1b[r")
+
+        # urwid replaces the list on every draw, so it can be changed in place
+        screen_buf = self.screen_buf
+        screen_buf[first:end] = old[first + amount:end + amount]
+
+        if amount > 0:
+            screen_buf[end:bottom] = [None] * amount
+        else:
+            screen_buf[top:first] = [None] * -amount
+
+class BufferDisplay(TrackedWidget):
     "Urwid widget for displaying a buffer's contents"
     _sizing = frozenset('box')
 
     def __init__(self, buff):
-        urwid.Widget.__init__(self)
+        TrackedWidget.__init__(self)
         self.buf = buff
         self.scroll = 0
+        self.left = 0
         self.scroll_pos = "All"
+        self.line_cache = OrderedDict()
+        self.changes = buff.track_changes()
+        self.drawn = None
 
-    def get_cursor_coords(self, size):
+    def damage_key(self):
+        return (self.buf.version, self.buf.row, self.buf.col,
+                self.buf.search_expr, len(self.buf.regions),
+                len(self.buf.folds), pym.mode.focus)
+
+    def update_scroll(self, size):
         """
-        Get the coordinates of the cursor
+        Scroll so the cursor is on screen, and update the scroll position shown
+        in the status line. When the cursor goes past either side of the
+        screen, it is scrolled sideways to put the cursor in the middle.
         """
-        col = self.buf.col
-        row = self.buf.row - self.scroll
+        folds = self.buf.folds
+        cursor_row = folds.screen_row(self.buf.row)
+        lines = folds.visible_lines()
+        row = cursor_row - self.scroll
 
         global status_msg
         old_scroll = self.scroll
@@ -112,8 +355,8 @@ class BufferDisplay(urwid.Widget):
         if row > size[1] - scrolloff:
             self.scroll += row - size[1] + scrolloff
 
-        if self.scroll + size[1] > len(self.buf.lines):
-            self.scroll = len(self.buf.lines) - size[1]
+        if self.scroll + size[1] > lines:
+            self.scroll = lines - size[1]
 
         if row < scrolloff:
             self.scroll -= scrolloff - row
@@ -121,16 +364,21 @@ class BufferDisplay(urwid.Widget):
         if self.scroll < 0:
             self.scroll = 0
 
-        if self.scroll != old_scroll:
+        old_left = self.left
+        col = self.buf.col
+
+        if col < self.left or col >= self.left + size[0]:
+            self.left = max(col - size[0] // 2, 0)
+
+        if self.scroll != old_scroll or self.left != old_left:
             self._invalidate()
+            sline._invalidate()
             status_msg = None
 
-        row = self.buf.row - self.scroll
-
-        if size[1] >= len(self.buf.lines):
+        if size[1] >= lines:
             self.scroll_pos = "All"
         else:
-            max_scroll = len(self.buf.lines) - size[1]
+            max_scroll = lines - size[1]
             percent = self.scroll * 100 / max_scroll
             if percent == 0:
                 self.scroll_pos = "Top"
@@ -139,19 +387,51 @@ class BufferDisplay(urwid.Widget):
             else:
                 self.scroll_pos = "{}%".format(int(percent))
 
+    def get_cursor_coords(self, size):
+        """
+        Get the coordinates of the cursor
+        """
+        self.update_scroll(size)
+
         # We do this late so the scroll calculations still happen
         if pym.mode.focus != "buffer":
             return None
-        return (col, row)
+
+        row = self.buf.folds.screen_row(self.buf.row) - self.scroll
+        return (self.buf.col - self.left, row)
 
     def render(self, size, **_):
         """
         Render this widget
         """
-        encoded = [line_attrs(x + self.scroll, size[0]) for x in range(size[1])]
-        encoded = [x for x in encoded if x != None]
+        self.update_scroll(size)
+
+        if self.drawn != None and self.drawn[0] == size and \
+                self.drawn[2] == self.left and \
+                isinstance(pym.loop.screen, ScrollingScreen):
+            pym.loop.screen.scroll_rows(self.scroll - self.drawn[1])
+        self.drawn = (size, self.scroll, self.left)
+
+        folds = self.buf.folds
+        rows = [folds.buffer_row(x + self.scroll) for x in range(size[1])]
+        rows = [x for x in rows if x < len(self.buf.lines)]
+
+        if len(rows):
+            self.buf.hilight_lines(rows[0], rows[-1] + 1)
+
+        self.forget_changed()
+
+        encoded = []
+        for row in rows:
+            fold = folds.head(row)
+            if fold != None:
+                encoded.append(fold_attrs(row, fold, size[0]))
+            else:
+                encoded.append(self.line_attrs(row, self.left, size[0]))
         lines = [x[0] for x in encoded]
-        attrs = [x[1] for x in encoded]
+        # TextCanvas pads the attrs lists in place, so give it copies of the
+        # cached ones
+        attrs = [list(x[1]) for x in encoded]
         if len(lines) < size[1]:
             attrs += [[('nonline', 1)]] * (size[1]-len(lines))
             lines += [b"~"] * (size[1]-len(lines))
@@ -159,83 +439,157 @@ class BufferDisplay(urwid.Widget):
                                 cursor=self.get_cursor_coords(size),
                                 maxcol=size[0])
 
-def line_attrs(num, truncate):
+    def forget_changed(self):
+        """
+        Drop the cached lines whose text or regions changed, or that moved,
+        since the last render
+        """
+        moved = self.changes.moved
+        ranges = self.changes.take()
+
+        if moved == None and len(ranges) == 0:
+            return
+
+        starts = [x[0] for x in ranges]
+
+        for row in list(self.line_cache):
+            i = bisect_right(starts, row) - 1
+            if (moved != None and row >= moved) or \
+                    (i >= 0 and row < ranges[i][1]):
+                del self.line_cache[row]
+
+    def line_attrs(self, num, left, width):
+        """
+        Get the encoded text and attrs for the columns of a line that fit on
+        the screen. They are cached by row until the line's text or regions
+        change or it moves, which forget_changed finds out from the buffer,
+        so a line that didn't change is neither fetched nor looked up in the
+        regions again.
+        """
+        key = (left, width, self.buf.search_expr)
+        cache = self.line_cache
+        entry = cache.get(num)
+
+        if entry != None and entry[0] == key:
+            cache.move_to_end(num)
+            return entry[1]
+
+        result = encode_line(*line_spans(num, left, width))
+        cache[num] = (key, result)
+        cache.move_to_end(num)
+
+        if len(cache) > RENDER_CACHE_LINES:
+            cache.popitem(last=False)
+
+        return result
+
+def fold_attrs(num, fold, width):
     """
-    Given a line number, truncate it to fit the screen, encode it, and return
-    the tuple of its encoded text and its attrs
+    Get the encoded text and attrs for the line standing for a closed fold
+    that starts on the given line
     """
+    count = fold.end[0] - num + 1
+    text = pym.buf.line_slice(num, 0, width).strip()
+    text = "+--{:>4} lines: {} ".format(count, text)
+    text = (text + "-" * width)[:width]
+    encoded = text.encode()
 
-    if num >= len(pym.buf.lines):
-        return None
+    return (encoded, [('fold', len(encoded))])
 
-    line = pym.buf.lines[num][:truncate]
-    regions = pym.buf.regions_for_line(num)
+def line_spans(num, left, width):
+    """
+    Given a line number, get the width columns of the line starting at column
+    left, and a tuple of (start, end, tag) spans for the regions over them.
+    Only those columns of the line are fetched, and only the regions over
+    them are looked at, so drawing part of a very long line costs no more
+    than drawing a short one.
+    """
+    line = pym.buf.line_slice(num, left, left + width)
+    spans = []
 
-    attr_endpoints = []
-    for reg in regions:
+    for reg in pym.buf.regions_for_line(num, left, left + width):
         if reg.start[0] < num:
             start = 0
         else:
-            start = reg.start[1]
+            start = max(reg.start[1] - left, 0)
 
         if reg.end[0] > num:
             end = len(line)
         else:
-            end = reg.end[1]
+            end = min(reg.end[1] - left, len(line))
 
-        if len(attr_endpoints):
-            next_end = attr_endpoints[-1][1]
-        else:
-            next_end = None
+        if end < start:
+            continue
 
-        if next_end == None or next_end <= start:
-            attr_endpoints.append([start, end, start, end, reg.tag])
-        else:
-            attr_endpoints[-1][1] = start
-            attr_endpoints[-1][3] = start
-            prev_tag = attr_endpoints[-1][4]
-            attr_endpoints.append([start, end, start, end, reg.tag])
-            if next_end > end:
-                attr_endpoints.append([end, next_end, end, next_end, prev_tag])
-
-    offset = 0
-    encoded_line = "".encode()
-    attr_ep_pos = 0
-    for pos, char in enumerate(line):
-        encoded_char = char.encode()
-        encoded_line += encoded_char
-        offset += len(encoded_char) - 1
-
-        if attr_ep_pos >= len(attr_endpoints):
+        spans.append((start, end, reg.tag))
+
+    return line, tuple(spans)
+
+def encode_line(line, spans):
+    """
+    Encode a line and turn the spans of its regions into attrs. Returns the
+    tuple of the encoded text and its attrs.
+
+    A span that starts inside the one before it cuts that one short, and
+    whatever of the earlier span is left past its end follows it. Column
+    positions are turned into byte positions with a table built in one pass
+    over the line, or used as they are if the line is ASCII.
+    """
+    endpoints = []
+    for start, end, tag in spans:
+        if len(endpoints) == 0 or endpoints[-1][1] <= start:
+            endpoints.append((start, end, tag))
             continue
 
-        for ep in attr_endpoints:
-            if ep[0] > pos:
-                ep[2] = ep[0] + offset
-            if ep[1] > pos:
-                ep[3] = ep[1] + offset
+        prev_start, prev_end, prev_tag = endpoints[-1]
+        endpoints[-1] = (prev_start, start, prev_tag)
+        endpoints.append((start, end, tag))
 
-    for ep in attr_endpoints:
-        ep.pop(0)
-        ep.pop(0)
+        if prev_end > end:
+            endpoints.append((end, prev_end, prev_tag))
 
-    pos = 0
+    encoded_line = line.encode()
+    extra = len(encoded_line) - len(line)
+
+    if extra > 0:
+        offsets = list(accumulate((len(x.encode()) for x in line), initial=0))
+        last = len(line)
+
+        def to_byte(col):
+            """
+            Get the byte position of a column
+            """
+            if col > last:
+                return col + extra
+            return offsets[col]
+    else:
+        def to_byte(col):
+            """
+            Get the byte position of a column
+            """
+            return col
 
+    pos = 0
     attrs = []
-    for ep in attr_endpoints:
-        if ep[0] > pos:
-            attrs.append((None, ep[0] - pos))
-        pos = ep[1]
-        if ep[1] != ep[0]:
-            attr_name = urwid_text_color(ep[2])
-            attrs.append((attr_name, ep[1] - ep[0]))
+    for start, end, tag in endpoints:
+        start = to_byte(start)
+        end = to_byte(end)
+
+        if start > pos:
+            attrs.append((None, start - pos))
+        pos = end
+        if end != start:
+            attrs.append((urwid_text_color(tag), end - start))
 
     return (encoded_line, attrs)
 
-class Tabset(urwid.Widget):
+class Tabset(TrackedWidget):
     "Urwid widget for the tab bar at the top of the screen"
     _sizing = frozenset('flow')
 
+    def damage_key(self):
+        return buf.headline()
+
     def rows(self, dummy1, dummy2):
         """
         Number of rows taken up by the tabset
@@ -252,14 +606,19 @@ class Tabset(urwid.Widget):
                                 [[('tab', sz), ('tabspace', size[0]-sz)]],
                                 maxcol=size[0])
 
-class StatusLine(urwid.Widget):
+class StatusLine(TrackedWidget):
     "Urwid widget for the status line"
     _sizing = frozenset('flow')
 
     def __init__(self):
-        urwid.Widget.__init__(self)
+        TrackedWidget.__init__(self)
         self.buf = StatusLineBuf()
 
+    def damage_key(self):
+        if pym.mode.focus == 'sline':
+            return ('sline', self.buf.buf, self.buf.pos)
+        return (status_msg, status_err, pym.mode.label, bdisp.scroll_pos)
+
     def rows(self, dummy1, dummy2):
         """
         Number of rows used by the status line
@@ -318,17 +677,66 @@ palette = [('tab', 'black,underline', 'light gray'),
            ('tabspace', 'black', 'light gray', '', 'h8', 'g74'),
            ('modelabel', 'white,bold', ''),
            ('errlabel', 'white,bold', 'dark red'),
-           ('nonline', 'dark blue', '')]
+           ('nonline', 'dark blue', ''),
+           ('fold', 'dark cyan', '')]
+
+class PasteBuffer(object):
+    """
+    The keys of a bracketed paste, gathered between its begin and end so the
+    paste can be handled as one piece of text
+    """
+    def __init__(self):
+        self.collecting = False
+        self.keys = []
+
+    def begin(self):
+        """
+        Start gathering the keys of a paste
+        """
+        self.collecting = True
+        self.keys = []
+
+    def add(self, key):
+        """
+        Add a key to the paste, as the character it stands for
+        """
+        self.keys.append(PASTE_KEYS.get(key, key))
+
+    def end(self):
+        """
+        Stop gathering keys, and get the pasted text. Keys that don't stand
+        for a character are dropped.
+        """
+        self.collecting = False
+        text = "".join(x for x in self.keys if len(x) == 1)
+        self.keys = []
+        return text
+
+paste = PasteBuffer()
 
 def do_input(key):
     "Input line handling"
-    pym.mode.handle_key(key)
-    bdisp._invalidate()
-    sline._invalidate()
-    tabset._invalidate()
+    if key == 'begin paste':
+        paste.begin()
+        return
+
+    if paste.collecting:
+        if key != 'end paste':
+            paste.add(key)
+            return
+
+        pym.mode.paste(paste.end())
+    else:
+        pym.mode.handle_key(key)
 
-pym.loop = urwid.MainLoop(layout, palette, unhandled_input=do_input)
+    bdisp.check_damage()
+    sline.check_damage()
+    tabset.check_damage()
+
+pym.loop = FrameLoop(layout, palette, screen=ScrollingScreen(),
+                     unhandled_input=do_input)
 pym.bdisp = bdisp
+pym.wake_fd = pym.loop.watch_pipe(pym.run_posted)
 
 C16_MAP = {
     (0x0, 0x0, 0x0): "black",
@@ -360,27 +768,10 @@ C16B_MAP = {
     (0xd, 0xd, 0xd): "light gray",
 }
 
-def nearest_88(color):
-    "Convert a color value to 88-color"
-
-    nearest = 0x0
-
-    for i in [0x8, 0xc, 0xf]:
-        if abs(color - i) < abs(color - nearest):
-            nearest = i
-
-    return nearest
-
 def nearest_256(color):
     "Convert a color value to 256-color"
 
-    nearest = 0x0
-
-    for i in [0x6, 0x8, 0xa, 0xd, 0xf]:
-        if abs(color - i) < abs(color - nearest):
-            nearest = i
-
-    return nearest
+    return QUANTIZE_256[color]
 
 def nearest_list(r, g, b, items):
     "Nearest RGB value in a list"
@@ -417,75 +808,43 @@ def hex_color(r, g, b):
 
 NEW_ENTRIES = 0
 
+# Palette entry registered for each resolved PyM color, so each color is only
+# converted and registered once
+PALETTE_ENTRIES = {'#x|x': None}
+
+def urwid_colors(rgb, table):
+    """
+    Get the 16 color name from the given table and the 256 color spec for an
+    (r, g, b) tuple, or the default color for None
+    """
+    if rgb == None:
+        return 'default', 'default'
+
+    r, g, b = rgb
+    color_256 = hex_color(nearest_256(r), nearest_256(g), nearest_256(b))
+
+    return nearest_list(r, g, b, table), color_256
+
 def urwid_text_color(pym_color):
     "Get an urwid palette entry for a PyM color"
 
     global NEW_ENTRIES
-    foreground = 'default'
-    background = 'default'
-    foreground_88 = 'default'
-    background_88 = 'default'
-    foreground_256 = 'default'
-    background_256 = 'default'
 
     pym_color = resolve_text_color(pym_color)
 
-    if pym_color == "#x|x":
-        return None
+    if pym_color in PALETTE_ENTRIES:
+        return PALETTE_ENTRIES[pym_color]
 
-    pym_color = pym_color[1:]
-
-    fg_start = None
-    bg_start = None
-
-    if pym_color[0] != 'x':
-        r = int(pym_color[0], 16)
-        g = int(pym_color[1], 16)
-        b = int(pym_color[2], 16)
-
-        fg_start = (r, g, b)
-        pym_color = pym_color[4:]
-    else:
-        pym_color = pym_color[2:]
-
-    if len(pym_color) and pym_color[0] != 'x':
-        r = int(pym_color[0], 16)
-        g = int(pym_color[1], 16)
-        b = int(pym_color[2], 16)
-
-        bg_start = (r, g, b)
-
-    if fg_start != None:
-        r, g, b = fg_start
-        r88 = nearest_88(r)
-        g88 = nearest_88(g)
-        b88 = nearest_88(b)
-        r256 = nearest_256(r)
-        g256 = nearest_256(g)
-        b256 = nearest_256(b)
-
-        foreground_88 = hex_color(r88, g88, b88)
-        foreground_256 = hex_color(r256, g256, b256)
-        foreground = nearest_list(r, g, b, C16_MAP)
-
-    if bg_start != None:
-        r, g, b = bg_start
-        r88 = nearest_88(r)
-        g88 = nearest_88(g)
-        b88 = nearest_88(b)
-        r256 = nearest_256(r)
-        g256 = nearest_256(g)
-        b256 = nearest_256(b)
-
-        background_88 = hex_color(r88, g88, b88)
-        background_256 = hex_color(r256, g256, b256)
-        background = nearest_list(r, g, b, C16B_MAP)
+    fg_start, bg_start = split_text_color(pym_color)
+    foreground, foreground_256 = urwid_colors(fg_start, C16_MAP)
+    background, background_256 = urwid_colors(bg_start, C16B_MAP)
 
     entry_name = 'p' + str(NEW_ENTRIES)
     NEW_ENTRIES += 1
 
     pym.loop.screen.register_palette_entry(entry_name, foreground, background,
         None, foreground_256, background_256)
+    PALETTE_ENTRIES[pym_color] = entry_name
     return entry_name
 
 def run():
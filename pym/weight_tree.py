@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A balanced tree over a list of weights, keeping their running totals
+"""
+
+# Most children (or weights, for a leaf) a node may hold
+NODE_SIZE = 64
+
+class WeightNode(object):
+    """
+    A node in a WeightTree. Leaves hold a list of weights, branches a list of
+    child nodes. Either way the node knows how many weights lie beneath it
+    and their total. Subclasses may keep more about the weights beneath them
+    by extending recount().
+    """
+    __slots__ = ('children', 'weights', 'count', 'total')
+
+    def __init__(self, children=None, weights=None):
+        self.children = children
+        self.weights = weights
+        self.recount()
+
+    def recount(self):
+        """
+        Recompute the count and total for this node
+        """
+        if self.children == None:
+            self.count = len(self.weights)
+            self.total = sum(self.weights)
+        else:
+            self.count = sum(x.count for x in self.children)
+            self.total = sum(x.total for x in self.children)
+
+    def split(self):
+        """
+        Split this node into a list of nodes that are no larger than
+        NODE_SIZE.
+        """
+        if self.children == None:
+            items = self.weights
+        else:
+            items = self.children
+
+        if len(items) <= NODE_SIZE:
+            return [self]
+
+        # Split into evenly sized nodes so a big insert doesn't leave a runt
+        count = (len(items) + NODE_SIZE - 1) // NODE_SIZE
+        step = (len(items) + count - 1) // count
+        chunks = [items[i:i + step] for i in range(0, len(items), step)]
+
+        if self.children == None:
+            return [type(self)(weights=x) for x in chunks]
+        return [type(self)(children=x) for x in chunks]
+
+    def insert(self, idx, weights):
+        """
+        Insert weights before the given index. Return the list of nodes that
+        should replace this one.
+        """
+        if self.children == None:
+            self.weights[idx:idx] = weights
+            self.recount()
+            return self.split()
+
+        pos = 0
+        for i, child in enumerate(self.children):
+            if idx <= pos + child.count or i == len(self.children) - 1:
+                self.children[i:i + 1] = child.insert(idx - pos, weights)
+                break
+            pos += child.count
+
+        self.recount()
+        return self.split()
+
+    def delete(self, start, end):
+        """
+        Delete the weights in [start, end)
+        """
+        if self.children == None:
+            del self.weights[start:end]
+            self.recount()
+            return
+
+        pos = 0
+        kept = []
+        for child in self.children:
+            child_start = pos
+            pos += child.count
+
+            if pos <= start or child_start >= end:
+                kept.append(child)
+            elif start <= child_start and pos <= end:
+                continue
+            else:
+                child.delete(max(start, child_start) - child_start,
+                             min(end, pos) - child_start)
+                if child.count > 0:
+                    kept.append(child)
+
+        self.children = kept
+        self.recount()
+
+class WeightTree(object):
+    """
+    A B-tree over a list of weights. Finding the total of the weights before
+    an index, and splicing the list, are O(log n). Subclasses search the
+    tree in their own ways, and may give a node_class that keeps more in
+    each node.
+    """
+    node_class = WeightNode
+
+    def __init__(self, weights=()):
+        nodes = self.node_class(weights=list(weights)).split()
+
+        while len(nodes) > 1:
+            nodes = self.node_class(children=nodes).split()
+
+        self.root = nodes[0]
+
+    def __len__(self):
+        return self.root.count
+
+    def total(self, idx):
+        """
+        Get the total of the first idx weights
+        """
+        node = self.root
+        total = 0
+
+        while node.children != None:
+            found = None
+            for child in node.children:
+                if idx < child.count:
+                    found = child
+                    break
+                idx -= child.count
+                total += child.total
+
+            if found == None:
+                return total
+            node = found
+
+        return total + sum(node.weights[:idx])
+
+    def splice(self, start, end, weights):
+        """
+        Replace the weights in [start, end) with the given weights
+        """
+        if end > start:
+            self.root.delete(start, end)
+
+            while self.root.children != None and len(self.root.children) < 2:
+                if len(self.root.children) == 0:
+                    self.root = self.node_class(weights=[])
+                else:
+                    self.root = self.root.children[0]
+
+        if len(weights) == 0:
+            return
+
+        nodes = self.root.insert(start, list(weights))
+
+        while len(nodes) > 1:
+            nodes = self.node_class(children=nodes).split()
+
+        self.root = nodes[0]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the bracket index and the depth tree under it
+"""
+
+import random
+import unittest
+from unittest import mock
+
+from pym.buf import Region
+from pym.brackets import BracketIndex, DepthTree
+
+def totals(weights):
+    """
+    Get the running totals along a list of weights, starting with 0
+    """
+    found = [0]
+    for weight in weights:
+        found.append(found[-1] + weight)
+    return found
+
+@mock.patch('pym.weight_tree.NODE_SIZE', 4)
+class DepthTreeTest(unittest.TestCase):
+    """
+    Check DepthTree against running totals over a plain list
+    """
+    def check(self, tree, weights, rand):
+        expected = totals(weights)
+        self.assertEqual(len(tree), len(weights))
+
+        for idx in range(len(expected)):
+            self.assertEqual(tree.total(idx), expected[idx])
+
+        for _ in range(20):
+            idx = rand.randint(0, len(weights))
+            target = rand.randint(min(expected) - 1, max(expected))
+            first = [k for k in range(idx, len(expected))
+                     if expected[k] <= target]
+            last = [k for k in range(idx + 1) if expected[k] <= target]
+
+            self.assertEqual(tree.first_at_most(idx, target),
+                             first[0] if len(first) else None)
+            self.assertEqual(tree.last_at_most(idx, target),
+                             last[-1] if len(last) else None)
+
+    def test_splices(self):
+        rand = random.Random(8)
+        weights = [rand.choice((1, -1)) for _ in range(50)]
+        tree = DepthTree(weights)
+        self.check(tree, weights, rand)
+
+        for _ in range(200):
+            start = rand.randint(0, len(weights))
+            end = rand.randint(start, min(start + 20, len(weights)))
+            new = [rand.choice((1, -1)) for _ in range(rand.randint(0, 20))]
+            weights[start:end] = new
+            tree.splice(start, end, new)
+            self.check(tree, weights, rand)
+
+    def test_empty(self):
+        tree = DepthTree()
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.first_at_most(0, 0), 0)
+        self.assertEqual(tree.first_at_most(0, -1), None)
+
+        tree.splice(0, 0, [1, -1])
+        tree.splice(0, 2, [])
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.total(0), 0)
+
+class BracketIndexTest(unittest.TestCase):
+    """
+    Check bracket matching against a stack over the text
+    """
+    def test_match(self):
+        text = "a(b[c]{d(e)}f)g]h(i"
+        index = BracketIndex()
+        index.replace((0, 0), (1, 0), self,
+                      [Region(None, char, (0, col), (0, col + 1), self)
+                       for col, char in enumerate(text) if char in "()[]{}"])
+        pairs = {}
+        stack = []
+
+        for col, char in enumerate(text):
+            if char in "([{":
+                stack.append(col)
+            elif char in ")]}":
+                opening = stack.pop() if len(stack) else None
+                if opening != None and text[opening] + char in "()[]{}":
+                    pairs[opening] = col
+                    pairs[col] = opening
+
+        for col, char in enumerate(text):
+            if char in "()[]{}":
+                found = index.match((0, col))
+                self.assertEqual(found and found[1], pairs.get(col), col)
+
+        self.assertEqual(index.enclosing((0, 9)), ((0, 8), (0, 10)))
+        self.assertEqual(index.enclosing((0, 4), '('), ((0, 1), (0, 13)))
+        self.assertEqual(index.enclosing((0, 18)), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for file type detection and the hilighting cache
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from pym.buf import Buffer, SNIFF_BYTES
+from pym.piece_table import MappedLines
+from pym.filetypes import hilight_cache, HILIGHT_CACHE_LINES, \
+    file_type_for_path, plain_text, ALIAS_DICT
+
+def slow_build_index(self):
+    """
+    Index a file after a delay, so the tests can act while it is loading
+    """
+    time.sleep(0.2)
+    while not self.complete:
+        self.index_chunk()
+
+class FakeUI(object):
+    """
+    Stands in for the UI's main loop, running posted functions on demand
+    """
+    def __init__(self):
+        self.posted = []
+
+    def post(self, func):
+        self.posted.append(func)
+
+    def redraw(self):
+        pass
+
+class HilightCacheTest(unittest.TestCase):
+    """
+    Check that hilighting is cached by file and found again without reading
+    the buffer
+    """
+    def setUp(self):
+        self.ui = FakeUI()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        patches = [mock.patch('pym.highlight.pym', self.ui),
+                   mock.patch.object(hilight_cache, 'directory',
+                                     os.path.join(self.dir, 'cache'))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.path = os.path.join(self.dir, 'a.py')
+        with open(self.path, 'w') as f:
+            for x in range(HILIGHT_CACHE_LINES):
+                f.write('def f%d(x):\n    return "%d"\n' % (x, x))
+
+    def load(self):
+        buf = Buffer()
+
+        with mock.patch.object(Buffer, 'dump_chunks') as dump_chunks:
+            buf.load_file(self.path)
+            self.assertFalse(dump_chunks.called)
+
+        return buf
+
+    def lex(self, buf):
+        buf.highlighter.refresh()
+
+        while buf.highlighter.job != None:
+            buf.highlighter.job.thread.join()
+            while len(self.ui.posted):
+                self.ui.posted.pop(0)()
+
+    def test_restore(self):
+        buf = self.load()
+        self.lex(buf)
+        regions = sorted((x.tag, x.start, x.end)
+                         for x in buf.highlighter.regions())
+
+        again = self.load()
+        self.assertIsNone(again.highlighter.job)
+        self.assertEqual(again.highlighter.lexed, len(again.lines))
+        self.assertEqual(sorted((x.tag, x.start, x.end)
+                                for x in again.highlighter.regions()),
+                         regions)
+
+    @mock.patch('pym.piece_table.MAP_CHUNK', 64)
+    @mock.patch('pym.buf.LAZY_LOAD_BYTES', 0)
+    def test_restore_once_loaded(self):
+        self.lex(self.load())
+
+        with mock.patch.object(MappedLines, 'build_index', slow_build_index):
+            buf = self.load()
+
+        self.assertFalse(buf.loaded)
+        buf.lines.original.wait()
+        self.assertEqual(len(buf.lines), HILIGHT_CACHE_LINES * 2)
+        self.assertTrue(buf.loaded)
+        self.assertIsNone(buf.highlighter.job)
+        self.assertEqual(buf.highlighter.lexed, len(buf.lines))
+
+    def test_key(self):
+        buf = self.load()
+        lexer_class = type(buf.highlighter.lexer)
+        key = hilight_cache.key(buf, lexer_class)
+        self.assertEqual(hilight_cache.key(buf, lexer_class), key)
+
+        info = os.stat(self.path)
+        os.utime(self.path, ns=(info.st_atime_ns, info.st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(hilight_cache.key(buf, lexer_class), key)
+
+        buf.insert("x")
+        self.assertIsNone(hilight_cache.key(buf, lexer_class))
+
+class FileTypeTest(unittest.TestCase):
+    """
+    Check how file types are found
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_rename(self):
+        path = os.path.join(self.dir, 'a.txt')
+        with open(path, 'w') as f:
+            f.write("x = 1\n")
+
+        self.assertIs(file_type_for_path(path), plain_text)
+        os.rename(path, os.path.join(self.dir, 'a.py'))
+        self.assertIs(file_type_for_path(os.path.join(self.dir, 'a.py')),
+                      ALIAS_DICT['python'])
+
+    @mock.patch('pym.buf.LAZY_LOAD_BYTES', 0)
+    def test_mapped_first_line(self):
+        path = os.path.join(self.dir, 'script')
+        with open(path, 'w') as f:
+            f.write("#!/usr/bin/env python3 " + "x" * (SNIFF_BYTES * 4) +
+                    "\n" + "y = 1\n" * 10)
+
+        buf = Buffer(path)
+        self.assertIs(buf.file_type, ALIAS_DICT['python'])
+
+        with mock.patch.object(MappedLines, '__getitem__') as getitem:
+            self.assertEqual(len(buf.first_line()), SNIFF_BYTES)
+            self.assertFalse(getitem.called)
+
+if __name__ == '__main__':
+    unittest.main()
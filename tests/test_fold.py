@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for folding lines out of view
+"""
+
+import random
+import unittest
+
+from pym import urwid_ui
+from pym.buf import Buffer, Motion
+from pym.mode import normal
+
+def make_buffer(count):
+    """
+    Make a buffer of numbered lines
+    """
+    buf = Buffer()
+    buf.insert("\n".join("line %d" % x for x in range(count)), 0, 0)
+    return buf
+
+class FoldIndexTest(unittest.TestCase):
+    """
+    Check a FoldIndex against visible rows worked out from a plain list
+    """
+    def check(self, folds, count):
+        """
+        Compare every screen row and buffer row in the index to the rows left
+        visible by hiding all but the first line of each closed fold
+        """
+        hidden = set()
+        for reg in folds.closed:
+            hidden.update(range(reg.start[0] + 1, reg.end[0] + 1))
+
+        visible = [x for x in range(count) if x not in hidden]
+        self.assertEqual(folds.visible_lines(), len(visible))
+
+        for screen, row in enumerate(visible):
+            self.assertEqual(folds.buffer_row(screen), row)
+            self.assertEqual(folds.screen_row(row), screen)
+
+        screen = -1
+        for row in range(count):
+            if row not in hidden:
+                screen += 1
+            self.assertEqual(folds.screen_row(row), screen)
+            self.assertEqual(folds.visible_row(row), visible[screen])
+
+    def test_random_folds(self):
+        rand = random.Random(6)
+
+        for _ in range(50):
+            buf = make_buffer(60)
+            folds = buf.folds
+
+            for _ in range(rand.randint(0, 8)):
+                first = rand.randint(0, 58)
+                last = rand.randint(first + 1, min(first + 15, 59))
+                folds.add(first, last, rand.random() < 0.6)
+
+            self.check(folds, 60)
+
+    def test_nested(self):
+        buf = make_buffer(20)
+        outer = buf.folds.add(2, 12)
+        buf.folds.add(4, 6)
+        self.check(buf.folds, 20)
+        self.assertEqual(buf.folds.buffer_row(3), 13)
+
+        buf.folds.set_closed(outer, False)
+        self.check(buf.folds, 20)
+        self.assertEqual(buf.folds.buffer_row(5), 7)
+        self.assertEqual(buf.folds.head(4), buf.folds.folds_at(4)[-1])
+
+    def test_move(self):
+        buf = make_buffer(20)
+        buf.folds.add(3, 7)
+
+        self.assertEqual(buf.folds.move(2, 1), 3)
+        self.assertEqual(buf.folds.move(3, 1), 8)
+        self.assertEqual(buf.folds.move(5, 1), 8)
+        self.assertEqual(buf.folds.move(8, -1), 3)
+        self.assertEqual(buf.folds.move(9, -3), 2)
+        self.assertEqual(buf.folds.move(1, -5), 0)
+        self.assertEqual(buf.folds.move(18, 5), 19)
+
+        buf.row = 2
+        self.assertEqual(buf.down_motion(2).ordered_coords()[1][0], 9)
+
+    def test_single_line_dropped(self):
+        buf = make_buffer(20)
+        buf.folds.add(3, 5)
+        buf.folds.add(10, 12)
+
+        Motion(buf, (3, 6), (5, 6)).delete()
+        self.assertEqual(buf.folds.visible_lines(), 16)
+        self.assertEqual(len(buf.folds), 1)
+
+    def test_edit_above(self):
+        buf = make_buffer(20)
+        reg = buf.folds.add(5, 8)
+
+        buf.insert("new\nnew\n", 2, 0)
+        self.assertEqual((reg.start[0], reg.end[0]), (7, 10))
+        self.assertEqual(buf.folds.visible_row(9), 7)
+        self.check(buf.folds, 22)
+
+        Motion(buf, (0, 0), (3, 0)).delete()
+        self.assertEqual((reg.start[0], reg.end[0]), (4, 7))
+        self.assertEqual(buf.folds.screen_row(8), 5)
+        self.check(buf.folds, 19)
+
+class FoldKeysTest(unittest.TestCase):
+    """
+    Check the z commands in normal mode
+    """
+    def setUp(self):
+        buf = urwid_ui.buf
+        last = len(buf.lines) - 1
+        Motion(buf, (0, 0), (last, len(buf.lines[last]))).delete()
+        buf.insert("\n".join("line %d" % x for x in range(20)), 0, 0)
+        buf.folds.clear()
+        buf.row = buf.col = 0
+        self.buf = buf
+        normal.reset()
+
+    def keys(self, keys):
+        """
+        Feed keys to normal mode
+        """
+        for key in keys:
+            normal.handle_key(key)
+
+    def test_create_and_delete(self):
+        self.buf.row = 3
+        self.keys("zf2j")
+        self.assertEqual(len(self.buf.folds), 1)
+        self.assertEqual(self.buf.folds.buffer_row(4), 6)
+
+        self.keys("zd")
+        self.assertEqual(len(self.buf.folds), 0)
+
+    def test_open_close_all(self):
+        self.buf.row = 2
+        self.keys("zfj")
+        self.buf.row = 10
+        self.keys("zf3j")
+        self.assertEqual(self.buf.folds.visible_lines(), 16)
+
+        self.keys("zR")
+        self.assertEqual(self.buf.folds.visible_lines(), 20)
+
+        self.buf.row = 12
+        self.keys("zM")
+        self.assertEqual(self.buf.folds.visible_lines(), 16)
+        self.assertEqual(self.buf.row, 10)
+
+        self.keys("zE")
+        self.assertEqual(len(self.buf.folds), 0)
+        self.assertEqual(self.buf.folds.visible_lines(), 20)
+
+if __name__ == '__main__':
+    unittest.main()
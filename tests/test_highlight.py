@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the incremental syntax hilighter
+"""
+
+import unittest
+from unittest import mock
+
+from pygments.lexers import PythonLexer
+from pym.buf import Buffer
+from pym.highlight import Highlighter
+
+# Enough Python that the worker needs several chunks for it
+SOURCE = "\n".join('def f%d(x):\n    """\n    doc %d\n    """\n'
+                   '    return (x, "s", [1])\n' % (x, x)
+                   for x in range(60))
+
+class FakeUI(object):
+    """
+    Stands in for the UI's main loop, running posted functions on demand
+    """
+    def __init__(self):
+        self.posted = []
+
+    def post(self, func):
+        self.posted.append(func)
+
+    def redraw(self):
+        pass
+
+class SliceLog(list):
+    """
+    A list of lines that remembers how many lines each slice of it took
+    """
+    def __init__(self, lines):
+        super(SliceLog, self).__init__(lines)
+        self.slices = []
+
+    def __getitem__(self, key):
+        found = super(SliceLog, self).__getitem__(key)
+        if isinstance(key, slice):
+            self.slices.append(len(found))
+        return found
+
+def lex_fully(highlighter, ui):
+    """
+    Refresh a highlighter and run its worker until the buffer is all lexed
+    """
+    highlighter.refresh()
+
+    while highlighter.job != None:
+        highlighter.job.thread.join()
+        while len(ui.posted):
+            ui.posted.pop(0)()
+
+def spans(highlighter):
+    """
+    Get the tags and extents of a highlighter's regions, in order
+    """
+    return sorted((x.tag, x.start, x.end) for x in highlighter.regions())
+
+class HighlighterTest(unittest.TestCase):
+    """
+    Check that lexing the buffer in bounded chunks gives the same result as
+    lexing it whole
+    """
+    def setUp(self):
+        self.ui = FakeUI()
+        patches = [mock.patch('pym.highlight.pym', self.ui),
+                   mock.patch('pym.highlight.HIGHLIGHT_CHUNK_LINES', 40),
+                   mock.patch('pym.highlight.HIGHLIGHT_BATCH_LINES', 7),
+                   mock.patch('pym.highlight.RESUME_LINES', 10)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def whole(self, text):
+        buf = Buffer()
+        buf.insert(text)
+        highlighter = Highlighter(buf, PythonLexer(), str)
+
+        with mock.patch('pym.highlight.HIGHLIGHT_CHUNK_LINES', 10 ** 6):
+            lex_fully(highlighter, self.ui)
+
+        return highlighter
+
+    def test_chunks(self):
+        buf = Buffer()
+        buf.insert(SOURCE)
+        highlighter = Highlighter(buf, PythonLexer(), str)
+        done = []
+        highlighter.on_done = done.append
+        starts = []
+
+        def start_job(orig=highlighter.start_job):
+            orig()
+            starts.append(highlighter.job.limit)
+
+        highlighter.start_job = start_job
+        lex_fully(highlighter, self.ui)
+
+        self.assertGreater(len(starts), 3)
+        self.assertEqual(starts[-1], None)
+        self.assertEqual(done, [highlighter])
+        self.assertEqual(highlighter.lexed, len(buf.lines))
+        self.assertEqual(spans(highlighter), spans(self.whole(SOURCE)))
+
+    def test_relex_hands_off(self):
+        buf = Buffer()
+        buf.insert(SOURCE)
+        highlighter = Highlighter(buf, PythonLexer(), str)
+        lex_fully(highlighter, self.ui)
+
+        buf.insert('"""\n', 0, 0)
+        buf.lines = SliceLog(buf.lines)
+        highlighter.refresh()
+
+        self.assertEqual(buf.lines.slices, [20, 50])
+        self.assertLess(highlighter.lexed, len(buf.lines))
+
+        lex_fully(highlighter, self.ui)
+        self.assertEqual(spans(highlighter),
+                         spans(self.whole('"""\n' + SOURCE)))
+
+if __name__ == '__main__':
+    unittest.main()
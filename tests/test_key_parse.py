@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for parsing key sequences
+"""
+
+import unittest
+
+from pym.key_parse import parse_key_expr
+from pym.mode import normal
+from pym import normal_mode
+
+def completed(parser, keys):
+    """
+    Offer keys to a parser until one is refused, and get the parsers among
+    its choices that completed
+    """
+    parser.reset()
+
+    for key in keys:
+        if not parser.offer(key):
+            return []
+
+    return [x for x in parser.others if x.complete]
+
+class ChoiceKeyParserTest(unittest.TestCase):
+    """
+    Check that each choice is followed, even when another shares its prefix
+    """
+    def test_shared_prefix(self):
+        parser = parse_key_expr('#?(]|[)m|[(<(>|{)|](<)>|})')
+
+        for keys in (['[', 'm'], ['3', ']', 'm'], ['[', '('], [']', '}']):
+            self.assertEqual(len(completed(parser, keys)), 1, keys)
+
+        parser.reset()
+        self.assertTrue(parser.offer('['))
+        self.assertFalse(parser.offer('x'))
+
+    def test_motions(self):
+        parser = [expr for expr, func in normal.key_exprs
+                  if func is normal_mode.normal_mode_motion][0]
+        expected = [
+            (['[', 'm'], normal_mode.definition_motion),
+            ([']', 'm'], normal_mode.definition_motion),
+            (['[', '('], normal_mode.enclosing_bracket_motion),
+            (['[', '{'], normal_mode.enclosing_bracket_motion),
+            ([']', ')'], normal_mode.enclosing_bracket_motion),
+            ([']', '}'], normal_mode.enclosing_bracket_motion),
+            (['%'], normal_mode.bracket_motion),
+            (['g', 'd'], normal_mode.goto_definition_motion),
+        ]
+
+        for keys, func in expected:
+            self.assertEqual([x.filt for x in completed(parser, keys)],
+                             [func], keys)
+
+if __name__ == '__main__':
+    unittest.main()
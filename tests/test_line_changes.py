@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for tracking the changed lines of a buffer
+"""
+
+import random
+import unittest
+
+from pym.buf import Buffer, Region, Motion
+
+class LineChangesTest(unittest.TestCase):
+    """
+    Check that LineChanges reports every line that changed
+    """
+    def test_random_edits(self):
+        rand = random.Random(3)
+        buf = Buffer()
+        buf.insert("\n".join("line %d" % x for x in range(40)))
+        changes = buf.track_changes()
+
+        for _ in range(300):
+            before = list(buf.lines)
+
+            for _ in range(rand.randint(1, 3)):
+                row = rand.randrange(len(buf.lines))
+                col = rand.randint(0, len(buf.lines[row]))
+                if rand.random() < 0.5:
+                    buf.insert(rand.choice(["x", "y\nz", "\n"]), row, col)
+                elif row + 1 < len(buf.lines):
+                    Motion(buf, (row, col), (row + 1, 0)).delete()
+
+            moved = changes.moved
+            ranges = changes.take()
+            self.assertIsNone(changes.moved)
+            self.assertEqual(changes.take(), [])
+
+            if len(buf.lines) != len(before):
+                self.assertIsNotNone(moved)
+            elif moved == None:
+                moved = len(buf.lines)
+
+            for row in range(min(moved, len(buf.lines))):
+                if buf.lines[row] != before[row]:
+                    self.assertTrue(any(x <= row < y for x, y in ranges))
+
+        changes.close()
+        self.assertEqual(buf.trackers, [])
+
+    def test_region_changes(self):
+        buf = Buffer()
+        buf.insert("a\nb\nc\nd")
+        changes = buf.track_changes()
+
+        buf.add_region(Region(None, 'x', (1, 0), (2, 1)))
+
+        self.assertEqual(changes.take(), [(1, 3)])
+        self.assertIsNone(changes.moved)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the index of line lengths
+"""
+
+import random
+import unittest
+
+from pym.line_index import LineIndex
+
+class LineIndexTest(unittest.TestCase):
+    """
+    Check a LineIndex against offsets worked out from a plain list
+    """
+    def check(self, index, lengths):
+        """
+        Compare every offset and position in the index to the lengths
+        """
+        self.assertEqual(len(index), len(lengths))
+        self.assertEqual(index.chars, sum(lengths) + len(lengths))
+
+        offset = 0
+        for row, length in enumerate(lengths):
+            for col in range(length + 1):
+                self.assertEqual(index.offset(row, col), offset + col)
+                self.assertEqual(index.position(offset + col), (row, col))
+            offset += length + 1
+
+    def test_random_splices(self):
+        rand = random.Random(2)
+        lengths = [rand.randint(0, 5) for _ in range(300)]
+        index = LineIndex(lengths)
+        self.check(index, lengths)
+
+        for _ in range(300):
+            start = rand.randint(0, len(lengths))
+            end = rand.randint(start, min(start + 80, len(lengths)))
+            new = [rand.randint(0, 5) for _ in range(rand.randint(0, 80))]
+            lengths[start:end] = new
+            index.splice(start, end, new)
+
+        self.check(index, lengths)
+
+    def test_position_clamped(self):
+        index = LineIndex([3, 0, 4])
+        self.assertEqual(index.position(index.chars), (2, 4))
+        self.assertEqual(index.position(index.chars + 10), (2, 4))
+        self.assertEqual(LineIndex().position(5), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the outline of Python definitions
+"""
+
+import random
+import unittest
+from unittest import mock
+
+from pym.buf import Buffer
+from pym.outline import OutlineIndex, parse_definitions, scan_definitions
+
+class GrowingLines(list):
+    """
+    Original lines that load a few more lines each time they are counted,
+    like a mapped file being indexed
+    """
+    def __init__(self, lines):
+        list.__init__(self, lines)
+        self.known = 1
+
+    def __len__(self):
+        known = self.known
+        self.known = min(self.known + 3, list.__len__(self))
+        return known
+
+def source(rand, count):
+    """
+    Make up some Python with nested definitions
+    """
+    lines = []
+
+    for x in range(count):
+        lines.append("class C%d(object):" % x)
+        for y in range(rand.randint(0, 3)):
+            lines.append("    def f%d_%d(self):" % (x, y))
+            lines.append("        return %d" % y)
+        lines.append("    x = 1")
+
+    return lines
+
+class ScanDefinitionsTest(unittest.TestCase):
+    """
+    Check the fallback for source that won't parse
+    """
+    def test_strings_and_comments(self):
+        lines = ['class A:',
+                 '    def f(self):',
+                 '        """',
+                 'def fake():',
+                 '        """',
+                 '        # def comment():',
+                 '        x = 1',
+                 '    async def g(self, (:',
+                 '        pass',
+                 'def h(']
+
+        self.assertEqual(scan_definitions(lines),
+                         [(0, 9, 0, 'class', 'A'), (1, 7, 1, 'def', 'f'),
+                          (7, 9, 1, 'def', 'g'), (9, 10, 0, 'def', 'h')])
+
+    def test_matches_parse(self):
+        lines = source(random.Random(4), 20)
+        self.assertEqual(scan_definitions(lines),
+                         parse_definitions("\n".join(lines)))
+
+@mock.patch('pym.outline.OUTLINE_CHUNK_LINES', 8)
+class OutlineIndexTest(unittest.TestCase):
+    """
+    Check OutlineIndex against parsing the whole buffer
+    """
+    def check(self, buf, index):
+        found = []
+        item = index.next_definition(-1)
+
+        while item != None:
+            found.append(item)
+            item = index.next_definition(item[0])
+
+        self.assertEqual(found, parse_definitions("\n".join(buf.lines)))
+
+    def test_edits(self):
+        rand = random.Random(5)
+        buf = Buffer()
+        buf.insert("\n".join(source(rand, 30)))
+        index = OutlineIndex(buf)
+        self.check(buf, index)
+
+        for _ in range(50):
+            row = rand.choice([x for x, line in enumerate(buf.lines)
+                               if line.startswith("class")])
+            buf.insert("\n".join(source(rand, 2)) + "\n", row, 0)
+            self.check(buf, index)
+
+        self.assertEqual(index.find("C3", 0)[4], "C3")
+
+    def test_while_loading(self):
+        buf = Buffer(piece_table=True)
+        lines = source(random.Random(6), 30)
+        buf.lines = buf.line_store(GrowingLines(lines))
+        index = OutlineIndex(buf)
+
+        self.assertEqual(index.next_definition(-1)[0], 0)
+        self.assertEqual(list(buf.lines), lines)
+        self.check(buf, index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the piece table line store
+"""
+
+import os
+import time
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from pym.buf import Buffer
+from pym.piece_table import PieceTable, MappedLines
+
+class PieceTableTest(unittest.TestCase):
+    """
+    Check a PieceTable against a plain list under random edits
+    """
+    def test_random_edits(self):
+        rand = random.Random(1)
+        lines = ["line %d" % x for x in range(50)]
+        table = PieceTable(list(lines))
+
+        for _ in range(2000):
+            start = rand.randint(0, len(lines))
+            end = rand.randint(start, min(start + 3, len(lines)))
+            new = ["new %d" % rand.randint(0, 99)
+                   for _ in range(rand.randint(0, 3))]
+
+            lines[start:end] = new
+            table[start:end] = new
+
+            if len(lines) and rand.random() < 0.3:
+                row = rand.randrange(len(lines))
+                lines[row] = "set %d" % row
+                table[row] = "set %d" % row
+
+            self.assertEqual(len(table), len(lines))
+
+        self.assertEqual(list(table), lines)
+        self.assertEqual(table[:], lines)
+        self.assertEqual(table[5:9], lines[5:9])
+
+    def test_typing_reuses_entry(self):
+        buf = Buffer(piece_table=True)
+        buf.insert("one\ntwo\nthree")
+        buf.row, buf.col = 1, 3
+
+        buf.insert("x")
+        added = len(buf.lines.added)
+
+        for i in range(200):
+            buf.insert("y", 1, 4 + i)
+
+        self.assertEqual(len(buf.lines.added), added)
+        self.assertEqual(buf.lines[1], "twox" + "y" * 200)
+        self.assertEqual(list(buf.lines), ["one", "twox" + "y" * 200,
+                                           "three"])
+
+def slow_build_index(self):
+    """
+    Index a file after a delay, so the tests can act while it is loading
+    """
+    time.sleep(0.2)
+    while not self.complete:
+        self.index_chunk()
+
+class MappedLinesTest(unittest.TestCase):
+    """
+    Check lazily loaded files
+    """
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        self.lines = ["line %d" % x for x in range(100)]
+
+        with os.fdopen(handle, 'w') as f:
+            f.write("\n".join(self.lines) + "\n")
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    @mock.patch('pym.piece_table.MAP_CHUNK', 64)
+    @mock.patch('pym.buf.LAZY_LOAD_BYTES', 0)
+    @mock.patch.object(MappedLines, 'build_index', slow_build_index)
+    def test_write_while_loading(self):
+        buf = Buffer(self.path)
+        self.assertLess(len(buf.lines), len(self.lines))
+
+        buf.write_file()
+
+        with open(self.path) as f:
+            self.assertEqual(f.read().split("\n")[:-1], self.lines)
+        self.assertEqual(list(buf.lines), self.lines)
+
+if __name__ == '__main__':
+    unittest.main()
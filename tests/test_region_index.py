@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the index of buffer regions
+"""
+
+import random
+import unittest
+
+from pym.buf import Region, RegionIndex
+
+def random_region(rand, tag):
+    """
+    Make a region on one or a few lines
+    """
+    row = rand.randint(0, 20)
+    col = rand.randint(0, 10)
+
+    if rand.random() < 0.3:
+        end = (row + rand.randint(1, 4), rand.randint(0, 10))
+    else:
+        end = (row, col + rand.randint(0, 5))
+
+    return Region(None, tag, (row, col), end)
+
+class RegionIndexTest(unittest.TestCase):
+    """
+    Check RegionIndex lookups against scanning every region
+    """
+    def test_lookups(self):
+        rand = random.Random(5)
+        index = RegionIndex()
+        regions = []
+
+        for i in range(300):
+            reg = random_region(rand, i)
+            regions.append(reg)
+            index.add(reg)
+
+            if rand.random() < 0.2:
+                gone = regions.pop(rand.randrange(len(regions)))
+                index.remove(gone)
+
+        self.assertEqual([x.start for x in index],
+                         sorted(x.start for x in regions))
+
+        for first in range(25):
+            last = first + rand.randint(0, 3)
+            expected = [x for x in regions
+                        if x.start[0] <= last and x.end[0] >= first]
+            found = index.in_range(first, last)
+
+            self.assertEqual(sorted(id(x) for x in found),
+                             sorted(id(x) for x in expected))
+            self.assertEqual([x.start for x in found],
+                             sorted(x.start for x in found))
+
+    def test_replace(self):
+        index = RegionIndex()
+        mine = object()
+        other = Region(None, 'other', (1, 0), (1, 2))
+        index.add(other)
+        index.replace((0, 0), (3, 0), mine,
+                      [Region(None, 'a', (0, 0), (0, 1), mine),
+                       Region(None, 'b', (2, 0), (4, 1), mine)])
+
+        reach = index.replace((2, 0), (3, 0), mine, [])
+
+        self.assertEqual(reach, 4)
+        self.assertEqual([x.tag for x in index], ['a', 'other'])
+        self.assertEqual(index.for_line(3), [])
+
+def inserted(pos, start, end):
+    """
+    Where a position moves to when text is inserted from start to end
+    """
+    if pos <= start:
+        return pos
+    if pos[0] == start[0]:
+        return (end[0], pos[1] + end[1] - start[1])
+    return (pos[0] + end[0] - start[0], pos[1])
+
+def deleted(pos, start, end):
+    """
+    Where a position moves to when the text from start to end is deleted
+    """
+    if pos <= start:
+        return pos
+    if pos < end:
+        return start
+    if pos[0] == end[0]:
+        return (start[0], pos[1] - end[1] + start[1])
+    return (pos[0] - end[0] + start[0], pos[1])
+
+class RegionMoveTest(unittest.TestCase):
+    """
+    Check that edits move regions the same wherever the gap is
+    """
+    def test_random_edits(self):
+        rand = random.Random(6)
+        index = RegionIndex()
+        regions = [random_region(rand, i) for i in range(200)]
+        expected = {id(x): (x.start, x.end) for x in regions}
+
+        for reg in regions:
+            index.add(reg)
+
+        for _ in range(300):
+            row = rand.randint(0, 25)
+            start = (row, rand.randint(0, 10))
+
+            if rand.random() < 0.5:
+                end = (row + rand.randint(0, 2), rand.randint(0, 10))
+                if end[0] == row:
+                    end = (row, start[1] + rand.randint(0, 5))
+                index.expand(start, end)
+                move = inserted
+            else:
+                end = (row + rand.randint(0, 2), rand.randint(0, 10))
+                if end < start:
+                    end = start
+                index.collapse(start, end)
+                move = deleted
+
+            for key, (reg_start, reg_end) in expected.items():
+                expected[key] = (move(reg_start, start, end),
+                                 move(reg_end, start, end))
+
+        for reg in regions:
+            self.assertEqual((reg.start, reg.end), expected[id(reg)])
+
+        self.assertEqual([x.start for x in index],
+                         sorted(x.start for x in regions))
+
+        for line in range(30):
+            self.assertEqual(sorted(id(x) for x in index.for_line(line)),
+                             sorted(id(x) for x in regions
+                                    if x.start[0] <= line <= x.end[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for searching buffers
+"""
+
+import re
+import random
+import unittest
+from unittest import mock
+
+from pym.buf import Buffer
+from pym.search import SearchIndex
+
+class GrowingLines(list):
+    """
+    Original lines that load a few more lines each time they are counted,
+    like a mapped file being indexed
+    """
+    def __init__(self, lines):
+        list.__init__(self, lines)
+        self.known = 1
+
+    def __len__(self):
+        known = self.known
+        self.known = min(self.known + 3, list.__len__(self))
+        return known
+
+@mock.patch('pym.search.SEARCH_CHUNK_LINES', 8)
+class SearchIndexTest(unittest.TestCase):
+    """
+    Check SearchIndex against searching the whole text
+    """
+    def test_matches(self):
+        rand = random.Random(7)
+        buf = Buffer()
+        buf.insert("\n".join("".join(rand.choice("ab ") for _ in range(8))
+                             for _ in range(100)))
+        index = SearchIndex(buf, re.compile("ab+"))
+
+        text = "\n".join(buf.lines)
+        expected = [buf.offset_to_pos(x.start())
+                    for x in re.finditer("ab+", text)]
+        found = []
+        pos = (0, -1)
+
+        for _ in expected:
+            pos = index.next_match(pos)[0]
+            found.append(pos)
+
+        self.assertEqual(found, expected)
+        self.assertEqual(index.next_match(found[-1])[0], expected[0])
+        self.assertEqual(index.prev_match(expected[0])[0], expected[-1])
+
+    def test_search_while_loading(self):
+        buf = Buffer(piece_table=True)
+        lines = ["line %d" % x for x in range(60)] + ["needle"]
+        buf.lines = buf.line_store(GrowingLines(lines))
+        index = SearchIndex(buf, re.compile("needle"))
+
+        self.assertEqual(index.next_match((0, 0)), ((60, 0), (60, 6)))
+        self.assertEqual(list(buf.lines), lines)
+
+if __name__ == '__main__':
+    unittest.main()
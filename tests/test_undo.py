@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the undo journal
+"""
+
+import random
+import unittest
+
+from pym.buf import Buffer, Motion
+from pym.undo import UndoJournal
+
+def random_edit(rand, buf):
+    """
+    Make a random insert or delete in a buffer. Return False if the delete
+    chosen was empty, so nothing changed.
+    """
+    row = rand.randrange(len(buf.lines))
+    col = rand.randint(0, len(buf.lines[row]))
+
+    if rand.random() < 0.6:
+        buf.insert(rand.choice(["x", "yz", "\n", "a\nb"]), row, col)
+        return True
+
+    end_row = min(row + rand.randint(0, 1), len(buf.lines) - 1)
+    end_col = rand.randint(0, len(buf.lines[end_row]))
+
+    if (end_row, end_col) <= (row, col):
+        return False
+
+    Motion(buf, (row, col), (end_row, end_col)).delete()
+    return True
+
+class UndoTest(unittest.TestCase):
+    """
+    Check that undo and redo step through the states a buffer went through
+    """
+    def test_undo_redo(self):
+        rand = random.Random(8)
+        buf = Buffer()
+        buf.insert("one\ntwo\nthree", 0, 0)
+        states = [list(buf.lines)]
+
+        for _ in range(100):
+            if random_edit(rand, buf):
+                states.append(list(buf.lines))
+
+        for state in reversed(states[:-1]):
+            self.assertTrue(buf.undo())
+            self.assertEqual(list(buf.lines), state)
+
+        buf.undo()
+        self.assertEqual(list(buf.lines), [""])
+        self.assertFalse(buf.undo())
+
+        buf.redo()
+        for state in states[1:]:
+            self.assertTrue(buf.redo())
+            self.assertEqual(list(buf.lines), state)
+
+        self.assertFalse(buf.redo())
+
+    def test_group(self):
+        buf = Buffer()
+        buf.insert("start", 0, 0)
+        buf.journal.begin_group()
+
+        for i, char in enumerate("typed"):
+            buf.insert(char, 0, 5 + i)
+        Motion(buf, (0, 0), (0, 1)).delete()
+
+        buf.journal.seal()
+        self.assertEqual(buf.lines[0], "tarttyped")
+        self.assertEqual(len(buf.journal.undo_list), 2)
+
+        buf.undo()
+        self.assertEqual(buf.lines[0], "start")
+
+    def test_limit(self):
+        journal = UndoJournal(limit=10)
+
+        for i in range(20):
+            journal.record(True, (0, i), "x", (0, i))
+
+        self.assertLessEqual(journal.size, 10)
+        self.assertEqual(len(journal.undo_list), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014, 2015 Casey Dahlin, John H. Dulaney
+#
+# This file is part of PyM.
+#
+# PyM is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# PyM is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# PyM.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for drawing buffers in the urwid UI
+"""
+
+import random
+import unittest
+from unittest import mock
+
+import urwid
+
+from pym import urwid_ui
+from pym.buf import Motion
+from pym.mode import normal, excmd
+from pym.urwid_ui import encode_line, urwid_text_color, ScrollingScreen, \
+    SCREEN_INTERNALS, FRAME_INTERVAL, FrameLoop, UrwidUI
+
+# Tags the tests put on regions
+TAGS = ['#f00', '#0f0', '#00f', '#ff0']
+
+def expand_attrs(encoded, attrs):
+    """
+    Get the attr of each character of an encoded line
+    """
+    names = []
+    for name, length in attrs:
+        names.extend([name] * length)
+
+    text = encoded.decode()
+    result = []
+    pos = 0
+    for char in text:
+        result.append(names[pos] if pos < len(names) else None)
+        pos += len(char.encode())
+    return result
+
+class EncodeLineTest(unittest.TestCase):
+    """
+    Check encode_line against coloring each character in turn
+    """
+    def test_random_spans(self):
+        rand = random.Random(4)
+
+        for _ in range(500):
+            line = "".join(rand.choice("ab é中") for _ in range(20))
+            spans = []
+            col = 0
+
+            while col < len(line):
+                start = rand.randint(col, len(line))
+                end = rand.randint(start, len(line))
+                spans.append((start, end, rand.choice(TAGS)))
+                if end - start > 2 and rand.random() < 0.5:
+                    inner = rand.randint(start + 1, end - 1)
+                    spans.append((inner, rand.randint(inner, end),
+                                  rand.choice(TAGS)))
+                col = end + 1
+
+            expected = [None] * len(line)
+            for start, end, tag in spans:
+                for col in range(start, end):
+                    expected[col] = urwid_text_color(tag)
+
+            encoded, attrs = encode_line(line, tuple(spans))
+            self.assertEqual(encoded, line.encode())
+            self.assertEqual(expand_attrs(encoded, attrs), expected)
+
+class RenderCacheTest(unittest.TestCase):
+    """
+    Check that BufferDisplay only rebuilds lines that changed
+    """
+    def setUp(self):
+        buf = urwid_ui.buf
+        last = len(buf.lines) - 1
+        Motion(buf, (0, 0), (last, len(buf.lines[last]))).delete()
+        buf.insert("\n".join("line %d" % x for x in range(30)), 0, 0)
+        buf.row = buf.col = 0
+        self.buf = buf
+        self.render()
+
+    def render(self):
+        """
+        Render the buffer display, and get its rows of text
+        """
+        urwid_ui.bdisp._invalidate()
+        canvas = urwid_ui.bdisp.render((20, 10))
+        return [x.rstrip() for x in canvas.text]
+
+    def test_only_changed_lines_rebuilt(self):
+        spans = urwid_ui.line_spans
+
+        with mock.patch('pym.urwid_ui.line_spans', wraps=spans) as called:
+            self.render()
+            self.assertEqual(called.call_count, 0)
+
+            self.buf.insert("X", 3, 0)
+            rows = self.render()
+            self.assertEqual(called.call_count, 1)
+            self.assertEqual(rows[3], b"Xline 3")
+
+            self.buf.insert("new\n", 5, 0)
+            rows = self.render()
+            self.assertEqual(rows[5:7], [b"new", b"line 5"])
+            self.assertEqual(rows[4], b"line 4")
+            self.assertEqual(called.call_count, 6)
+
+    def test_plain_screen(self):
+        screen = mock.Mock(spec=[])
+
+        with mock.patch.object(urwid_ui.pym.loop, 'screen', screen):
+            self.buf.row = 25
+            self.assertIn(b"line 25", self.render())
+
+class ScrollingScreenTest(unittest.TestCase):
+    """
+    Check moving rows on the terminal, and falling back to a plain redraw
+    """
+    def setUp(self):
+        self.screen = ScrollingScreen()
+        self.screen.screen_buf = [[(None, None, b'row %d' % x)]
+                                  for x in range(6)]
+        self.written = []
+        self.screen.write = self.written.append
+
+    def test_scroll_band(self):
+        rows = self.screen.screen_buf[2:] + [[(None, None, b'new')]] * 2
+        old = list(self.screen.screen_buf)
+
+        self.assertTrue(self.screen.can_scroll((20, 6), rows, 2))
+        self.screen.scroll_band(rows, 2)
+
+        self.assertIn("\x1b[2M", self.written)
+        self.assertEqual(self.screen.screen_buf, old[2:] + [None, None])
+
+    def test_missing_internals(self):
+        with mock.patch('pym.urwid_ui.SCREEN_INTERNALS',
+                        SCREEN_INTERNALS + ('_gone',)):
+            self.assertFalse(self.screen.can_scroll((20, 6), [], 2))
+
+        self.screen.screen_buf = None
+        self.assertFalse(self.screen.can_scroll((20, 6), [], 2))
+
+    def test_bad_screen_buf(self):
+        self.screen.screen_buf = [None] * 6
+        canvas = mock.Mock()
+        canvas.content.return_value = iter([[(None, None, b'x')]] * 6)
+        self.screen.scroll_hint = 2
+
+        with mock.patch.object(ScrollingScreen, 'scroll_band',
+                               side_effect=TypeError), \
+                mock.patch('urwid.raw_display.Screen.draw_screen') as draw:
+            self.screen.draw_screen((20, 6), canvas)
+
+        self.assertIsNone(self.screen.screen_buf)
+        draw.assert_called_once_with(self.screen, (20, 6), canvas)
+
+class FrameLoopTest(unittest.TestCase):
+    """
+    Check that redraws are merged into the loop's draw and kept to the frame
+    rate
+    """
+    def setUp(self):
+        self.ui = UrwidUI()
+        self.ui.bdisp = mock.Mock()
+        screen = mock.Mock()
+        screen.started = True
+        self.ui.loop = FrameLoop(urwid.SolidFill(), screen=screen)
+        self.ui.loop.screen_size = (80, 24)
+        self.now = 100.0
+
+        patches = [mock.patch('pym.urwid_ui.pym', self.ui),
+                   mock.patch('time.monotonic', lambda: self.now),
+                   mock.patch.object(self.ui.loop, 'draw_screen'),
+                   mock.patch.object(self.ui.loop, 'set_alarm_in')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_merged(self):
+        for _ in range(3):
+            self.ui.redraw()
+
+        self.ui.loop.entering_idle()
+        self.ui.loop.entering_idle()
+        self.assertEqual(self.ui.loop.draw_screen.call_count, 1)
+
+    def test_frame_interval(self):
+        self.ui.redraw()
+        self.ui.loop.entering_idle()
+
+        self.now += FRAME_INTERVAL / 4
+        self.ui.redraw()
+        self.ui.loop.entering_idle()
+        self.assertEqual(self.ui.loop.draw_screen.call_count, 1)
+
+        wait, callback = self.ui.loop.set_alarm_in.call_args[0]
+        self.assertAlmostEqual(wait, FRAME_INTERVAL * 3 / 4)
+
+        self.now += wait
+        callback(self.ui.loop, None)
+        self.assertEqual(self.ui.loop.draw_screen.call_count, 2)
+
+    def test_resize(self):
+        self.ui.loop.entering_idle()
+        self.assertEqual(self.ui.loop.draw_screen.call_count, 0)
+
+        self.ui.loop.screen_size = None
+        self.ui.loop.entering_idle()
+        self.assertEqual(self.ui.loop.draw_screen.call_count, 1)
+
+class PasteTest(unittest.TestCase):
+    """
+    Check that a bracketed paste is handled as one piece of text
+    """
+    def setUp(self):
+        buf = urwid_ui.buf
+        last = len(buf.lines) - 1
+        Motion(buf, (0, 0), (last, len(buf.lines[last]))).delete()
+        buf.insert("one", 0, 0)
+        buf.row = 0
+        buf.col = 1
+        self.buf = buf
+        urwid_ui.sline.buf.buf = "ab"
+        urwid_ui.sline.buf.pos = 1
+        urwid_ui.pym.mode = normal
+        self.addCleanup(setattr, urwid_ui.pym, 'mode', normal)
+
+    def paste(self, keys):
+        """
+        Send keys to the UI as a bracketed paste
+        """
+        urwid_ui.do_input('begin paste')
+        for key in keys:
+            urwid_ui.do_input(key)
+        urwid_ui.do_input('end paste')
+
+    def test_buffer(self):
+        before = list(self.buf.lines)
+
+        with mock.patch.object(normal, 'handle_key') as handle_key:
+            self.paste(['d', 'd', 'enter', 'x', 'tab', 'y', 'f1'])
+
+        handle_key.assert_not_called()
+        self.assertEqual(list(self.buf.lines), ["odd", "x\tyne"])
+
+        self.assertTrue(self.buf.undo())
+        self.assertEqual(list(self.buf.lines), before)
+
+    def test_status_line(self):
+        urwid_ui.pym.mode = excmd
+        self.paste(['x', 'y', 'enter', 'z'])
+
+        self.assertEqual(urwid_ui.sline.buf.buf, "axyb")
+        self.assertEqual(urwid_ui.sline.buf.pos, 3)
+        self.assertEqual(list(self.buf.lines), ["one"])
+
+    def test_keys_mapped(self):
+        urwid_ui.do_input('begin paste')
+        for key in ['a', 'enter', 'tab', 'page up', 'b']:
+            urwid_ui.do_input(key)
+
+        self.assertTrue(urwid_ui.paste.collecting)
+        self.assertEqual(urwid_ui.paste.end(), "a\n\tb")
+        self.assertFalse(urwid_ui.paste.collecting)
+
+if __name__ == '__main__':
+    unittest.main()